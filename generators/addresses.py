@@ -0,0 +1,177 @@
+# addresses.py
+import json
+import os
+import random
+import threading
+import time
+from pathlib import Path
+import requests
+
+BASE_DIR = Path.cwd()
+
+# Local copy of the addresses downloaded from mockaroo
+address_cache_path = BASE_DIR / "addresses.json"
+
+MOCKAROO_ADDRESS_URL = "https://my.api.mockaroo.com/address.json?key=d995a340"
+
+# Used by generate_offline_address when mockaroo cannot be reached
+STREETS = ["High Street", "Station Road", "Church Lane", "Main Street", "Park Avenue", "Mill Road",
+           "Victoria Road", "Queen Street", "Castle Street", "Manor Way", "Riverside Drive", "Malone Road"]
+TOWNS = [("Belfast", "BT"), ("Manchester", "M"), ("Leeds", "LS"), ("Bristol", "BS"), ("Glasgow", "G"),
+         ("Cardiff", "CF"), ("Newcastle", "NE"), ("Derry", "BT"), ("Edinburgh", "EH"), ("Liverpool", "L"),
+         ("Sheffield", "S"), ("Nottingham", "NG")]
+POSTCODE_LETTERS = "ABDEFGHJLNPQRSTUWXYZ"
+
+
+def generate_offline_address(index: int, seed: int = 0) -> dict:
+    """Builds a UK-style address without any network access.
+
+    The same ``index`` and ``seed`` always give the same address, so offline runs are repeatable.
+
+    Returns:
+    - address: ``dict`` with the same keys as the mockaroo API
+    """
+    rng = random.Random(seed * 1_000_003 + index)
+    town, area = rng.choice(TOWNS)
+    return {
+        "address": f"{rng.randint(1, 250)} {rng.choice(STREETS)}",
+        "address_2": f"Flat {rng.randint(1, 30)}" if rng.random() < 0.2 else "",
+        "city": town,
+        "country": "United Kingdom",
+        "post_code": f"{area}{rng.randint(1, 20)} {rng.randint(1, 9)}"
+                     f"{rng.choice(POSTCODE_LETTERS)}{rng.choice(POSTCODE_LETTERS)}",
+        "country_code": "GB",
+    }
+
+
+class AddressPool:
+    """Serves random addresses from memory instead of calling the mockaroo API per patient.
+
+    Addresses are downloaded from mockaroo in bulk and saved to ``addresses.json``, so later runs
+    start from the local file. Once the pool holds ``min_size`` addresses it serves them at random,
+    and a background refill tops it up by ``refill_size`` after every ``refill_after`` addresses
+    served, until it holds ``max_size``. When mockaroo cannot be reached, or ``offline`` is set,
+    addresses come from ``generate_offline_address``.
+
+    Args:
+    - path: ``Path``, location of the local address file
+    - min_size: ``int``, addresses needed before the pool stops fetching up front
+    - refill_size: ``int``, addresses requested from mockaroo per call
+    - refill_after: ``int | None``, addresses served between background refills, ``None`` to never refill
+    - max_size: ``int``, largest number of addresses kept
+    - offline: ``bool``, never call mockaroo
+    - seed: ``int``, seed for choosing and generating addresses
+    - retry_after: ``float``, seconds to wait before calling mockaroo again after a failure
+    """
+    def __init__(self, path=address_cache_path, min_size=200, refill_size=500, refill_after=1000,
+                 max_size=20000, offline=False, seed=None, retry_after=60):
+        self.path = Path(path)
+        self.min_size = min_size
+        self.refill_size = refill_size
+        self.refill_after = refill_after
+        self.max_size = max_size
+        self.offline = offline
+        self.retry_after = retry_after
+        self.last_failure = None
+        self.seed = seed if seed is not None else random.randrange(2**31)
+        self.rng = random.Random(self.seed)
+        self.lock = threading.Lock()
+        self.refilling = False
+        self.served = 0
+        self.offline_served = 0
+        self.addresses: list[dict] = self.load()
+
+
+    def load(self) -> list[dict]:
+        if not self.path.exists():
+            return []
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Could not read address file {self.path}: {e}")
+            return []
+
+
+    def save(self) -> None:
+        temp_path = self.path.with_suffix(".tmp")
+        with open(temp_path, "w") as f:
+            json.dump(self.addresses, f)
+        os.replace(temp_path, self.path)
+
+
+    def fetch(self, count: int) -> list[dict]:
+        """Downloads ``count`` addresses from mockaroo in one request."""
+        response = requests.get(MOCKAROO_ADDRESS_URL, params={"count": count}, timeout=30)
+        response.raise_for_status()
+        addresses = response.json()
+        # mockaroo returns a single object rather than a list when count is 1
+        return addresses if isinstance(addresses, list) else [addresses]
+
+
+    def refill(self, count: int | None = None) -> bool:
+        """Adds addresses from mockaroo to the pool and saves it. Returns False if mockaroo failed."""
+        if self.offline:
+            return False
+        if self.last_failure is not None and time.monotonic() - self.last_failure < self.retry_after:
+            return False
+        try:
+            addresses = self.fetch(count or self.refill_size)
+        except (requests.RequestException, ValueError) as e:
+            print(f"Could not fetch addresses from mockaroo: {e}")
+            self.last_failure = time.monotonic()
+            return False
+        self.last_failure = None
+
+        with self.lock:
+            self.addresses.extend(addresses)
+            del self.addresses[:-self.max_size]
+            self.save()
+        return True
+
+
+    def background_refill(self) -> None:
+        try:
+            self.refill()
+        finally:
+            self.refilling = False
+
+
+    def get(self) -> dict:
+        """Returns a random address, without touching the network in the common case."""
+        if len(self.addresses) < self.min_size and not self.offline:
+            self.refill(max(self.refill_size, self.min_size - len(self.addresses)))
+
+        with self.lock:
+            if not self.addresses:
+                self.offline_served += 1
+                return generate_offline_address(self.offline_served, self.seed)
+
+            self.served += 1
+            address = dict(self.rng.choice(self.addresses))
+
+            start_refill = (self.refill_after and self.served % self.refill_after == 0 and not self.refilling
+                            and not self.offline and len(self.addresses) < self.max_size)
+            if start_refill:
+                self.refilling = True
+
+        if start_refill:
+            threading.Thread(target=self.background_refill, daemon=True).start()
+
+        return address
+
+
+# Shared pool used by request_random_address
+default_address_pool: AddressPool | None = None
+
+
+def get_address_pool() -> AddressPool:
+    """Returns the process's shared ``AddressPool``.
+
+    Set the ``POLL_SYNTHEA_OFFLINE`` environment variable to never call mockaroo, e.g. on
+    machines without network access.
+    """
+    global default_address_pool
+    if default_address_pool is None:
+        default_address_pool = AddressPool(offline=bool(os.environ.get("POLL_SYNTHEA_OFFLINE")))
+    return default_address_pool
@@ -0,0 +1,303 @@
+# columnar.py
+import datetime
+import gc
+from pathlib import Path
+from typing import Iterator
+from .utilities import BASE_DIR, PatientInfo, PatientCondition, PatientObservation, parse_fhir_date_time
+
+# pyarrow is optional; it is only needed to export and reload populations as Parquet
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pc = pq = None
+
+# Default folder of an exported population
+population_folder_path = BASE_DIR / "population"
+
+PATIENT_TEXT_FIELDS = ["gender", "ssn", "first_name", "middle_name", "last_name", "address", "address_2", "city",
+                       "country", "post_code", "country_code"]
+CONDITION_FIELDS = ["condition", "clinical_status", "verification_status", "onset_date_time", "recorded_date",
+                    "abatement_time", "encounter_reference", "subject_reference", "snomed_code"]
+OBSERVATION_FIELDS = ["category", "observation", "status", "effective_date_time", "issued", "value_quantity",
+                      "value_codeable_concept", "encounter_reference", "subject_reference", "component"]
+
+# Date-times are kept as ISO text, as FHIR allows partial dates such as 2015 which are not datetimes
+CONDITION_DATE_TIMES = ("onset_date_time", "recorded_date", "abatement_time")
+OBSERVATION_DATE_TIMES = ("effective_date_time", "issued")
+
+
+def require_pyarrow() -> None:
+    if pa is None:
+        raise ImportError("Exporting or loading a population as Parquet needs pyarrow: pip install pyarrow")
+
+
+def patient_schema():
+    return pa.schema(
+        [("patient_index", pa.int64()), ("id", pa.string()), ("hl7v2_id", pa.list_(pa.string())),
+         ("birth_date", pa.date32())]
+        + [(name, pa.string()) for name in PATIENT_TEXT_FIELDS]
+        + [("age", pa.int32()), ("creation_date", pa.date32()),
+           # Rows of the patient's conditions and observations in the other two tables
+           ("condition_start", pa.int64()), ("condition_count", pa.int32()),
+           ("observation_start", pa.int64()), ("observation_count", pa.int32())]
+    )
+
+
+def condition_schema():
+    return pa.schema([("patient_index", pa.int64())] + [(name, pa.string()) for name in CONDITION_FIELDS])
+
+
+def observation_schema():
+    component = pa.list_(pa.struct([("code_text", pa.string()), ("result", pa.string())]))
+    return pa.schema([("patient_index", pa.int64())]
+                     + [(name, pa.string()) for name in OBSERVATION_FIELDS[:-1]]
+                     + [("component", component)])
+
+
+# Dates may come as date, datetime or ISO text, depending on whether the patient came from FHIR or Firestore
+def to_date(value):
+    if value is None or isinstance(value, datetime.date) and not isinstance(value, datetime.datetime):
+        return value
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    return datetime.date.fromisoformat(str(value)[:10])
+
+
+def to_text(value):
+    if value is None:
+        return None
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return str(value)
+
+
+class PopulationWriter:
+    """Writes patients, with their conditions and observations, to three linked Parquet tables:
+    ``patients.parquet``, ``conditions.parquet`` and ``observations.parquet``.
+
+    Every condition and observation row carries the ``patient_index`` of its patient, and every
+    patient row records where its conditions and observations start and how many there are, so a
+    loader can find them without a join. Patients are written ``batch_size`` at a time, so a
+    population of any size can be streamed through.
+
+    Patients are stored in the form ``parse_fhir_message`` builds, which is reloaded unchanged: 
+    ``hl7v2_id`` as a list of strings, ``birth_date`` and ``creation_date`` as dates, date-times 
+    as ISO text that is parsed again with ``parse_fhir_date_time``, and every other value as a 
+    string. Patients in another form are normalised to it, so a patient read from Firestore, 
+    whose ``hl7v2_id`` is a single string and whose dates are ISO text, comes back with a 
+    one-element ``hl7v2_id`` list and ``date`` values.
+
+    Args:
+    - folder: ``Path``, created if missing
+    - batch_size: ``int``, patients held before each write
+    """
+    def __init__(self, folder=population_folder_path, batch_size=10000):
+        require_pyarrow()
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.batch_size = batch_size
+        self.writers = {
+            "patients": pq.ParquetWriter(self.folder / "patients.parquet", patient_schema()),
+            "conditions": pq.ParquetWriter(self.folder / "conditions.parquet", condition_schema()),
+            "observations": pq.ParquetWriter(self.folder / "observations.parquet", observation_schema()),
+        }
+        self.patient_count = 0
+        self.condition_count = 0
+        self.observation_count = 0
+        self.start_batch()
+
+
+    def start_batch(self) -> None:
+        self.rows = {
+            "patients": {name: [] for name in patient_schema().names},
+            "conditions": {name: [] for name in condition_schema().names},
+            "observations": {name: [] for name in observation_schema().names},
+        }
+        self.batch_count = 0
+
+
+    def write(self, patient_info: PatientInfo) -> None:
+        """Adds one patient, with its conditions and observations."""
+        index = self.patient_count
+        hl7v2_id = patient_info.hl7v2_id
+        # Patients read from Firestore hold a single hl7v2_id
+        if isinstance(hl7v2_id, str):
+            hl7v2_id = [hl7v2_id]
+
+        patients = self.rows["patients"]
+        patients["patient_index"].append(index)
+        patients["id"].append(to_text(patient_info.id))
+        patients["hl7v2_id"].append(list(hl7v2_id or []))
+        patients["birth_date"].append(to_date(patient_info.birth_date))
+        for name in PATIENT_TEXT_FIELDS:
+            patients[name].append(to_text(getattr(patient_info, name)))
+        patients["age"].append(patient_info.age)
+        patients["creation_date"].append(to_date(patient_info.creation_date))
+        patients["condition_start"].append(self.condition_count)
+        patients["condition_count"].append(len(patient_info.conditions))
+        patients["observation_start"].append(self.observation_count)
+        patients["observation_count"].append(len(patient_info.observations))
+
+        conditions = self.rows["conditions"]
+        for condition in patient_info.conditions:
+            conditions["patient_index"].append(index)
+            for name in CONDITION_FIELDS:
+                conditions[name].append(to_text(getattr(condition, name)))
+
+        observations = self.rows["observations"]
+        for observation in patient_info.observations:
+            observations["patient_index"].append(index)
+            for name in OBSERVATION_FIELDS[:-1]:
+                observations[name].append(to_text(getattr(observation, name)))
+            observations["component"].append(
+                [{"code_text": to_text(c["code_text"]), "result": to_text(c["result"])} for c in observation.component]
+                if observation.component is not None else None
+            )
+
+        self.patient_count += 1
+        self.condition_count += len(patient_info.conditions)
+        self.observation_count += len(patient_info.observations)
+        self.batch_count += 1
+        if self.batch_count >= self.batch_size:
+            self.flush()
+
+
+    def flush(self) -> None:
+        schemas = {"patients": patient_schema(), "conditions": condition_schema(), "observations": observation_schema()}
+        for name, columns in self.rows.items():
+            if columns["patient_index"]:
+                self.writers[name].write_table(pa.table(columns, schema=schemas[name]))
+        self.start_batch()
+
+
+    def close(self) -> None:
+        self.flush()
+        for writer in self.writers.values():
+            writer.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def export_population(patients, folder=population_folder_path, batch_size=10000) -> int:
+    """Writes patients, e.g. from ``iter_firestore_age_range`` or ``parse_fhir_file``, to Parquet with a
+    ``PopulationWriter``.
+
+    Args:
+    - patients: ``Iterable[PatientInfo]``
+    - folder: ``Path``
+    - batch_size: ``int``
+
+    Returns:
+    - ``int``, the number of patients written
+    """
+    with PopulationWriter(folder, batch_size) as writer:
+        for patient_info in patients:
+            writer.write(patient_info)
+    return writer.patient_count
+
+
+class ColumnarPopulation:
+    """A population exported by ``PopulationWriter``, rebuilt into ``PatientInfo`` objects lazily.
+
+    The three tables are memory mapped, and a column is only turned into Python values the first
+    time it is needed; the condition and observation tables are not read at all unless details are
+    wanted. A ``PatientInfo`` is built when it is indexed or iterated over, so loading a large
+    population costs little until patients are actually used.
+
+    Args:
+    - folder: ``Path``, a folder written by ``PopulationWriter``
+    - details: ``bool``, whether built patients include their conditions and observations
+    """
+    def __init__(self, folder=population_folder_path, details=True):
+        require_pyarrow()
+        self.folder = Path(folder)
+        self.details = details
+        self.patients = pq.read_table(self.folder / "patients.parquet", memory_map=True)
+        self.tables = {}
+        self.columns = {}
+
+
+    def table(self, name: str):
+        if name not in self.tables:
+            self.tables[name] = pq.read_table(self.folder / f"{name}.parquet", memory_map=True)
+        return self.tables[name]
+
+
+    def column(self, name: str, table: str = "patients") -> list:
+        """Returns a column as Python values, decoding it on first use."""
+        if (table, name) not in self.columns:
+            # Decoding makes millions of objects at once; collecting garbage meanwhile only slows it down
+            gc_was_enabled = gc.isenabled()
+            gc.disable()
+            try:
+                values = (self.patients if table == "patients" else self.table(table))[name].to_pylist()
+                if name in CONDITION_DATE_TIMES + OBSERVATION_DATE_TIMES:
+                    # The same date-times repeat across rows, so parse each one once
+                    parsed = {value: parse_fhir_date_time(value) for value in set(values)}
+                    values = [parsed[value] for value in values]
+            finally:
+                if gc_was_enabled:
+                    gc.enable()
+            self.columns[(table, name)] = values
+        return self.columns[(table, name)]
+
+
+    def __len__(self) -> int:
+        return self.patients.num_rows
+
+
+    def __getitem__(self, index: int) -> PatientInfo:
+        return self.patient(index)
+
+
+    def __iter__(self) -> Iterator[PatientInfo]:
+        for index in range(len(self)):
+            yield self.patient(index)
+
+
+    def patient(self, index: int) -> PatientInfo:
+        """Builds the ``PatientInfo`` in row ``index``."""
+        column = self.column
+        patient_info = PatientInfo(
+            id=column("id")[index],
+            hl7v2_id=column("hl7v2_id")[index],
+            birth_date=column("birth_date")[index],
+            age=column("age")[index],
+            creation_date=column("creation_date")[index],
+            **{name: column(name)[index] for name in PATIENT_TEXT_FIELDS},
+        )
+
+        if self.details:
+            start, count = column("condition_start")[index], column("condition_count")[index]
+            if count:
+                fields = [column(name, "conditions")[start:start + count] for name in CONDITION_FIELDS]
+                patient_info.conditions = [PatientCondition(*values) for values in zip(*fields)]
+
+            start, count = column("observation_start")[index], column("observation_count")[index]
+            if count:
+                fields = [column(name, "observations")[start:start + count] for name in OBSERVATION_FIELDS]
+                patient_info.observations = [PatientObservation(*values) for values in zip(*fields)]
+
+        return patient_info
+
+
+    def select(self, lower: int, upper: int, gender: str = None) -> list[int]:
+        """Returns the rows of the patients aged ``lower`` to ``upper``, inclusive, optionally of one gender."""
+        mask = pc.and_(pc.greater_equal(self.patients["age"], lower), pc.less_equal(self.patients["age"], upper))
+        if gender is not None:
+            mask = pc.and_(mask, pc.equal(self.patients["gender"], gender))
+        return self.patients["patient_index"].filter(mask).to_pylist()
+
+
+    def iter_age_range(self, lower: int, upper: int, limit: int = None, gender: str = None) -> Iterator[PatientInfo]:
+        """Yields up to ``limit`` patients aged ``lower`` to ``upper``, building each as it is reached."""
+        for index in self.select(lower, upper, gender)[:limit]:
+            yield self.patient(index)
@@ -0,0 +1,95 @@
+# histogram.py
+from firebase_admin import firestore
+from .paging import iter_query_pages
+
+# Counter document holding the number of patients in full_fhir by gender and age
+HISTOGRAM_COLLECTION = "stats"
+HISTOGRAM_DOCUMENT = "age_sex_histogram"
+
+
+def histogram_ref(db: firestore.client):
+    return db.collection(HISTOGRAM_COLLECTION).document(HISTOGRAM_DOCUMENT)
+
+
+def count_by_age_and_gender(patients) -> dict[str, dict[str, int]]:
+    """Counts patients by gender and age, as ``{gender: {str(age): count}}``.
+
+    Args:
+    - patients: ``Iterable`` of objects or dicts with ``gender`` and ``age``
+    """
+    counts: dict[str, dict[str, int]] = {}
+    for patient in patients:
+        gender, age = (patient.get("gender"), patient.get("age")) if isinstance(patient, dict) else \
+            (patient.gender, patient.age)
+        if age is None:
+            continue
+        by_age = counts.setdefault(str(gender), {})
+        by_age[str(age)] = by_age.get(str(age), 0) + 1
+    return counts
+
+
+def increment_age_histogram(db: firestore.client, patients) -> None:
+    """Adds newly uploaded patients to the counter document with one write of ``firestore.Increment``s.
+
+    Args:
+    - db: ``firestore.client``
+    - patients: ``Iterable[PatientInfo]``, patients which were added, not ones which already existed
+    """
+    counts = count_by_age_and_gender(patients)
+    if counts:
+        histogram_ref(db).set(
+            {"counts": {gender: {age: firestore.Increment(n) for age, n in by_age.items()}
+                        for gender, by_age in counts.items()}},
+            merge=True,
+        )
+
+
+class AgeHistogram:
+    """The number of patients in ``full_fhir`` by gender and age, read from one counter document.
+
+    The counter is kept up to date by ``save_to_firestore`` and ``save_patients_to_firestore``, so
+    "how many patients aged L..U exist" is answered from memory instead of an aggregation query.
+    Counts are by the ``age`` stored with each patient, which is what queries with ``peter_pan`` set
+    filter on. ``rebuild`` counts the collection once, for a database which predates the counter.
+
+    The first upload creates the counter document, but on an older database it then only holds the 
+    patients added since. ``exists`` is therefore only set once ``rebuild`` has written its ``built`` 
+    marker; until then ``count_patient_records`` keeps using the aggregation query.
+
+    Args:
+    - db: ``firestore.client``
+    """
+    def __init__(self, db):
+        self.db = db
+        self.counts: dict[str, dict[str, int]] = {}
+        self.exists = False
+        self.refresh()
+
+
+    def refresh(self) -> None:
+        """Reads the counter document again, one document read."""
+        snapshot = histogram_ref(self.db).get()
+        self.exists = snapshot.exists and bool((snapshot.to_dict() or {}).get("built"))
+        self.counts = (snapshot.to_dict() or {}).get("counts", {}) if snapshot.exists else {}
+
+
+    def count(self, lower: int, upper: int, gender: str = None) -> int:
+        """Returns the number of patients aged ``lower`` to ``upper``, inclusive, optionally of one gender."""
+        total = 0
+        for patient_gender, by_age in self.counts.items():
+            if gender is not None and patient_gender != gender:
+                continue
+            total += sum(n for age, n in by_age.items() if lower <= int(age) <= upper)
+        return total
+
+
+    def rebuild(self, page_size: int = 1000) -> None:
+        """Counts every patient in ``full_fhir`` and replaces the counter document with the result.
+
+        Reads every patient document once, fetching only its age and gender.
+        """
+        query = self.db.collection("full_fhir").select(["age", "gender"])
+        docs = iter_query_pages(query, "age", float("inf"), page_size)
+        self.counts = count_by_age_and_gender(doc.to_dict() for doc in docs)
+        histogram_ref(self.db).set({"counts": self.counts, "built": True})
+        self.exists = True
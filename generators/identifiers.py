@@ -0,0 +1,335 @@
+# identifiers.py
+import logging
+import os
+import random
+import sqlite3
+import string
+import threading
+import time
+from array import array
+from pathlib import Path
+
+BASE36_DIGITS = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+# Every pair of uppercase letters, so two letters can be looked up from one number
+LETTER_PAIRS = [a + b for a in string.ascii_uppercase for b in string.ascii_uppercase]
+
+
+def to_base36(number, width=5):
+    result = ""
+    while number:
+        number, remainder = divmod(number, 36)
+        result = BASE36_DIGITS[remainder] + result
+    return result.rjust(width, "0")
+
+
+# Formats numbers below 676,000 as three digits followed by two uppercase letters, e.g. 042QX
+def format_digits_letters(numbers: list[int]) -> list[str]:
+    return [str(number // 676).zfill(3) + LETTER_PAIRS[number % 676] for number in numbers]
+
+
+# Formats numbers below 1,000,000 as six digits
+def format_six_digits(numbers: list[int]) -> list[str]:
+    return [str(number).zfill(6) for number in numbers]
+
+
+# Formats numbers below 999,999,999 as filler order numbers, e.g. 1^^23^4
+def format_filler_order_nums(numbers: list[int]) -> list[str]:
+    return [f"1^^{(number + 1) // 10000}^{(number + 1) % 10000}" for number in numbers]
+
+
+# Spaces up to this size list their unused numbers once mostly used, rather than rejecting most draws
+COMPLEMENT_LIMIT = 1 << 20
+
+# File in an output folder recording the identifiers handed out for it
+IDENTIFIER_STORE_NAME = ".identifiers.sqlite"
+
+
+class IdentifierStore:
+    """A SQLite record of the identifiers handed out for one output folder, so a later run, or another 
+    process, writing to the same folder never hands them out again.
+
+    Args:
+    - path: ``Path``, location of the SQLite database
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS used (
+                space TEXT NOT NULL,
+                number INTEGER NOT NULL,
+                PRIMARY KEY (space, number)
+            ) WITHOUT ROWID"""
+        )
+        self.connection.commit()
+
+
+    def load(self, space: str, index: int = 0, count: int = 1) -> list[int]:
+        """Returns the numbers of ``space`` already used within share ``index`` of ``count``, as positions in the share."""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT number FROM used WHERE space = ? AND number % ? = ?", (space, count, index)
+            ).fetchall()
+        return [number // count for number, in rows]
+
+
+    def add(self, space: str, numbers: list[int]) -> None:
+        with self.lock:
+            self.connection.executemany("INSERT OR IGNORE INTO used VALUES (?, ?)", ((space, n) for n in numbers))
+            self.connection.commit()
+
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
+
+
+class IdentifierSpace:
+    """Generates random identifiers which never repeat within a run, or within an output folder with a store.
+
+    Identifiers are drawn in batches from the space ``[0, size)``, as one block of random 64-bit
+    words from ``random.randbytes``, and formatted with ``formatter``. Every drawn number is kept in a set, so an identifier is never
+    handed out twice until ``reset`` is called. A warning is logged once the space is ``warn_at``
+    full, and a RuntimeError is raised once it is exhausted.
+
+    The used set only lives in one process, so processes writing to the same output folder each
+    take their own share of the space with ``partition``: process ``index`` of ``count`` only hands
+    out numbers ``n`` with ``n % count == index``. With an ``IdentifierStore`` attached by ``use_store``,
+    the numbers used by earlier runs into the same folder are loaded, and every number drawn is added.
+
+    Args:
+    - name: ``str``, used in warnings
+    - size: ``int``, number of possible identifiers
+    - formatter: ``Callable[[list[int]], list[str]]``, turns a batch of numbers into identifiers
+    - batch_size: ``int``, identifiers drawn at a time by ``next``
+    - warn_at: ``float``, fraction of the space used before warning
+    """
+    def __init__(self, name, size, formatter, batch_size=10000, warn_at=0.8):
+        self.name = name
+        self.full_size = size
+        self.formatter = formatter
+        self.batch_size = batch_size
+        self.warn_at = warn_at
+        self.lock = threading.Lock()
+        self.store = None
+        self.partition(0, 1)
+
+
+    def partition(self, index: int, count: int) -> None:
+        """Restricts this process to share ``index`` of ``count`` of the space, and starts a new run."""
+        if not 0 <= index < count:
+            raise ValueError(f"Partition {index} of {count} does not exist")
+        self.part = index
+        self.parts = count
+        # Numbers drawn are positions within the share, n * count + index in the whole space
+        self.size = len(range(index, self.full_size, count))
+        self.reset()
+
+
+    def use_store(self, store) -> None:
+        """Records the identifiers handed out in ``store`` from now on, or stops recording them with ``None``."""
+        self.store = store
+        self.reset()
+
+
+    def reset(self) -> None:
+        """Forgets every identifier handed out, starting a new run. Those recorded in the store stay used."""
+        with self.lock:
+            self.used: set[int] = set(self.store.load(self.name, self.part, self.parts)) if self.store else set()
+            self.buffer: list[str] = []
+            self.warned = False
+
+
+    def draw(self, count: int) -> list[int]:
+        """Draws ``count`` numbers which have not been used yet and marks them as used."""
+        remaining = self.size - len(self.used)
+        if count > remaining:
+            raise RuntimeError(f"Only {remaining} {self.name} identifiers are left, {count} were requested")
+
+        if self.size <= COMPLEMENT_LIMIT and len(self.used) > self.size // 2:
+            # A small space which is mostly used: sample from what is left rather than rejecting most draws
+            numbers = random.sample([n for n in range(self.size) if n not in self.used], count)
+            self.used.update(numbers)
+        else:
+            size, used = self.size, self.used
+            numbers = []
+            while len(numbers) < count:
+                # Draw enough extra to cover repeats and used numbers, so a large space which is mostly
+                # used still needs no list of what is left; the modulo bias is negligible next to 2**64
+                needed = count - len(numbers)
+                free = size - len(used)
+                words = array("Q", random.randbytes(8 * min(needed * size // free + needed // 4 + 8, 1 << 20)))
+                # dict.fromkeys drops repeats within the draw while keeping the random order
+                fresh = [number for number in dict.fromkeys([word % size for word in words]) if number not in used]
+                fresh = fresh[:needed]
+                used.update(fresh)
+                numbers += fresh
+
+        if not self.warned and len(self.used) >= self.size * self.warn_at:
+            self.warned = True
+            logging.warning(f"{len(self.used)} of {self.size} {self.name} identifiers have been used in this run")
+            print(f"x Warning: {self.name} identifiers are {len(self.used) / self.size:.0%} used")
+
+        if self.parts > 1:
+            numbers = [number * self.parts + self.part for number in numbers]
+        if self.store:
+            self.store.add(self.name, numbers)
+        return numbers
+
+
+    def take(self, count: int) -> list[str]:
+        """Returns ``count`` new identifiers in one call."""
+        with self.lock:
+            return self.formatter(self.draw(count))
+
+
+    def next(self) -> str:
+        """Returns one new identifier, drawn from the current batch."""
+        with self.lock:
+            if not self.buffer:
+                count = min(self.batch_size, self.size - len(self.used)) or 1
+                self.buffer = self.formatter(self.draw(count))
+                # pop() takes from the end, so reverse to hand them out in drawn order
+                self.buffer.reverse()
+            return self.buffer.pop()
+
+
+placer_order_numbers = IdentifierSpace("placer order number", 1000 * len(LETTER_PAIRS), format_digits_letters)
+visit_institutions = IdentifierSpace("visit institution", 1000 * len(LETTER_PAIRS), format_digits_letters)
+visit_numbers = IdentifierSpace("visit number", 1_000_000, format_six_digits)
+filler_order_numbers = IdentifierSpace("filler order number", 999_999_999, format_filler_order_nums)
+
+IDENTIFIER_SPACES = [placer_order_numbers, visit_institutions, visit_numbers, filler_order_numbers]
+
+
+def partition_identifiers(index: int, count: int) -> None:
+    """Gives this process share ``index`` of ``count`` of every identifier space, so processes writing
+    to one output folder never hand out the same identifier."""
+    for space in IDENTIFIER_SPACES:
+        space.partition(index, count)
+
+
+def current_partition() -> tuple[int, int]:
+    """Returns the share ``(index, count)`` of the identifier spaces this process draws from."""
+    return placer_order_numbers.part, placer_order_numbers.parts
+
+
+def identifier_partition() -> tuple[int, int]:
+    """Returns the share of the identifier spaces set for this process by the ``POLL_SYNTHEA_WORKER_ID``
+    and ``POLL_SYNTHEA_WORKER_COUNT`` environment variables, e.g. for separate runs into one folder."""
+    count = int(os.environ.get("POLL_SYNTHEA_WORKER_COUNT", 1))
+    index = int(os.environ.get("POLL_SYNTHEA_WORKER_ID", 0)) % count if count > 1 else 0
+    return index, count
+
+
+partition_identifiers(*identifier_partition())
+
+
+# Every pair of base 36 digits, so sequence numbers can be formatted two digits at a time
+BASE36_PAIRS = [a + b for a in BASE36_DIGITS for b in BASE36_DIGITS]
+
+
+# Formats a sequence number below 36 ** 6 as six base 36 digits
+def format_sequence(sequence: int) -> str:
+    high, low = divmod(sequence, 1296)
+    return BASE36_PAIRS[high // 1296] + BASE36_PAIRS[high % 1296] + BASE36_PAIRS[low]
+
+
+# Control ids count seconds from here, so six base 36 digits last until 2091
+CONTROL_ID_EPOCH = 1672531200  # 2023-01-01 UTC
+
+# Control ids are <time:6><worker:5><sequence:6>, 17 characters, within the 20 allowed in MSH-10.
+# Five worker digits hold any Linux process id (pid_max is at most 4194304) without wrapping
+CONTROL_ID_WORKERS = 36 ** 5
+CONTROL_ID_SEQUENCE = 36 ** 6
+
+
+class ControlIdGenerator:
+    """Generates MSH-10 message control ids which are unique within and across processes.
+
+    Each id is the second it was made in, the worker id and a sequence number within that second,
+    all in base 36. The worker id comes from the ``POLL_SYNTHEA_WORKER_ID`` environment variable,
+    or the whole process id, and is worked out again in a forked child. If the sequence runs out within
+    a second the generator moves on to the next second, so ids never repeat or go backwards.
+
+    Args:
+    - worker_id: ``int``, overrides the environment variable and process id
+    """
+    def __init__(self, worker_id=None):
+        self.fixed_worker_id = worker_id
+        self.lock = threading.Lock()
+        self.reset()
+
+
+    def reset(self) -> None:
+        """Works out the worker id again and restarts the sequence, e.g. after a fork."""
+        worker_id = self.fixed_worker_id
+        if worker_id is None:
+            worker_id = int(os.environ.get("POLL_SYNTHEA_WORKER_ID", os.getpid()))
+        self.worker = to_base36(worker_id % CONTROL_ID_WORKERS, 5)
+        self.second = 0
+        self.sequence = CONTROL_ID_SEQUENCE
+        self.prefix = ""
+
+
+    def reserve(self, count: int) -> tuple[str, int]:
+        """Reserves ``count`` sequence numbers within one second; returns the prefix and first number."""
+        with self.lock:
+            now = int(time.time())
+            if now > self.second:
+                self.second = now
+                self.sequence = 0
+                self.prefix = to_base36(now - CONTROL_ID_EPOCH, 6) + self.worker
+            elif self.sequence + count > CONTROL_ID_SEQUENCE:
+                # Sequence used up within this second; borrow the next one
+                self.second += 1
+                self.sequence = 0
+                self.prefix = to_base36(self.second - CONTROL_ID_EPOCH, 6) + self.worker
+            start = self.sequence
+            self.sequence += count
+            return self.prefix, start
+
+
+    def next(self) -> str:
+        prefix, sequence = self.reserve(1)
+        return prefix + format_sequence(sequence)
+
+
+    def take(self, count: int) -> list[str]:
+        """Returns ``count`` control ids in one call."""
+        if count > CONTROL_ID_SEQUENCE:
+            return self.take(CONTROL_ID_SEQUENCE) + self.take(count - CONTROL_ID_SEQUENCE)
+        prefix, start = self.reserve(count)
+        return [prefix + format_sequence(sequence) for sequence in range(start, start + count)]
+
+
+control_ids = ControlIdGenerator()
+
+# A forked child shares the parent's sequence, so it must take its own worker id
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=control_ids.reset)
+
+
+def use_identifier_store(folder) -> IdentifierStore:
+    """Records the identifiers handed out by every identifier space in ``folder``'s ``IdentifierStore``, so 
+    none of them is handed out again by a later run into the same folder. Returns the store."""
+    folder = Path(folder)
+    os.makedirs(folder, exist_ok=True)
+    current = placer_order_numbers.store
+    if current is not None and current.path == folder / IDENTIFIER_STORE_NAME:
+        return current
+    store = IdentifierStore(folder / IDENTIFIER_STORE_NAME)
+    for space in IDENTIFIER_SPACES:
+        space.use_store(store)
+    if current is not None:
+        current.close()
+    return store
+
+
+def reset_identifiers() -> None:
+    """Starts a new run for every identifier space, e.g. before writing to a new output folder."""
+    for space in IDENTIFIER_SPACES:
+        space.reset()
@@ -0,0 +1,123 @@
+# ledger.py
+import hashlib
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from pathlib import Path
+from .utilities import work_folder_path
+
+# Default location of the processing ledger
+ledger_path = work_folder_path / "ledger.sqlite"
+
+
+def hash_file(file, chunk_size=1024 * 1024) -> str:
+    """Returns the sha256 hex digest of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(file, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ProcessingLedger:
+    """A local SQLite ledger of the fhir files in the Work folder that have already been processed.
+
+    Each row is keyed by file path and message type, and records the file's size, mtime and
+    content hash along with the outputs produced for it (the HL7 file and the patient id uploaded
+    to Firestore). A file is skipped on later runs while its size and mtime are unchanged, or
+    while its content hash still matches after a touch.
+
+    The ledger may be used from several threads, e.g. by ``Pool.imap``'s task handler while the main
+    thread records uploads, so the connection is shared and every use of it is serialised by a lock.
+
+    Args:
+    - path: ``Path``, location of the SQLite database, defaults to ``Work/ledger.sqlite``
+    """
+    def __init__(self, path=ledger_path):
+        self.path = Path(path)
+        os.makedirs(self.path.parent, exist_ok=True)
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS processed (
+                path TEXT NOT NULL,
+                message_type TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                sha256 TEXT NOT NULL,
+                patient_id TEXT,
+                hl7_path TEXT,
+                processed_at TEXT NOT NULL,
+                PRIMARY KEY (path, message_type)
+            )"""
+        )
+        self.connection.commit()
+
+
+    def is_processed(self, file, message_type: str) -> bool:
+        """Returns True if ``file`` has already been processed for ``message_type`` and is unchanged.
+        """
+        with self.lock:
+            return self.check_processed(file, message_type)
+
+
+    def check_processed(self, file, message_type: str) -> bool:
+        row = self.connection.execute(
+            "SELECT size, mtime_ns, sha256, hl7_path FROM processed WHERE path = ? AND message_type = ?",
+            (str(file), message_type),
+        ).fetchone()
+        if row is None:
+            return False
+
+        size, mtime_ns, sha256, hl7_path = row
+
+        # Reprocess if the HL7 output has since been removed
+        if hl7_path and not os.path.exists(hl7_path):
+            return False
+
+        stat = os.stat(file)
+        if stat.st_size != size:
+            return False
+        if stat.st_mtime_ns == mtime_ns:
+            return True
+
+        # Same size but touched; only the content hash can tell
+        if hash_file(file) != sha256:
+            return False
+
+        self.connection.execute(
+            "UPDATE processed SET mtime_ns = ? WHERE path = ? AND message_type = ?",
+            (stat.st_mtime_ns, str(file), message_type),
+        )
+        self.connection.commit()
+        return True
+
+
+    def record(self, file, message_type: str, patient_id: str | None, hl7_path=None) -> None:
+        """Records that ``file`` was processed for ``message_type`` and which outputs it produced.
+        """
+        stat = os.stat(file)
+        sha256 = hash_file(file)
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO processed VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (str(file), message_type, stat.st_size, stat.st_mtime_ns, sha256, patient_id,
+                 str(hl7_path) if hl7_path else None, datetime.now().isoformat()),
+            )
+            self.connection.commit()
+
+
+    def forget(self, file) -> None:
+        """Removes every record of ``file`` so that it is processed again on the next run.
+        """
+        with self.lock:
+            self.connection.execute("DELETE FROM processed WHERE path = ?", (str(file),))
+            self.connection.commit()
+
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,197 @@
+# paging.py
+import logging
+import queue
+import threading
+import time
+from datetime import date, timedelta
+from typing import Iterator
+from google.api_core import exceptions
+from google.cloud.firestore_v1.field_path import FieldPath
+
+# Errors after which a page is read again from the same cursor
+TRANSIENT_ERRORS = (
+    exceptions.ServiceUnavailable,
+    exceptions.DeadlineExceeded,
+    exceptions.InternalServerError,
+    exceptions.Aborted,
+    exceptions.ResourceExhausted,
+)
+
+
+class ReadBudget:
+    """The number of documents several readers may read between them, handed out a page at a time.
+
+    A reader takes up to a page of the budget before each read and settles it afterwards, giving
+    back what its page came up short. A reader finding the budget used up waits while pages are
+    still being read, in case some of it is given back.
+
+    Args:
+    - limit: ``int``
+    """
+    def __init__(self, limit: int):
+        self.remaining = limit
+        self.reserved = 0
+        self.changed = threading.Condition()
+
+
+    def take(self, count: int, stop: threading.Event = None) -> int:
+        """Reserves up to ``count`` documents; returns how many, 0 once nothing is left to read."""
+        with self.changed:
+            while not self.remaining and self.reserved and not (stop and stop.is_set()):
+                self.changed.wait(0.1)
+            granted = min(count, self.remaining)
+            self.remaining -= granted
+            self.reserved += granted
+            return granted
+
+
+    def settle(self, granted: int, read: int) -> None:
+        """Gives back the part of a reservation of ``granted`` documents which was not read."""
+        with self.changed:
+            self.remaining += granted - read
+            self.reserved -= granted
+            self.changed.notify_all()
+
+
+def iter_query_pages(query, field: str, limit: int, page_size: int = 500, max_attempts: int = 5,
+                     stop: threading.Event = None, start_after=None, budget: ReadBudget = None) -> Iterator:
+    """Yields up to ``limit`` documents of a query, read one page at a time with ``start_after`` cursors.
+
+    The query is ordered by ``field``, the field of its range filter, and then by document id, so
+    every page starts exactly after the last document of the page before. A page which fails with a
+    transient error is read again from the same cursor, so a dropped read never starts over.
+
+    Args:
+    - query: ``Query``, a firestore query with a range filter on ``field``
+    - field: ``str``
+    - limit: ``int``, most documents to yield
+    - page_size: ``int``, documents read per request
+    - max_attempts: ``int``, attempts per page before the error is raised
+    - stop: ``threading.Event``, stops reading after the current page once set
+    - start_after: ``dict``, a cursor to resume from, ``{field: value, "__name__": document_id}``
+    - budget: ``ReadBudget``, shared with other readers, which every page is also taken from
+
+    Returns:
+    - ``Iterator[DocumentSnapshot]``
+    """
+    query = query.order_by(field).order_by(FieldPath.document_id())
+    cursor = start_after
+    remaining = limit
+
+    while remaining > 0 and not (stop and stop.is_set()):
+        wanted = min(page_size, remaining)
+        if budget is not None:
+            wanted = budget.take(wanted, stop)
+            if not wanted:
+                return
+        page_query = query.limit(wanted)
+        if cursor is not None:
+            page_query = page_query.start_after(cursor)
+
+        docs = []
+        try:
+            for attempt in range(1, max_attempts + 1):
+                try:
+                    docs = list(page_query.stream())
+                    break
+                except TRANSIENT_ERRORS as e:
+                    if attempt == max_attempts:
+                        raise
+                    logging.warning(f"Reading a page of {field} failed ({type(e).__name__}: {e}), retrying from the last cursor")
+                    time.sleep(min(2 ** attempt * 0.1, 10))
+        finally:
+            if budget is not None:
+                budget.settle(wanted, len(docs))
+
+        yield from docs
+
+        if len(docs) < wanted:
+            return
+        cursor = docs[-1]
+        remaining -= len(docs)
+
+
+def split_range(low, high, parts: int) -> list[tuple]:
+    """Splits the inclusive range ``[low, high]`` into up to ``parts`` inclusive ranges which do not overlap.
+
+    Args:
+    - low, high: ``int``, or ``str`` ISO dates
+    - parts: ``int``
+
+    Returns:
+    - ``list[tuple]``, ``(low, high)`` pairs of the same type as ``low``
+    """
+    if isinstance(low, str):
+        first, last = date.fromisoformat(low), date.fromisoformat(high)
+        days = split_range(0, (last - first).days, parts)
+        return [((first + timedelta(days=a)).isoformat(), (first + timedelta(days=b)).isoformat()) for a, b in days]
+
+    parts = max(1, min(parts, high - low + 1))
+    size, extra = divmod(high - low + 1, parts)
+    ranges = []
+    for i in range(parts):
+        end = low + size + (1 if i < extra else 0) - 1
+        ranges.append((low, end))
+        low = end + 1
+    return ranges
+
+
+def iter_parallel_pages(queries: list, field: str, limit: int, page_size: int = 500) -> Iterator:
+    """Yields up to ``limit`` documents read from several queries at once, one thread per query.
+
+    Each thread pages through its query with ``iter_query_pages``, taking every page from one shared
+    ``ReadBudget`` of ``limit`` documents, so no more than ``limit`` documents are read between them.
+    Documents are handed over through a bounded queue, so at most a few pages are held in memory.
+    Documents come in the order they are read, not in query order.
+
+    Args:
+    - queries: ``list[Query]``, queries over ranges of ``field`` which do not overlap
+    - field: ``str``
+    - limit: ``int``
+    - page_size: ``int``
+
+    Returns:
+    - ``Iterator[DocumentSnapshot]``
+    """
+    docs = queue.Queue(maxsize=len(queries) * page_size)
+    stop = threading.Event()
+    budget = ReadBudget(limit)
+    done = object()
+
+    def hand_over(item) -> bool:
+        # Waits for room on the queue, giving up once the reader is told to stop
+        while not stop.is_set():
+            try:
+                docs.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read(query):
+        try:
+            for doc in iter_query_pages(query, field, limit, page_size, stop=stop, budget=budget):
+                if not hand_over(doc):
+                    return
+            hand_over(done)
+        except Exception as e:
+            hand_over(e)
+
+    readers = [threading.Thread(target=read, args=(query,), daemon=True) for query in queries]
+    for reader in readers:
+        reader.start()
+
+    running = len(readers)
+    yielded = 0
+    try:
+        while running and yielded < limit:
+            doc = docs.get()
+            if doc is done:
+                running -= 1
+            elif isinstance(doc, Exception):
+                raise doc
+            else:
+                yielded += 1
+                yield doc
+    finally:
+        stop.set()
@@ -0,0 +1,183 @@
+# patient_cache.py
+import os
+import pickle
+import sqlite3
+import time
+from pathlib import Path
+from .paging import iter_query_pages
+from .utilities import work_folder_path
+
+# Default location of the patient cache
+patient_cache_path = work_folder_path / "patients.sqlite"
+
+# Fields the cache can answer range queries on, as used by age_range_bounds
+CACHED_FIELDS = ("age", "birth_date")
+
+# Server timestamp written with every patient, which sync pages through
+SYNC_FIELD = "created_at"
+
+
+class PatientCache:
+    """A local SQLite read-through cache of the patient documents in Firestore's ``full_fhir`` collection.
+
+    Each row holds a patient's Firestore document, pickled so every value comes back with the type
+    Firestore gave it, alongside its age, birth date and creation date for range queries. ``sync``
+    reads only the documents written since the last one it read, and ``store`` adds documents read
+    from Firestore some other way. Once the cached documents take up
+    more than ``max_bytes``, the least recently used are evicted.
+
+    Args:
+    - path: ``Path``, location of the SQLite database, defaults to ``Work/patients.sqlite``
+    - max_bytes: ``int``, size of the cached documents before the least recently used are evicted
+    - sync_interval: ``float``, seconds after a sync during which ``sync`` reads nothing
+    """
+    def __init__(self, path=patient_cache_path, max_bytes=512 * 1024 * 1024, sync_interval=60):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.sync_interval = sync_interval
+        os.makedirs(self.path.parent, exist_ok=True)
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS patients (
+                id TEXT PRIMARY KEY,
+                age INTEGER,
+                birth_date TEXT,
+                creation_date TEXT,
+                data BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            )"""
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS patients_age ON patients (age, id)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS patients_birth_date ON patients (birth_date, id)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS patients_last_used ON patients (last_used)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.connection.commit()
+        self.total_bytes = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM patients").fetchone()[0]
+
+
+    def get_meta(self, key: str):
+        row = self.connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+
+    def set_meta(self, key: str, value) -> None:
+        self.connection.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, str(value)))
+
+
+    def store(self, documents) -> int:
+        """Adds or replaces Firestore documents, given as dicts, and returns how many were stored."""
+        now = time.time()
+        rows = []
+        for data in documents:
+            blob = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+            creation_date = data.get("creation_date")
+            rows.append((data["id"], data.get("age"), str(data.get("birth_date")),
+                         str(creation_date) if creation_date else None, blob, len(blob), now))
+        if not rows:
+            return 0
+
+        self.connection.executemany("INSERT OR REPLACE INTO patients VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        self.total_bytes = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM patients").fetchone()[0]
+        self.evict()
+        self.connection.commit()
+        return len(rows)
+
+
+    def sync(self, db, page_size: int = 500, force: bool = False) -> int:
+        """Reads the documents written to Firestore since the last one this cache synced.
+
+        Documents are paged through in ``created_at`` order, the server time of their write, then by
+        document id. The cursor is the ``created_at`` and id of the last document read, kept with its
+        Firestore type, so the next sync starts exactly after it and reads nothing twice. Documents
+        with no ``created_at``, uploaded before it was written, are never synced; they are cached
+        when read through ``store``. Does nothing if the last sync was less than ``sync_interval``
+        seconds ago, unless ``force`` is set.
+
+        Returns the number of documents read.
+        """
+        last_sync = self.get_meta("last_sync")
+        if not force and last_sync and time.time() - float(last_sync) < self.sync_interval:
+            return 0
+
+        cursor = self.get_meta("cursor")
+        cursor = pickle.loads(bytes.fromhex(cursor)) if cursor else None
+
+        read = 0
+        batch = []
+        last = None
+        for doc in iter_query_pages(db.collection("full_fhir"), SYNC_FIELD, float("inf"), page_size, start_after=cursor):
+            batch.append(doc.to_dict())
+            last = doc
+            if len(batch) >= page_size:
+                read += self.store(batch)
+                self.set_cursor(batch[-1], last.id)
+                batch = []
+        if batch:
+            read += self.store(batch)
+            self.set_cursor(batch[-1], last.id)
+        self.set_meta("last_sync", time.time())
+        self.connection.commit()
+        return read
+
+
+    def set_cursor(self, data: dict, document_id: str) -> None:
+        cursor = {SYNC_FIELD: data[SYNC_FIELD], "__name__": document_id}
+        self.set_meta("cursor", pickle.dumps(cursor).hex())
+
+
+    def count(self, field: str, low, high) -> int:
+        """Counts the cached patients whose ``field`` lies between ``low`` and ``high``, inclusive."""
+        if field not in CACHED_FIELDS:
+            raise ValueError(f"The patient cache cannot query {field}")
+        return self.connection.execute(
+            f"SELECT COUNT(*) FROM patients WHERE {field} BETWEEN ? AND ?", (low, high)
+        ).fetchone()[0]
+
+
+    def query(self, field: str, low, high, limit: int) -> list[dict]:
+        """Returns up to ``limit`` cached documents whose ``field`` lies between ``low`` and ``high``,
+        inclusive, in the order Firestore would return them, and marks them as recently used."""
+        if field not in CACHED_FIELDS:
+            raise ValueError(f"The patient cache cannot query {field}")
+        rows = self.connection.execute(
+            f"SELECT id, data FROM patients WHERE {field} BETWEEN ? AND ? ORDER BY {field}, id LIMIT ?",
+            (low, high, limit),
+        ).fetchall()
+        now = time.time()
+        self.connection.executemany("UPDATE patients SET last_used = ? WHERE id = ?", [(now, row[0]) for row in rows])
+        self.connection.commit()
+        return [pickle.loads(row[1]) for row in rows]
+
+
+    def evict(self) -> int:
+        """Removes the least recently used documents until the cache is back under 90% of ``max_bytes``.
+
+        Returns the number of documents removed.
+        """
+        if self.total_bytes <= self.max_bytes:
+            return 0
+
+        target = self.max_bytes * 0.9
+        evicted = []
+        for patient_id, size in self.connection.execute("SELECT id, size FROM patients ORDER BY last_used, id"):
+            if self.total_bytes <= target:
+                break
+            evicted.append((patient_id,))
+            self.total_bytes -= size
+        self.connection.executemany("DELETE FROM patients WHERE id = ?", evicted)
+        return len(evicted)
+
+
+    def clear(self) -> None:
+        """Removes every cached document, so the next sync reads the whole collection again."""
+        self.connection.execute("DELETE FROM patients")
+        self.connection.execute("DELETE FROM meta")
+        self.connection.commit()
+        self.total_bytes = 0
+
+
+    def close(self) -> None:
+        self.connection.close()
@@ -1,21 +1,40 @@
 # utilities.py
 import logging
+import os
+import sys
 from pathlib import Path
 import random, string, datetime
 from datetime import date, datetime
 import datetime
 import time
+import itertools
+import threading
+import json
+from decimal import Decimal
+from typing import Iterator
 from fhir.resources.R4B.bundle import Bundle
 from fhir.resources.R4B.patient import Patient
 from fhir.resources.R4B.condition import Condition
 from fhir.resources.R4B.observation import Observation
 from firebase_admin import firestore
+from google.api_core import exceptions
 from google.cloud.firestore_v1 import document
 from google.cloud.firestore_v1.base_query import FieldFilter
 from google.cloud.firestore_v1 import aggregation
 from ..poll_synthea import call_for_patients
+from .addresses import get_address_pool
+from .paging import iter_parallel_pages, iter_query_pages, split_range
+from .histogram import increment_age_histogram
+from .identifiers import placer_order_numbers, filler_order_numbers, visit_institutions, visit_numbers, \
+    control_ids, current_partition, to_base36
 from hl7apy.parser import parse_message
-import requests
+
+# orjson is optional; it decodes FHIR bundles several times faster than the json module
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
 
 BASE_DIR = Path.cwd()
 work_folder_path = BASE_DIR / "Work"
@@ -31,47 +50,30 @@ def create_obr_time():
     return random_date.strftime("%Y%m%d%H%M")
 
 
-# generate a random placer order number for the HL7 message
+# generate a random placer order number for the HL7 message, unique within the run
 def create_placer_order_num():
-    order_id = "".join(
-        ["{}".format(random.randint(0, 9)) for _ in range(0, 3)]
-    ) + "".join(
-        ["{}".format(random.choice(string.ascii_uppercase)) for _ in range(0, 2)]
-    )
-    return order_id
+    return placer_order_numbers.next()
 
 
-# generate a random filler order number for the HL7 message
+# generate a random filler order number for the HL7 message, unique within the run
 def create_filler_order_num():
-    # allocate a random number between 1 and 999999999
-    random_number = random.randint(1, 999999999)
-    # format the random number as 1^^23^4
-    filler_order_id = f"1^^{random_number // 10000}^{random_number % 10000}"
-    return filler_order_id
+    # formatted as 1^^23^4 from a number between 1 and 999999999
+    return filler_order_numbers.next()
 
 
-# Creates a random visit institution for the HL7 message
+# Creates a random visit institution for the HL7 message, unique within the run
 def create_visit_instiution():
-    visit_institution = "".join(
-        ["{}".format(random.randint(0, 9)) for _ in range(0, 3)]
-    ) + "".join(
-        ["{}".format(random.choice(string.ascii_uppercase)) for _ in range(0, 2)]
-    )
-    return visit_institution
+    return visit_institutions.next()
 
 
-# Creates a random visit number for the HL7 message
+# Creates a random six digit visit number for the HL7 message, unique within the run
 def create_visit_number():
-    visit_number = "".join(["{}".format(random.randint(0, 9)) for _ in range(0, 3)])
-    return visit_number
+    return visit_numbers.next()
 
 
-# Creates a random control ID for the HL7 message
+# Creates a control ID for the HL7 message, unique across processes
 def create_control_id():
-    current_date_time = datetime.datetime.now()
-    formatted_date_minutes_milliseconds = current_date_time.strftime("%Y%m%d%H%M%S.%f")
-    control_id = formatted_date_minutes_milliseconds.replace(".", "")
-    return control_id
+    return control_ids.next()
 
   
 # Increments patient hl7v2_id by one  
@@ -100,46 +102,149 @@ def increment_patient_id(s):
     return ''.join(s)
 
 
-# Creates a random patient ID for the patient 
-def create_patient_id(db: firestore.client):
-    """Generates an hl7v2_id for a new patient, given the highest id currently 
-    in the database. 
+# Returns the next count ids after s, counting in base 36 (0-9 then A-Z) as increment_patient_id does
+def increment_patient_ids(s, count):
+    """Produces the next ``count`` base-36 ids after ``s`` at once. 
 
     Args: 
-    - db: ``firestore.client``, the client for interfacing with the firestore database
+    - s: ``str``, the current id, e.g. ``"0000Z"``
+    - count: ``int``, the number of ids to produce
 
     Returns: 
-    - patient_id: ``String``, the fully-formed patient hl7v2_id. 
-    
-    To do: 
-    - Catch edge cases such as no ID being returned by query
+    - ids: ``list[str]``, e.g. ``["00010", "00011", ...]``, zero padded to the width of ``s``
     """
-    synthea_code = "SYN"
+    value = int(s, 36)
+    return [to_base36(value + i, len(s)) for i in range(1, count + 1)]
 
-    # Pull largest id from firebase
+
+# Formats the numeric part of an hl7v2_id as a full patient id, e.g. 8 -> SYN00008^^^PAS^MR
+def format_patient_id(number):
+    return f"SYN{to_base36(number)}^^^PAS^MR"
+
+
+# Reads the numeric part of an hl7v2_id, e.g. SYN00008^^^PAS^MR -> 8
+def parse_patient_id_number(patient_id):
+    return int(patient_id[3:].split("^")[0], 36)
+
+
+def find_greatest_patient_id_number(db: firestore.client) -> int:
+    """Returns the numeric part of the highest hl7v2_id in the database, or 0 if there is none."""
     db_ref = db.collection("full_fhir")
     query = (
         db_ref.order_by("hl7v2_id", direction=firestore.Query.DESCENDING).limit(1)
     )
 
-    results = query.stream()
-    for result in results:
-        greatest_id = result._data["hl7v2_id"]
-        break
+    for result in query.stream():
+        return parse_patient_id_number(result._data["hl7v2_id"])
 
-    greatest_id = greatest_id[3 : 9]
+    return 0
 
-    # Increment previous patient id to new value
-    new_id = increment_patient_id(greatest_id)
 
-    # Generate new hl7v2_id in full
-    patient_id = f"{synthea_code + new_id}^^^PAS^MR"
+class PatientIdAllocator:
+    """Hands out unique hl7v2_ids from blocks reserved in a Firestore counter document. 
 
-    # Return new hl7v2_id 
-    return patient_id
+    Each block is reserved with one transaction on ``counters/hl7v2_id``, so ids stay unique 
+    across threads and processes, and every id within a block is served locally. Ids left 
+    unused in a block when the process ends are simply skipped. 
+
+    Args: 
+    - db: ``firestore.client``, the client for interfacing with the firestore database
+    - block_size: ``int``, number of ids reserved per transaction
+    """
+    def __init__(self, db: firestore.client, block_size: int = 2000):
+        self.db = db
+        self.block_size = block_size
+        self.counter_ref = db.collection("counters").document("hl7v2_id")
+        self.next_number = 0
+        self.end_number = 0
+        self.lock = threading.Lock()
+
+
+    def reserve_block(self, size: int) -> None:
+        # Only needed the first time, when the counter document does not exist yet
+        seed = None
+        if not self.counter_ref.get().exists:
+            seed = find_greatest_patient_id_number(self.db) + 1
+
+        @firestore.transactional
+        def reserve(transaction):
+            snapshot = self.counter_ref.get(transaction=transaction)
+            start = snapshot.get("next") if snapshot.exists else seed
+            transaction.set(self.counter_ref, {"next": start + size})
+            return start
+
+        self.next_number = reserve(self.db.transaction())
+        self.end_number = self.next_number + size
+
+
+    def next_ids(self, count: int) -> list[str]:
+        """Returns ``count`` new hl7v2_ids, reserving more blocks as needed."""
+        ids = []
+        with self.lock:
+            while len(ids) < count:
+                if self.next_number >= self.end_number:
+                    self.reserve_block(max(self.block_size, count - len(ids)))
+                take = min(count - len(ids), self.end_number - self.next_number)
+                ids.extend(format_patient_id(number) for number in range(self.next_number, self.next_number + take))
+                self.next_number += take
+        return ids
+
+
+    def next_id(self) -> str:
+        return self.next_ids(1)[0]
+
+
+class LocalPatientIdAllocator:
+    """Hands out hl7v2_ids without Firestore, for runs which do not upload patients. 
+
+    Each process numbers its ids within its share of the identifier spaces, so the workers of one 
+    run never hand out the same id. The ids are not checked against Firestore. 
+    """
+    db = None
+
+    def __init__(self):
+        self.numbers = itertools.count(1)
+        self.lock = threading.Lock()
+
+
+    def next_id(self) -> str:
+        index, count = current_partition()
+        with self.lock:
+            return format_patient_id(next(self.numbers) * count + index)
+
+
+# One allocator per firestore client, so that blocks are shared within the process
+patient_id_allocators: dict[int, PatientIdAllocator] = {}
+
+
+def get_patient_id_allocator(db: firestore.client) -> PatientIdAllocator:
+    allocator = patient_id_allocators.get(id(db))
+    if allocator is None or allocator.db is not db:
+        allocator = patient_id_allocators[id(db)] = LocalPatientIdAllocator() if db is None else PatientIdAllocator(db)
+    return allocator
+
+
+# Creates a random patient ID for the patient 
+def create_patient_id(db: firestore.client):
+    """Generates an hl7v2_id for a new patient from the process's ``PatientIdAllocator``. 
+
+    Args: 
+    - db: ``firestore.client``, the client for interfacing with the firestore database, or ``None`` 
+    when patients are not uploaded, to use a ``LocalPatientIdAllocator``
+
+    Returns: 
+    - patient_id: ``String``, the fully-formed patient hl7v2_id. 
+    """
+    return get_patient_id_allocator(db).next_id()
 
 
 # PatientInfo class to store patient information from a Bundled FHIR message
+def intern_text(value):
+    """Returns the interned copy of a string, so a value repeated across patients, such as an observation 
+    status or category, is held in memory once. Other values are returned unchanged."""
+    return sys.intern(value) if type(value) is str else value
+
+
 class PatientInfo:
     """A class which holds all patient information. 
 
@@ -163,6 +268,12 @@ class PatientInfo:
     - conditions: ``list[PatientCondition]``
     - observations: ``list[PatientObservation]``
     """
+    # Fields copied by to_dict and from_dict, besides the conditions and observations
+    FIELDS = ("id", "hl7v2_id", "birth_date", "gender", "ssn", "first_name", "middle_name", "last_name", "address",
+              "address_2", "city", "country", "post_code", "country_code", "age", "creation_date")
+    # Slots instead of a per-instance __dict__, as populations of patients are held in memory
+    __slots__ = FIELDS + ("conditions", "observations")
+
     def __init__(
         self,
         id,
@@ -191,23 +302,42 @@ class PatientInfo:
             self.hl7v2_id: list[str] = []
 
         self.birth_date = birth_date
-        self.gender = gender
+        self.gender = intern_text(gender)
         self.ssn = ssn
         self.first_name = first_name
         self.middle_name = middle_name
         self.last_name = last_name
         self.address = address
         self.address_2 = address_2
-        self.city = city
-        self.country = country
+        self.city = intern_text(city)
+        self.country = intern_text(country)
         self.post_code = post_code
-        self.country_code = country_code
+        self.country_code = intern_text(country_code)
         self.age = age
         self.creation_date = creation_date
         self.conditions: list[PatientCondition] = []
         self.observations: list[PatientObservation] = []
 
 
+    def to_dict(self) -> dict:
+        """Returns the patient as a dict of its attributes, with conditions and observations as lists of dicts."""
+        data = {name: getattr(self, name) for name in self.FIELDS}
+        data["conditions"] = [condition.to_dict() for condition in self.conditions]
+        data["observations"] = [observation.to_dict() for observation in self.observations]
+        return data
+
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "PatientInfo":
+        """Builds a patient from a dict made by ``to_dict``; conditions and observations are optional."""
+        patient_info = cls(**{name: data.get(name) for name in cls.FIELDS})
+        patient_info.conditions = [PatientCondition.from_dict(condition) for condition in data.get("conditions") or []]
+        patient_info.observations = [PatientObservation.from_dict(observation)
+                                     for observation in data.get("observations") or []]
+        return patient_info
+
+
+
     def __repr__(self):  
         return ("PatientInfo id:% s hl7v2_id:% s birth_date:% s gender:% s ssn:% s first_name:% s middle_name:% s last_name:% s "
                 "address:% s address_2:% s city:% s country:% s post_code:% s country_code:% s age:% s creation_date:% s"
@@ -240,6 +370,10 @@ class PatientCondition:
     - subject_reference: ``String``
     - snomed_code: ``String``
     """
+    FIELDS = ("condition", "clinical_status", "verification_status", "onset_date_time", "recorded_date",
+              "abatement_time", "encounter_reference", "subject_reference", "snomed_code")
+    __slots__ = FIELDS
+
     def __init__(
         self,
         condition, 
@@ -252,15 +386,26 @@ class PatientCondition:
         subject_reference, 
         snomed_code
     ):
-        self.condition = condition 
-        self.clinical_status = clinical_status
-        self.verification_status = verification_status
+        self.condition = intern_text(condition)
+        self.clinical_status = intern_text(clinical_status)
+        self.verification_status = intern_text(verification_status)
         self.onset_date_time = onset_date_time
         self.recorded_date = recorded_date
         self.abatement_time = abatement_time
         self.encounter_reference = encounter_reference
         self.subject_reference = subject_reference
-        self.snomed_code = snomed_code
+        self.snomed_code = intern_text(snomed_code)
+
+
+    def to_dict(self) -> dict:
+        """Returns the condition as a dict of its attributes, as stored in Firestore."""
+        return {name: getattr(self, name) for name in self.FIELDS}
+
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "PatientCondition":
+        return cls(**{name: data[name] for name in cls.FIELDS})
+
 
     def __repr__(self):  
         return ("PatientCondition condition:% s clinical_status:% s verification_status:% s onset_date_time:% s "
@@ -293,6 +438,10 @@ class PatientObservation:
     - component: ``list[dict] | None``
     
     """
+    FIELDS = ("category", "observation", "status", "effective_date_time", "issued", "value_quantity",
+              "value_codeable_concept", "encounter_reference", "subject_reference", "component")
+    __slots__ = FIELDS
+
     def __init__(
         self,
         category, 
@@ -306,16 +455,31 @@ class PatientObservation:
         subject_reference,
         component,
     ):
-        self.category = category
-        self.observation = observation
-        self.status = status
+        self.category = intern_text(category)
+        self.observation = intern_text(observation)
+        self.status = intern_text(status)
         self.effective_date_time = effective_date_time
         self.issued = issued
         self.value_quantity = value_quantity
-        self.value_codeable_concept = value_codeable_concept
+        self.value_codeable_concept = intern_text(value_codeable_concept)
         self.encounter_reference = encounter_reference
         self.subject_reference = subject_reference
+        # Copied rather than changed in place, as the dicts may belong to the caller, e.g. a cached document
         self.component = component
+        if component is not None:
+            self.component = [dict(component_dict, code_text=intern_text(component_dict.get("code_text")))
+                              for component_dict in component]
+
+
+    def to_dict(self) -> dict:
+        """Returns the observation as a dict of its attributes, as stored in Firestore."""
+        return {name: getattr(self, name) for name in self.FIELDS}
+
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "PatientObservation":
+        return cls(**{name: data[name] for name in cls.FIELDS})
+
 
     def __repr__(self):  
         return ("PatientObservation category:% s observation:% s status:% s effective_date_time:% s "
@@ -346,15 +510,15 @@ def calculate_age(birth_date):
     return age
 
 
-# Get random address from mockeroo API 
+# Get random address from the local pool of mockeroo addresses
 def request_random_address():
-    """Requests a random address from a mockeroo API.
+    """Returns a random address from the shared ``AddressPool``.
 
-    Will require error checks to ensure address is reachable and the API responds as expected. 
+    Addresses are fetched from the mockeroo API in bulk and kept in ``addresses.json``, so this
+    does not make a network call per patient. Without network access the pool generates
+    addresses offline instead.
     """
-    response = requests.get("https://my.api.mockaroo.com/address.json?key=d995a340")
-
-    return response.json()
+    return get_address_pool().get()
 
 
 # TODO update the dobs after the sample patients are created - 
@@ -363,7 +527,20 @@ def request_random_address():
 
 
 # Parses a FHIR JSON message and returns a PatientInfo object
-def parse_fhir_message(db: firestore.client, fhir_message, require_address=True):
+def parse_fhir_message(db: firestore.client, fhir_message, require_address=True, validate=False):
+    """Parses a Synthea FHIR bundle into a ``PatientInfo`` object. 
+
+    By default the bundle is decoded with ``extract_fhir_message``, which only looks at the 
+    Patient, Condition and Observation resources. Set ``validate`` to build and validate the 
+    whole bundle with fhir.resources instead. 
+    """
+    if validate:
+        return parse_validated_fhir_message(db, fhir_message, require_address)
+    return extract_fhir_message(db, fhir_message, require_address)
+
+
+# Parses a FHIR JSON message through fhir.resources and returns a PatientInfo object
+def parse_validated_fhir_message(db: firestore.client, fhir_message, require_address=True):
     # Parse the FHIR JSON message into a Bundle
     bundle = Bundle.parse_raw(fhir_message)
 
@@ -558,6 +735,333 @@ def parse_fhir_observations(resource: Observation, patient_info: PatientInfo) ->
     return patient_info
 
 
+def parse_fhir_date_time(value):
+    """Turns a FHIR dateTime/instant string into a ``datetime``, as fhir.resources does. 
+
+    Date-only values such as ``2015-02-03`` become a ``date`` and partial dates such as 
+    ``2015`` are returned unchanged. 
+    """
+    if value is None:
+        return None
+    try:
+        if "T" not in value:
+            return date.fromisoformat(value)
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        return value
+
+
+def format_fhir_decimal(value) -> str:
+    """Formats a decoded FHIR decimal the same way as ``str`` of the fhir.resources ``Decimal``."""
+    if isinstance(value, float):
+        return str(Decimal(repr(value)))
+    return str(value)
+
+
+def extract_fhir_message(db: firestore.client, fhir_message, require_address=True):
+    """Fast-path version of ``parse_validated_fhir_message``. 
+
+    Decodes the bundle as plain JSON and only reads the Patient, Condition and Observation 
+    resources, skipping the fhir.resources models for every other resource in the bundle. 
+
+    Args: 
+    - db: ``firestore.client``, the client for interfacing with the firestore database
+    - fhir_message: ``str | bytes``, the raw FHIR JSON bundle
+
+    Returns: 
+    - patient_info: ``PatientInfo | None``
+    """
+    bundle = json_loads(fhir_message)
+    entries = bundle.get("entry") or []
+
+    print("Bundle Type:", bundle.get("type"))
+    print("Entry Count:", len(entries))
+
+    patient_info = None
+    birth_date = None
+    for entry in entries:
+        resource = entry.get("resource") or {}
+        resource_type = resource.get("resourceType")
+
+        if resource_type == "Patient":
+            patient_info, birth_date = extract_fhir_patient(db, resource, birth_date, require_address)
+
+        elif resource_type == "Condition" and patient_info:
+            patient_info.conditions.append(extract_fhir_condition(resource))
+
+        elif resource_type == "Observation" and patient_info:
+            patient_info.observations.append(extract_fhir_observation(resource))
+
+    return patient_info
+
+
+def extract_fhir_patient(db: firestore.client, resource: dict, previous_birth_date, require_address=True):
+    """Builds a ``PatientInfo`` from a decoded Patient resource. 
+
+    The first patient's birth date is moved to the first day of its year; any further patient 
+    in the same bundle is born one day after the previous one. 
+
+    Returns: 
+    - ``(PatientInfo, birth_date)``
+    """
+    if previous_birth_date is None:
+        birth_date = date.fromisoformat(resource["birthDate"]).replace(month=1, day=1)
+    else:
+        birth_date = previous_birth_date + datetime.timedelta(days=1)
+    age = calculate_age(birth_date)
+
+    ssn = None
+    for identifier in resource.get("identifier", []):
+        if identifier.get("system") == "http://hl7.org/fhir/sid/us-ssn":
+            ssn = identifier.get("value")
+            break
+
+    name = resource["name"][0]
+    given = name.get("given", [])
+
+    # Handle missing middle name
+    middle_name = given[1] if len(given) > 1 else None
+
+    # Create patient id array
+    hl7v2_id = [create_patient_id(db=db)]
+
+    # Synthea addresses are replaced for both synthetic and UK patients for now
+    address_json = request_random_address()
+
+    patient_info = PatientInfo(
+        id=resource["id"],
+        birth_date=birth_date,
+        gender=resource.get("gender"),
+        ssn=ssn,
+        first_name=given[0],
+        middle_name=middle_name,
+        last_name=name.get("family"),
+        address=address_json["address"],
+        address_2=address_json["address_2"],
+        city=address_json["city"],
+        country=address_json["country"],
+        post_code=address_json["post_code"],
+        country_code=address_json["country_code"],
+        age=age,
+        creation_date=date.today(),
+        hl7v2_id=hl7v2_id
+    )
+    return patient_info, birth_date
+
+
+def extract_fhir_condition(resource: dict) -> PatientCondition:
+    """Builds a ``PatientCondition`` from a decoded Condition resource."""
+    clinical_status = resource["clinicalStatus"]["coding"][0]["code"]
+
+    # May not be present in condition record
+    abatement_date_time = None
+    if clinical_status == "resolved":
+        abatement_date_time = parse_fhir_date_time(resource.get("abatementDateTime"))
+
+    return PatientCondition(condition=resource["code"].get("text"), clinical_status=clinical_status,
+                            verification_status=resource["verificationStatus"]["coding"][0]["code"],
+                            onset_date_time=parse_fhir_date_time(resource.get("onsetDateTime")),
+                            recorded_date=parse_fhir_date_time(resource.get("recordedDate")),
+                            abatement_time=abatement_date_time,
+                            encounter_reference=str((resource.get("encounter") or {}).get("reference")),
+                            subject_reference=str((resource.get("subject") or {}).get("reference")),
+                            snomed_code=resource["code"]["coding"][0]["code"])
+
+
+def extract_fhir_result(resource: dict):
+    """Returns the valueQuantity, valueCodeableConcept and valueString of a decoded resource or 
+    component, formatted as in ``parse_fhir_observations``."""
+    value_quantity = None
+    if resource.get("valueQuantity"):
+        value_quantity = format_fhir_decimal(resource["valueQuantity"].get("value")) + resource["valueQuantity"]["unit"]
+
+    value_codeable_concept = None
+    if resource.get("valueCodeableConcept"):
+        value_codeable_concept = resource["valueCodeableConcept"].get("text")
+
+    return value_quantity, value_codeable_concept, resource.get("valueString")
+
+
+def extract_fhir_observation(resource: dict) -> PatientObservation:
+    """Builds a ``PatientObservation`` from a decoded Observation resource."""
+    value_quantity, value_codeable_concept, _ = extract_fhir_result(resource)
+
+    component_list = None
+    if resource.get("component"):
+        component_list = []
+        for component in resource["component"]:
+            component_quantity, component_concept, component_string = extract_fhir_result(component)
+
+            # Later values win, as in parse_fhir_observations
+            component_result = None
+            if component_quantity is not None:
+                component_result = component_quantity
+            if component.get("valueCodeableConcept"):
+                component_result = component_concept
+            if component_string:
+                component_result = component_string
+
+            component_list.append({"code_text": component["code"].get("text"), "result": component_result})
+
+    return PatientObservation(category=resource["category"][0]["coding"][0]["code"],
+                              observation=resource["code"].get("text"),
+                              status=resource.get("status"),
+                              effective_date_time=parse_fhir_date_time(resource.get("effectiveDateTime")),
+                              issued=parse_fhir_date_time(resource.get("issued")),
+                              value_quantity=value_quantity,
+                              value_codeable_concept=value_codeable_concept,
+                              encounter_reference=str((resource.get("encounter") or {}).get("reference")),
+                              subject_reference=str((resource.get("subject") or {}).get("reference")),
+                              component=component_list)
+
+
+class BundleEntryReader:
+    """Walks a FHIR bundle file one ``entry[]`` element at a time. 
+
+    Only the current entry and a small read buffer are held in memory, so the memory used 
+    does not grow with the size of the bundle. Top-level values other than ``entry`` (such as 
+    ``type``) are kept in ``bundle_fields``. 
+
+    Args: 
+    - f: a file opened in text mode
+    - chunk_size: ``int``, number of characters read at a time
+    """
+    decoder = json.JSONDecoder()
+
+    def __init__(self, f, chunk_size=64 * 1024):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self.bundle_fields = {}
+
+
+    def read_more(self, size=None) -> bool:
+        """Drops consumed text and appends the next chunk of the file to the buffer."""
+        if self.eof:
+            return False
+        chunk = self.f.read(size or self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+
+    def next_char(self) -> str:
+        """Skips whitespace and returns the next character without consuming it."""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.read_more():
+                raise ValueError("Unexpected end of FHIR bundle")
+
+
+    def expect(self, char: str) -> None:
+        if self.next_char() != char:
+            raise ValueError(f"Expected '{char}' in FHIR bundle at position {self.pos}")
+        self.pos += 1
+
+
+    def decode_value(self):
+        """Decodes the next complete JSON value, reading more of the file until it is complete."""
+        self.next_char()
+        read_size = self.chunk_size
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # A number at the very end of the buffer may continue in the next chunk
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            # Grow the reads so very large entries are not decoded again for every chunk
+            self.read_more(read_size)
+            read_size *= 2
+
+
+    def __iter__(self):
+        self.expect("{")
+        while self.next_char() != "}":
+            key = self.decode_value()
+            self.expect(":")
+
+            if key == "entry":
+                self.expect("[")
+                while self.next_char() != "]":
+                    yield self.decode_value()
+                    if self.next_char() == ",":
+                        self.pos += 1
+                self.pos += 1
+            else:
+                self.bundle_fields[key] = self.decode_value()
+
+            if self.next_char() == ",":
+                self.pos += 1
+
+
+def stream_fhir_file(db: firestore.client, file, require_address=True):
+    """Reads a FHIR bundle file one resource at a time and yields the ``PatientInfo``, then each 
+    ``PatientCondition`` and ``PatientObservation`` as soon as it is read. 
+
+    Memory use stays flat however large the bundle is, as long as the caller does not keep 
+    the records it is given. Conditions and observations found before the Patient resource 
+    are skipped, as in ``parse_fhir_message``. 
+    """
+    with open(file, "r", encoding="utf-8") as f:
+        reader = BundleEntryReader(f)
+
+        patient_info = None
+        birth_date = None
+        for entry in reader:
+            resource = entry.get("resource") or {}
+            resource_type = resource.get("resourceType")
+
+            if resource_type == "Patient":
+                patient_info, birth_date = extract_fhir_patient(db, resource, birth_date, require_address)
+                yield patient_info
+
+            elif resource_type == "Condition" and patient_info:
+                yield extract_fhir_condition(resource)
+
+            elif resource_type == "Observation" and patient_info:
+                yield extract_fhir_observation(resource)
+
+
+def parse_fhir_file(db: firestore.client, file, require_address=True, validate=False, stream_threshold=8 * 1024 * 1024):
+    """Parses a FHIR bundle file into a ``PatientInfo`` object. 
+
+    Files larger than ``stream_threshold`` bytes are read one resource at a time with 
+    ``stream_fhir_file``, so the file text and decoded JSON are never held in memory; smaller 
+    files are read at once and parsed with ``parse_fhir_message``. The returned patient still 
+    holds every condition and observation, so memory grows with their number. Callers that 
+    need flat memory should consume ``stream_fhir_file`` directly. 
+
+    Returns: 
+    - patient_info: ``PatientInfo | None``, the last patient in the bundle
+    """
+    if validate or os.path.getsize(file) <= stream_threshold:
+        with open(file, "rb") as f:
+            return parse_fhir_message(db, f.read(), require_address, validate)
+
+    patient_info = None
+    for record in stream_fhir_file(db, file, require_address):
+        if isinstance(record, PatientInfo):
+            patient_info = record
+        elif isinstance(record, PatientCondition):
+            patient_info.conditions.append(record)
+        else:
+            patient_info.observations.append(record)
+
+    return patient_info
+
+
 def firestore_doc_to_patient_info(db: firestore.client, doc: document) -> PatientInfo:
     """Transforms a document from Firestore into a ``PatientInfo`` object for 
     further use. 
@@ -569,78 +1073,62 @@ def firestore_doc_to_patient_info(db: firestore.client, doc: document) -> Patien
     - patient_info: ``PatientInfo``, a class which holds all patient information 
     within the Firestore document
     
+    """
+    return firestore_dict_to_patient_info(db=db, data=doc._data)
+
+
+def firestore_dict_to_patient_info(db: firestore.client, data: dict) -> PatientInfo:
+    """Transforms the fields of a Firestore document, e.g. one held by the ``PatientCache``, 
+    into a ``PatientInfo`` object. 
+
+    Args: 
+    - data: ``dict``, the fields of a patient document
+
+    Returns:
+    - patient_info: ``PatientInfo``
+    
     """
     # Handle middle name 
     middle_name = None
-    if ("middle_name" in doc._data): middle_name = doc._data["middle_name"] 
+    if ("middle_name" in data): middle_name = data["middle_name"] 
 
     # Handle creation date - if patient doesn't have one, then assign today's date
-    if ("creation_date" in doc._data): 
-        creation_date = doc._data["creation_date"]
+    if ("creation_date" in data): 
+        creation_date = data["creation_date"]
     else: 
         creation_date = date.today().isoformat()
 
     # Handle possible missing hl7v2_id 
-    if ("hl7v2_id" in doc._data):
-        hl7v2_id = doc._data["hl7v2_id"]
+    if ("hl7v2_id" in data):
+        hl7v2_id = data["hl7v2_id"]
     else:
         hl7v2_id = create_patient_id(db=db)
 
     # Create patient_info object for further use 
     patient_info = PatientInfo(
-        id=doc._data["id"],
+        id=data["id"],
         hl7v2_id=hl7v2_id,
-        birth_date=doc._data["birth_date"],
-        gender=doc._data["gender"],
-        ssn=doc._data["ssn"],
-        first_name=doc._data["first_name"],
+        birth_date=data["birth_date"],
+        gender=data["gender"],
+        ssn=data["ssn"],
+        first_name=data["first_name"],
         middle_name=middle_name,
-        last_name=doc._data["last_name"],
-        address=doc._data["address"],
-        address_2=doc._data["address_2"],
-        city=doc._data["city"],
-        country=doc._data["country"],
-        post_code=doc._data["post_code"],
-        country_code=doc._data["country_code"],
-        age=doc._data["age"],
+        last_name=data["last_name"],
+        address=data["address"],
+        address_2=data["address_2"],
+        city=data["city"],
+        country=data["country"],
+        post_code=data["post_code"],
+        country_code=data["country_code"],
+        age=data["age"],
         creation_date=creation_date,
     )
 
-    if ("conditions" in doc._data):
-        for condition in doc._data["conditions"]:
-            pat_condition=condition["condition"]
-            clinical_status=condition["clinical_status"]
-            verification_status=condition["verification_status"]
-            onset_date_time=condition["onset_date_time"]
-            recorded_date=condition["recorded_date"]
-            abatement_time=condition["abatement_time"]
-            encounter_reference=condition["encounter_reference"]
-            subject_reference=condition["subject_reference"]
-            snomed_code=condition["snomed_code"]
-
-            condition_record = PatientCondition(condition=pat_condition, clinical_status=clinical_status, 
-                                                verification_status=verification_status, onset_date_time=onset_date_time, 
-                                                recorded_date=recorded_date, abatement_time=abatement_time, 
-                                                encounter_reference=encounter_reference, subject_reference=subject_reference, 
-                                                snomed_code=snomed_code)
-            
-            patient_info.conditions.append(condition_record)
-
-    if ("observations" in doc._data):
-        for observation in doc._data["observations"]:
-            new_observation = PatientObservation(
-                                    category=observation["category"],
-                                    observation=observation["observation"],
-                                    status=observation["status"],
-                                    effective_date_time=observation["effective_date_time"],
-                                    issued=observation["issued"],
-                                    value_quantity=observation["value_quantity"],
-                                    value_codeable_concept=observation["value_codeable_concept"],
-                                    encounter_reference=observation["encounter_reference"],
-                                    subject_reference=observation["subject_reference"],
-                                    component=observation["component"]
-                                )
-            patient_info.observations.append(new_observation)
+    if ("conditions" in data):
+        patient_info.conditions = [PatientCondition.from_dict(condition) for condition in data["conditions"]]
+
+    if ("observations" in data):
+        patient_info.observations = [PatientObservation.from_dict(observation) for observation in data["observations"]]
 
     return patient_info
 
@@ -711,74 +1199,144 @@ def parse_HL7_message(msg):
     return hl7, patient_info
 
 
-def get_firestore_age_range(db: firestore.client, num_of_patients: int, lower: int, upper: int, peter_pan: bool) -> list[PatientInfo]: 
+def get_firestore_age_range(db: firestore.client, num_of_patients: int, lower: int, upper: int, peter_pan: bool, 
+                            readers: int = 1, cache = None, histogram = None) -> list[PatientInfo]: 
     """
     Pull patient information from Firestorm, given an age range. If not enough patients exist in the firestore, 
     they will be generated using poll_synthea and the HL7 processor. 
 
     If peter_pan is set to true, patients will have their DOBs changed to match their age at time of creation.
     If false, their age will be updated using their DOB. 
+
+    Set readers above 1 to read slices of the age range in parallel. Pass a ``PatientCache`` to 
+    read patients already downloaded from the local cache instead of Firestore, and an 
+    ``AgeHistogram`` to count patients without an aggregation query. 
     
     Returns a list of patients.
     """
 
-    patients = []
-    uploaded_patients = []
+    return list(iter_firestore_age_range(db, num_of_patients, lower, upper, peter_pan, readers=readers, cache=cache, 
+                                         histogram=histogram))
 
-    while (len(patients) == 0):
-        count, query = count_patient_records(db, lower, upper, peter_pan)
 
-        # If there are enough patients...
-        if (count >= num_of_patients):
+def iter_firestore_age_range(db: firestore.client, num_of_patients: int, lower: int, upper: int, peter_pan: bool, 
+                             readers: int = 1, page_size: int = 500, cache = None, 
+                             histogram = None) -> Iterator[PatientInfo]: 
+    """Yields the patients of ``get_firestore_age_range`` one at a time, as their documents arrive 
+    from Firestore, so only the documents of the page being streamed are held in memory. 
 
-            docs = query.limit(num_of_patients).stream()
+    Documents are read a page at a time with ``start_after`` cursors, and a page which fails with a 
+    transient error is read again from the last cursor. With ``readers`` above 1, the age range is 
+    split into that many slices, each paged through by its own thread, and patients are yielded in 
+    the order they are read. 
 
-            # Stream the patient docs 
-            for doc in docs:
-                patient_info = firestore_doc_to_patient_info(db=db, doc=doc)
+    As with ``get_firestore_age_range``, missing patients are generated first; nothing is yielded 
+    until the database holds enough of them. 
 
-                # Matches age with dob - method for doing so depends on the peter_pan bool
-                if peter_pan:
-                    patient_info = update_retrieved_patient_dob(patient_info=patient_info)
-                else: 
-                    patient_info = update_retrieved_patient_age(patient_info=patient_info)
+    With a ``PatientCache``, the cache is synced and consulted first, and if it holds enough 
+    matching patients no patient documents are read from Firestore. Otherwise the documents are 
+    read from Firestore as usual and added to the cache. 
 
-                patients.append(patient_info)
+    With an ``AgeHistogram``, patients are counted from the histogram instead of an aggregation 
+    query whenever peter_pan is set. 
 
-            # Return a list of patients     
-            return patients
-        
-        else: 
-            print(f"Database only has {count} matching patient(s) - generating new patients...")
+    Args: 
+    - db: ``firestore.client``, an initialised firestore client
+    - num_of_patients: ``int``, number of patients to yield
+    - lower: ``int``, youngest age
+    - upper: ``int``, oldest age
+    - peter_pan: ``bool``, whether patients keep the age they were created with
+    - readers: ``int``, threads reading slices of the age range at once
+    - page_size: ``int``, documents read per request
+    - cache: ``PatientCache``, optional local cache of patient documents
+    - histogram: ``AgeHistogram``, optional counts of patients by age
+
+    Returns:
+    - ``Iterator[PatientInfo]``
+    """
+
+    field, low, high = age_range_bounds(lower, upper, peter_pan)
+
+    if cache is not None:
+        cache.sync(db, page_size)
+        if cache.count(field, low, high) >= num_of_patients:
+            for data in cache.query(field, low, high, num_of_patients):
+                yield retrieved_patient_info(db, data, peter_pan)
+            return
+
+    uploaded_patients = []
+
+    while True:
+        count, query = count_patient_records(db, lower, upper, peter_pan, histogram)
 
-            info = {
-                "number_of_patients": int(num_of_patients - count),
-                "age_from": lower, 
-                "age_to": upper, 
-                "sex": "F"
-            }
+        # If there are enough patients...
+        if (count >= num_of_patients):
+            break
+
+        print(f"Database only has {count} matching patient(s) - generating new patients...")
 
-            # Generate patients using poll_synthea
-            call_for_patients(info=info)
+        info = {
+            "number_of_patients": int(num_of_patients - count),
+            "age_from": lower, 
+            "age_to": upper, 
+            "sex": "F"
+        }
 
-            # Iterate through FHIR JSON files in the work folder
+        # Generate patients using poll_synthea
+        call_for_patients(info=info)
+
+        # Iterate through FHIR JSON files in the work folder
+        def new_patients():
             for file in work_folder_path.glob("*.json"):
                 if file.name not in uploaded_patients:
                     try: 
-                        with open(file, "r") as f:
-                            fhir_message = f.read()
-
-                            # Parse patient information from file 
-                            patient_info = parse_fhir_message(fhir_message)
-                            save_to_firestore(db=db, patient_info=patient_info)
-                            uploaded_patients.append(file.name)
-                            
+                        # Parse patient information from file 
+                        patient_info = parse_fhir_file(db, file)
                     except UnicodeDecodeError as e:
                         print("Problem reading file...")
                         print(e)
+                        continue
                     except Exception as e: 
                         print("Couldn't parse patient information from fhir message...")
                         time.sleep(3)
+                        continue
+
+                    uploaded_patients.append(file.name)
+                    yield patient_info
+
+        save_patients_to_firestore(db=db, patients=new_patients())
+
+        if histogram is not None:
+            histogram.refresh()
+
+    if readers > 1:
+        queries = [build_patient_query(db, field, a, b) for a, b in split_range(low, high, readers)]
+        docs = iter_parallel_pages(queries, field, num_of_patients, page_size)
+    else:
+        docs = iter_query_pages(query, field, num_of_patients, page_size)
+
+    # Page through the patient docs; each one is converted and handed on before the next is read
+    read = []
+    for doc in docs:
+        if cache is not None:
+            read.append(doc._data)
+            if len(read) >= page_size:
+                cache.store(read)
+                read = []
+        yield retrieved_patient_info(db, doc._data, peter_pan)
+
+    if cache is not None:
+        cache.store(read)
+
+
+def retrieved_patient_info(db: firestore.client, data: dict, peter_pan: bool) -> PatientInfo:
+    """Converts a retrieved patient document and matches its age with its dob - the method for 
+    doing so depends on the peter_pan bool."""
+    patient_info = firestore_dict_to_patient_info(db=db, data=data)
+
+    if peter_pan:
+        return update_retrieved_patient_dob(patient_info=patient_info)
+    return update_retrieved_patient_age(patient_info=patient_info)
 
 
 def update_retrieved_patient_dob(patient_info: PatientInfo, ) -> PatientInfo:
@@ -845,33 +1403,51 @@ def assign_age_to_patient(patient_info: PatientInfo, desired_age: int, index: in
     return patient_info
 
 
-def count_patient_records(db: firestore.client, lower: int, upper: int, peter_pan: bool) -> tuple[int | float, any]:
-    """Counts the number of patient records that match the age requirements specified. 
+def age_range_bounds(lower: int, upper: int, peter_pan: bool) -> tuple[str, int | str, int | str]:
+    """Works out which field, and which range of it, holds the patients aged ``lower`` to ``upper``. 
 
-    Returns both the count of the patients in the db, and the query used in the check. 
+    Returns the field name and its lowest and highest values, both inclusive. 
     """
 
-    # Form the query based on peter_pan bool 
+    # Form the range based on peter_pan bool 
     if peter_pan:
 
         # We can simply collect patients using 'age', as will be changing their dob to match
-        query = db.collection("full_fhir").where(filter=FieldFilter("age", "<=", upper))\
-                                            .where(filter=FieldFilter("age", ">=", lower))
-    else:
+        return "age", lower, upper
+
+    # We need to calculate the appropriate dob ranges; we can't search by age as we will change this
+    current_date = date.today()
 
-        # We need to calculate the appropriate dob ranges; we can't search by age as we will change this
-        current_date = date.today()
+    # If they are X years old today, their DOB will fall between these ranges
+    lower_year = current_date.year - lower
+    upper_dob = current_date.replace(year=lower_year)
 
-        # If they are X years old today, their DOB will fall between these ranges
-        lower_year = current_date.year - lower
-        upper_dob = current_date.replace(year=lower_year)
+    upper_year = current_date.year - upper 
+    lower_dob = current_date.replace(year=upper_year)
 
-        upper_year = current_date.year - upper 
-        lower_dob = current_date.replace(year=upper_year)
+    return "birth_date", lower_dob.isoformat(), upper_dob.isoformat()
 
-        # Find all records between the two valid DOBs
-        query = db.collection("full_fhir").where(filter=FieldFilter("birth_date", "<=", upper_dob.isoformat()))\
-                                            .where(filter=FieldFilter("birth_date", ">=", lower_dob.isoformat()))
+
+def build_patient_query(db: firestore.client, field: str, low, high):
+    """Builds the query for the patient records whose ``field`` lies between ``low`` and ``high``, inclusive."""
+    return db.collection("full_fhir").where(filter=FieldFilter(field, "<=", high))\
+                                     .where(filter=FieldFilter(field, ">=", low))
+
+
+def count_patient_records(db: firestore.client, lower: int, upper: int, peter_pan: bool, 
+                          histogram = None) -> tuple[int | float, any]:
+    """Counts the number of patient records that match the age requirements specified. 
+
+    With peter_pan set, patients are queried by their stored age, so an ``AgeHistogram`` which has 
+    been built can answer without an aggregation query. 
+
+    Returns both the count of the patients in the db, and the query used in the check. 
+    """
+
+    query = build_patient_query(db, *age_range_bounds(lower, upper, peter_pan))
+
+    if peter_pan and histogram is not None and histogram.exists:
+        return histogram.count(lower, upper), query
     
     aggregate_query = aggregation.AggregationQuery(query)
 
@@ -885,9 +1461,86 @@ def count_patient_records(db: firestore.client, lower: int, upper: int, peter_pa
     return count, query
 
 
+def patient_info_to_firestore_data(db: firestore.client, patient_info: PatientInfo) -> dict:
+    """Builds the Firestore document for a patient, assigning it a new hl7v2_id if it has none. 
+
+    Args: 
+    - db: ``firestore.client``, an initialised firestore client
+    - patient_info: ``PatientInfo``, a PatientInfo object
+
+    Returns: 
+    - patient_data: ``dict``
+    """
+    # Keep the id already given to the patient when it was parsed, so the HL7 message and the 
+    # Firestore document agree
+    hl7v2_id = patient_info.hl7v2_id
+    if isinstance(hl7v2_id, list):
+        hl7v2_id = hl7v2_id[0] if hl7v2_id else None
+    if not hl7v2_id:
+        hl7v2_id = create_patient_id(db=db)
+
+    patient_data = {
+        "id": patient_info.id,
+        "hl7v2_id": hl7v2_id,
+        "birth_date": patient_info.birth_date.isoformat(),
+        "gender": patient_info.gender,
+        "ssn":patient_info.ssn,
+        "first_name": patient_info.first_name,
+        "middle_name": patient_info.middle_name,
+        "last_name": patient_info.last_name,
+        "address": patient_info.address,
+        "address_2": patient_info.address_2,
+        "city": patient_info.city,
+        "country": patient_info.country,
+        "post_code": patient_info.post_code,
+        "country_code": patient_info.country_code,
+        "age":patient_info.age,
+        "creation_date":patient_info.creation_date.isoformat(),
+        # Exact time of the write, which PatientCache.sync resumes from; creation_date is only a day
+        "created_at": firestore.SERVER_TIMESTAMP,
+    }
+
+    patient_data["conditions"] = [condition.to_dict() for condition in patient_info.conditions]
+    patient_data["observations"] = [observation.to_dict() for observation in patient_info.observations]
+
+    return patient_data
+
+
+def get_existing_patient_ids(db: firestore.client, patient_ids, chunk_size: int = 300) -> set[str]:
+    """Returns the subset of ``patient_ids`` which already exist in the full_fhir collection. 
+
+    Each chunk of ids is resolved with a single ``get_all`` call, and only the ``id`` field 
+    is fetched, so conditions and observations are never downloaded. 
+
+    Args: 
+    - db: ``firestore.client``, an initialised firestore client
+    - patient_ids: ``Iterable[str]``
+    - chunk_size: ``int``, number of ids looked up per call
+
+    Returns: 
+    - existing_ids: ``set[str]``
+    """
+    collection = db.collection("full_fhir")
+    existing_ids = set()
+
+    patient_ids = iter(patient_ids)
+    while True:
+        chunk = list(itertools.islice(patient_ids, chunk_size))
+        if not chunk:
+            break
+        refs = [collection.document(patient_id) for patient_id in chunk]
+        for snapshot in db.get_all(refs, field_paths=["id"]):
+            if snapshot.exists:
+                existing_ids.add(snapshot.id)
+
+    return existing_ids
+
+
 def save_to_firestore(db: firestore.client, patient_info: PatientInfo) -> None:
         """Save patient info to Firestore if the patient does not already exist 
-        in the database - this is checked using their ID. 
+        in the database - this is checked using their ID. The document is written with 
+        ``create``, so of two concurrent writers only the one that adds the patient counts 
+        it in the age histogram. 
         
         Args: 
         - db: ``firestore.client``, an initialised firestore client
@@ -900,46 +1553,105 @@ def save_to_firestore(db: firestore.client, patient_info: PatientInfo) -> None:
         try: 
             patient_id = patient_info.id
             patient_ref = db.collection("full_fhir").document(patient_id)
-            if patient_ref.get().exists:
+            if get_existing_patient_ids(db, [patient_id]):
                 print(
                     f"Patient with ID {patient_id} already exists in Firestore. Skipping."
                 )
-            else:
-
-                patient_data = {
-                    "id": patient_info.id,
-                    "hl7v2_id": create_patient_id(db=db),
-                    "birth_date": patient_info.birth_date.isoformat(),
-                    "gender": patient_info.gender,
-                    "ssn":patient_info.ssn,
-                    "first_name": patient_info.first_name,
-                    "middle_name": patient_info.middle_name,
-                    "last_name": patient_info.last_name,
-                    "address": patient_info.address,
-                    "address_2": patient_info.address_2,
-                    "city": patient_info.city,
-                    "country": patient_info.country,
-                    "post_code": patient_info.post_code,
-                    "country_code": patient_info.country_code,
-                    "age":patient_info.age,
-                    "creation_date":patient_info.creation_date.isoformat(),
-                }
-
-                if hasattr(patient_info, 'conditions'):
-                    conditions = []
-                    for condition in patient_info.conditions:
-                        conditions.append(condition.__dict__)
-                    patient_data["conditions"] = conditions
-
-                if hasattr(patient_info, 'observations'):
-                    observations = []
-                    for observation in patient_info.observations:
-                        observations.append(observation.__dict__)
-                    patient_data["observations"] = observations
-
-                patient_ref.set(patient_data)
-                print(f"Added patient with ID {patient_id} to Firestore.")
+                return
+            patient_ref.create(patient_info_to_firestore_data(db, patient_info))
+            print(f"Added patient with ID {patient_id} to Firestore.")
 
+        except exceptions.AlreadyExists:
+            print(f"Patient with ID {patient_id} already exists in Firestore. Skipping.")
+            return
         except Exception as e:
             print('Failed to upload to Firestore: %s', repr(e)) 
+            return
+
+        try:
+            increment_age_histogram(db, [patient_info])
+        except Exception as e:
+            logging.error(f"Could not update the age histogram: {type(e).__name__}: {e}")
+
+
+# gRPC status code returned when a create() targets a document that already exists
+ALREADY_EXISTS = 6
+
+
+def save_patients_to_firestore(db: firestore.client, patients, max_attempts: int = 5, chunk_size: int = 300) -> dict[str, str]:
+    """Uploads many patients to Firestore through a ``BulkWriter``, which groups the writes into 
+    batches and sends them in parallel. 
+
+    Patients are handled in chunks of ``chunk_size``: the ids which already exist are found with 
+    one ``get_existing_patient_ids`` call per chunk and skipped. The rest are written with 
+    ``create``, so a patient added in the meantime is still left untouched. 
+
+    Args: 
+    - db: ``firestore.client``, an initialised firestore client
+    - patients: ``Iterable[PatientInfo]``
+    - max_attempts: ``int``, attempts for writes which fail for any other reason
+    - chunk_size: ``int``, number of patients checked for existence at a time
+
+    Returns: 
+    - outcomes: ``dict[str, str]``, patient id -> "added", "exists" or "failed: <reason>"
+    """
+    outcomes: dict[str, str] = {}
+    # Gender and age of each patient queued, for the age histogram once the writes are done
+    queued: dict[str, dict] = {}
+    collection = db.collection("full_fhir")
+
+    bulk_writer = db.bulk_writer()
+
+    def on_write_result(reference, result, writer):
+        outcomes[reference.id] = "added"
+
+    def on_write_error(failure, writer) -> bool:
+        patient_id = failure.operation.reference.id
+        if failure.code == ALREADY_EXISTS:
+            outcomes[patient_id] = "exists"
+            return False
+        if failure.attempts < max_attempts:
+            return True
+        outcomes[patient_id] = f"failed: {failure.message}"
+        return False
+
+    bulk_writer.on_write_result(on_write_result)
+    bulk_writer.on_write_error(on_write_error)
+
+    patients = iter(patients)
+    while True:
+        chunk = list(itertools.islice(patients, chunk_size))
+        if not chunk:
+            break
 
+        # Skip patients which already exist before building their documents and hl7v2_ids
+        existing_ids = get_existing_patient_ids(db, (patient_info.id for patient_info in chunk), chunk_size)
+
+        for patient_info in chunk:
+            # A bulk writer cannot write the same document twice
+            if patient_info.id in outcomes:
+                continue
+            if patient_info.id in existing_ids:
+                outcomes[patient_info.id] = "exists"
+                continue
+            try:
+                outcomes[patient_info.id] = "pending"
+                bulk_writer.create(collection.document(patient_info.id), patient_info_to_firestore_data(db, patient_info))
+                queued[patient_info.id] = {"gender": patient_info.gender, "age": patient_info.age}
+            except Exception as e:
+                outcomes[patient_info.id] = f"failed: {e!r}"
+
+    # Blocks until every write has completed
+    bulk_writer.close()
+
+    try:
+        increment_age_histogram(db, [queued[id] for id, outcome in outcomes.items() if outcome == "added" and id in queued])
+    except Exception as e:
+        logging.error(f"Could not update the age histogram: {type(e).__name__}: {e}")
+
+    counts = {}
+    for outcome in outcomes.values():
+        counts[outcome.split(":")[0]] = counts.get(outcome.split(":")[0], 0) + 1
+    print(f"Uploaded patients to Firestore: {counts}")
+
+    return outcomes
@@ -0,0 +1,230 @@
+# Author Paul Olphert 2023
+
+# This file contains the writers which save generated HL7 messages to disk. HL7FileWriter keeps
+# the original layout of one <patient id>.hl7 file per patient, and HL7AsyncWriter does the same
+# from a pool of background threads. HL7BatchWriter streams messages into HL7 batch files wrapped
+# in FHS/BHS segments, starting a new file after a set number of messages or bytes, so a large run
+# produces a handful of files instead of one per patient.
+
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from .generators.identifiers import control_ids
+
+
+class HL7FileWriter:
+    """
+    Writes each message to its own <patient id>.hl7 file. The message is written to a hidden
+    temporary file first and renamed into place, so a folder poller never sees a partial file.
+
+    Mandatory args: hl7_folder_path: string
+    """
+
+    def __init__(self, hl7_folder_path):
+        self.hl7_folder_path = Path(hl7_folder_path)
+
+    def path_for(self, patient_id):
+        return self.hl7_folder_path / f"{patient_id}.hl7"
+
+    def write(self, message, patient_id):
+        """
+        Writes one ER7 message and returns the path of the file it was written to.
+        """
+        hl7_file_path = self.path_for(patient_id)
+        # Unique per process and thread, so two writers of the same patient never share a temporary file
+        temp_path = hl7_file_path.with_name(f".{hl7_file_path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(temp_path, "w") as hl7_file:
+            hl7_file.write(message)
+        os.replace(temp_path, hl7_file_path)
+        return hl7_file_path
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class HL7AsyncWriter(HL7FileWriter):
+    """
+    Writes each message to its own <patient id>.hl7 file from a pool of background threads, so
+    the caller does not wait on disk. Messages wait on a bounded queue, and write blocks once
+    the queue is full. Files are written atomically as with HL7FileWriter.
+
+    close waits for the queue to drain, prints the write throughput and logs any failed writes,
+    which stay in ``errors`` until the next write starts the threads again.
+
+    Mandatory args: hl7_folder_path: string
+    Optional args: threads: int, queue_size: int, messages waiting to be written
+    """
+
+    def __init__(self, hl7_folder_path, threads=4, queue_size=1000):
+        super().__init__(hl7_folder_path)
+        self.threads = threads
+        self.queue_size = queue_size
+        self.workers = []
+        self.errors = []
+
+    def __getstate__(self):
+        # Sent to worker processes without the threads; each process starts its own
+        return {"hl7_folder_path": self.hl7_folder_path, "threads": self.threads, "queue_size": self.queue_size}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def start(self):
+        self.queue = queue.Queue(self.queue_size)
+        self.lock = threading.Lock()
+        self.written = 0
+        self.bytes_written = 0
+        self.errors = []
+        self.started_at = time.perf_counter()
+        self.workers = [
+            threading.Thread(target=self.write_queued_messages, name=f"hl7_writer_{i}", daemon=True)
+            for i in range(self.threads)
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    def write(self, message, patient_id):
+        """
+        Queues one ER7 message and returns the path its file will have once written.
+        """
+        if not self.workers:
+            self.start()
+        self.queue.put((message, patient_id))
+        return self.path_for(patient_id)
+
+    def write_queued_messages(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            message, patient_id = item
+            try:
+                super().write(message, patient_id)
+                with self.lock:
+                    self.written += 1
+                    self.bytes_written += len(message)
+            except Exception as e:
+                logging.error(f"Could not write the HL7 message for {patient_id}: {type(e).__name__}: {e}")
+                with self.lock:
+                    self.errors.append((patient_id, f"{type(e).__name__}: {e}"))
+
+    def stats(self):
+        """Returns the files and bytes written since the threads started, and the rate."""
+        seconds = time.perf_counter() - self.started_at
+        return {
+            "written": self.written,
+            "bytes": self.bytes_written,
+            "seconds": seconds,
+            "files_per_second": self.written / seconds if seconds else 0.0,
+        }
+
+    def close(self):
+        """Waits for every queued message to be written and reports the throughput."""
+        if not self.workers:
+            return
+
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+        stats = self.stats()
+        print(f"Wrote {stats['written']} HL7 files ({stats['bytes'] / 1e6:.1f} MB) in {stats['seconds']:.1f}s, "
+              f"{stats['files_per_second']:.0f} files/s ✓")
+        if self.errors:
+            print(f"x {len(self.errors)} HL7 files could not be written, see the log")
+
+
+class HL7BatchWriter:
+    """
+    Streams messages into HL7 batch files, each holding one FHS/BHS batch:
+
+        FHS ... BHS ... <messages> ... BTS|<count> FTS|1
+
+    A new file is started once the current one holds max_messages messages or max_bytes bytes.
+    Files are written as <name>.hl7.part and renamed to <name>.hl7 once their trailer is written,
+    so a half written batch is never picked up by the interface engine.
+
+    Mandatory args: hl7_folder_path: string
+    Optional args: max_messages: int, max_bytes: int or None, buffer_size: int, bytes buffered
+    before each write to disk, prefix: string, start of each batch file name
+    """
+
+    def __init__(self, hl7_folder_path, max_messages=10000, max_bytes=None, buffer_size=1024 * 1024, prefix="batch"):
+        self.hl7_folder_path = Path(hl7_folder_path)
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.buffer_size = buffer_size
+        self.prefix = prefix
+        self.file = None
+        self.file_number = 0
+        self.written_files = []
+
+    def __getstate__(self):
+        # Sent to worker processes without the open file; each worker writes its own batch files
+        state = self.__dict__.copy()
+        state.update(file=None, file_number=0, written_files=[])
+        return state
+
+    def header(self, file_name, timestamp, control_id):
+        return (
+            f"FHS|^~\\&|ULTRA|TEST|ULTRA|NUFFIELD|{timestamp}||{file_name}||{control_id}\r"
+            f"BHS|^~\\&|ULTRA|TEST|ULTRA|NUFFIELD|{timestamp}||||{control_id}\r"
+        )
+
+    def open(self):
+        timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+        self.file_number += 1
+        file_name = f"{self.prefix}_{timestamp}_{os.getpid()}_{self.file_number:04d}.hl7"
+
+        self.path = self.hl7_folder_path / file_name
+        self.part_path = self.path.with_name(file_name + ".part")
+        self.file = open(self.part_path, "wb", buffering=self.buffer_size)
+        self.message_count = 0
+        self.byte_count = self.file.write(self.header(file_name, timestamp, control_ids.next()).encode())
+
+    def write(self, message, patient_id=None):
+        """
+        Appends one ER7 message to the current batch file and returns the path that file will have
+        once it is closed.
+        """
+        if self.file is None:
+            self.open()
+
+        self.byte_count += self.file.write(message.encode())
+        self.message_count += 1
+        path = self.path
+
+        if self.message_count >= self.max_messages or (self.max_bytes and self.byte_count >= self.max_bytes):
+            self.close()
+
+        return path
+
+    def close(self):
+        """Writes the batch trailer and renames the finished file; the next write starts a new file."""
+        if self.file is None:
+            return
+
+        self.file.write(f"BTS|{self.message_count}\rFTS|1\r".encode())
+        self.file.close()
+        self.file = None
+        os.replace(self.part_path, self.path)
+        self.written_files.append(self.path)
+        print(f"Wrote {self.message_count} messages to {self.path.name} ✓")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
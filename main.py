@@ -1,16 +1,28 @@
 # Author Paul Olphert 2023
 
 # This file contains the code to Build an HL7 message from FHIR data and create a patient in Firestore
+from collections import namedtuple
 from datetime import date, datetime
 import logging
+import multiprocessing
+import os
+import multiprocessing.util
 import traceback
+from typing import Iterator
 import firebase_admin
 from firebase_admin import credentials, firestore
 from pathlib import Path
 from .generators.utilities import create_control_id, create_filler_order_num, create_placer_order_num, \
-    get_firestore_age_range, parse_fhir_message, PatientInfo, assign_age_to_patient
+    get_firestore_age_range, iter_firestore_age_range, parse_fhir_file, PatientInfo, assign_age_to_patient, save_to_firestore, \
+    save_patients_to_firestore
 from hl7apy import core
+from .generators.identifiers import identifier_partition, partition_identifiers, use_identifier_store
+from .generators.ledger import ProcessingLedger
 from .segments import create_pid, create_obr, create_orc, create_msh, create_evn, create_pv1
+from .segments.er7_template import MESSAGE_LAYOUTS, render_er7_message
+from .segments.skeleton import get_message_skeleton
+from .poll_synthea import stream_synthea
+from .hl7_output import HL7FileWriter
 from pathlib import Path
 
 BASE_DIR = Path.cwd()
@@ -18,7 +30,8 @@ work_folder_path = BASE_DIR / "Work"
 hl7_folder_path = BASE_DIR / "HL7_v2"
 
 # Creates an HL7 MSH segment and returns the HL7 message this must be called first to create the HL7 message
-def create_message_header(messageType):
+# With use_skeleton the message starts from the cached MessageSkeleton, so only the variable fields are built
+def create_message_header(messageType, use_skeleton=True):
     global BASE_DIR
     current_date = date.today()
 
@@ -28,89 +41,132 @@ def create_message_header(messageType):
     # Create empty HL7 message
     try:
         # Move to 2.4 - test!!
-        hl7 = core.Message(messageType, version="2.4")
+        if use_skeleton:
+            hl7 = get_message_skeleton(messageType).new_message()
+        else:
+            hl7 = core.Message(messageType, version="2.4")
     except Exception as e:
         hl7 = None
         print(f"An error occurred while initializing the HL7 Message: {e}")
         print(f"messageType: {messageType}")
 
     # Create MSH Segment
-    hl7 = create_msh.create_msh(messageType, control_id, hl7, current_date) # MSH Segment
+    hl7 = create_msh.create_msh(messageType, control_id, hl7, current_date, static_fields=not use_skeleton) # MSH Segment
 
     return hl7
 
 
 # Creates an HL7 ADT message includes the MSH segment then options based on message type then returns an HL7 message
-def create_adt_message(patient_info, messageType):
-    hl7 = create_message_header(messageType)
-    hl7 = create_evn.create_evn(hl7)
-    hl7 = create_pid.create_pid(patient_info, hl7)
-    hl7 = create_pv1.create_pv1(patient_info, hl7)
+def create_adt_message(patient_info, messageType, use_skeleton=True):
+    static_fields = not use_skeleton
+    hl7 = create_message_header(messageType, use_skeleton)
+    hl7 = create_evn.create_evn(hl7, static_fields)
+    hl7 = create_pid.create_pid(patient_info, hl7, static_fields)
+    hl7 = create_pv1.create_pv1(patient_info, hl7, static_fields)
   
     return hl7
 
 
 # Creates an HL7 ORM message includes the MSH segment then options based on message type then returns an HL7 message
-def create_orm_message(patient_info, messageType):
-    hl7 = create_message_header(messageType)
-    hl7 = create_pid.create_pid(patient_info, hl7)
-    hl7 = create_pv1.create_pv1(patient_info, hl7)
+def create_orm_message(patient_info, messageType, use_skeleton=True):
+    static_fields = not use_skeleton
+    hl7 = create_message_header(messageType, use_skeleton)
+    hl7 = create_pid.create_pid(patient_info, hl7, static_fields)
+    hl7 = create_pv1.create_pv1(patient_info, hl7, static_fields)
     placer_order_num = create_placer_order_num()
     filler_order_id = create_filler_order_num()
-    hl7 = create_orc.create_orc(hl7, placer_order_num, filler_order_id)
-    hl7 = create_obr.create_obr(patient_info, placer_order_num, filler_order_id, hl7)
+    hl7 = create_orc.create_orc(hl7, placer_order_num, filler_order_id, static_fields)
+    hl7 = create_obr.create_obr(patient_info, placer_order_num, filler_order_id, hl7, static_fields)
 
     return hl7
 
 
 # Creates an HL7 ORU message includes the MSH segment then options based on message type then returns an HL7 message
-def create_oru_message(patient_info, messageType):
-    hl7 = create_message_header(messageType)
-    hl7 = create_pid.create_pid(patient_info, hl7)
-    hl7 = create_pv1.create_pv1(patient_info, hl7)
+def create_oru_message(patient_info, messageType, use_skeleton=True):
+    static_fields = not use_skeleton
+    hl7 = create_message_header(messageType, use_skeleton)
+    hl7 = create_pid.create_pid(patient_info, hl7, static_fields)
+    hl7 = create_pv1.create_pv1(patient_info, hl7, static_fields)
     placer_order_num = create_placer_order_num()
     filler_order_id = create_filler_order_num()
-    hl7 = create_orc.create_orc(hl7, placer_order_num, filler_order_id)
-    hl7 = create_obr.create_obr(patient_info, placer_order_num, filler_order_id, hl7)
+    hl7 = create_orc.create_orc(hl7, placer_order_num, filler_order_id, static_fields)
+    hl7 = create_obr.create_obr(patient_info, placer_order_num, filler_order_id, hl7, static_fields)
 
     return hl7
 
 
-def create_oml_message(patient_info, messageType):
-    hl7 = create_message_header(messageType)
-    hl7 = create_pid.create_pid(patient_info, hl7)
+def create_oml_message(patient_info, messageType, use_skeleton=True):
+    static_fields = not use_skeleton
+    hl7 = create_message_header(messageType, use_skeleton)
+    hl7 = create_pid.create_pid(patient_info, hl7, static_fields)
     placer_order_num = create_placer_order_num()
     filler_order_id = "24325-3^Liver^Function^Test"
-    hl7 = create_orc.create_orc(hl7, placer_order_num, filler_order_id)
-    hl7 = create_obr.create_obr(patient_info, placer_order_num, filler_order_id, hl7)
+    hl7 = create_orc.create_orc(hl7, placer_order_num, filler_order_id, static_fields)
+    hl7 = create_obr.create_obr(patient_info, placer_order_num, filler_order_id, hl7, static_fields)
 
     return hl7
 
 
+# Serializes an hl7apy message to ER7 text, each segment ending in a carriage return
+def message_to_er7(hl7_message, messageType) -> str:
+    return "".join(str(getattr(hl7_message, segment.lower()).value) + "\r" for segment in MESSAGE_LAYOUTS[messageType])
+
+
+# Outcome of processing a single fhir file, returned in order by HL7MessageProcessor.main. 
+# upload is the Firestore outcome from save_patients_to_firestore; patient_info is only 
+# carried until the patient has been uploaded. hl7_path is the file the message was written to.
+FileResult = namedtuple("FileResult", ["file", "patient_id", "error", "traceback", "upload", "patient_info", "hl7_path"], 
+                        defaults=(None, None, None))
+
+
 # HL7MessageProcessor class to process FHIR messages and create HL7 messages  
 class HL7MessageProcessor:
     """
     Mandatory args: hl7_folder_path: string
-    Optional args: initialised firestore client: firestore.client
+    Optional args: initialised firestore client: firestore.client, 
+    ledger: ProcessingLedger used to skip fhir files that were already processed and have not changed, 
+    upload_batch_size: int, number of patients uploaded to firestore together, 
+    engine: string, "hl7apy" to build each message with hl7apy or "template" to format it straight 
+    to ER7 with segments/er7_template.py, which gives the same output many times faster, 
+    output: HL7FileWriter (the default, one file per patient), HL7AsyncWriter (one file per patient, 
+    written by background threads) or HL7BatchWriter (FHS/BHS batch files), 
+    upload: bool, set to False to only write HL7 messages; no firestore client is needed then, and 
+    patients are given hl7v2_ids by a LocalPatientIdAllocator
     """
 
-    def __init__(self, hl7_folder_path, db = None):
+    def __init__(self, hl7_folder_path, db = None, ledger = None, upload_batch_size = 500, engine = "hl7apy", 
+                 output = None, upload = True):
         self.messageType = None
+        self.engine = engine
         self.hl7_folder_path = Path(hl7_folder_path)
+        self.output = output or HL7FileWriter(self.hl7_folder_path)
+        # Order and visit identifiers already used for this folder by earlier runs are not handed out again
+        use_identifier_store(self.hl7_folder_path)
+        self.ledger = ledger
+        self.upload_batch_size = upload_batch_size
+        self.upload = upload
 
         # Check to see if firestore client has been passed as argument
         if db:
             self.db = db
-        else:
+        elif upload:
             self.db = initialize_firestore()
+        else:
+            self.db = None
 
 
-    def main(self, predetermined_message_type=None):
+    def main(self, predetermined_message_type=None, fhir_files=None, workers=1):
         """
         Reads and parses fhir docs in work folder, generates HL7 messages, and 
         uploads patient info to firestore. 
 
-        Optional args: predetermined_message_type: string
+        Optional args: predetermined_message_type: string, 
+        fhir_files: iterable of fhir file paths to process instead of the work folder, 
+        e.g. poll_synthea.stream_synthea(...) to process bundles while Synthea is still generating, 
+        workers: int, number of processes to spread the files across, each with its own firestore client 
+        unless upload is off
+
+        Returns a list of FileResult, one per processed file, in the order the files were given
         """
         #TODO: Add a menu to choose the message type with validation for choices
         # Initialize Firebase Admin SDK with your credentials
@@ -128,74 +184,195 @@ class HL7MessageProcessor:
                 self.messageType = "ADT_A01"
             elif messageType == "3":
                 self.messageType = "ORM_O01"
+
+        if fhir_files is None:
+            fhir_files = work_folder_path.glob("*.json")
+
+        self.skipped = 0
+        pending_files = self.pending_files(fhir_files)
+
+        if workers > 1:
+            # Spawned rather than forked so that every worker opens its own firestore connection
+            context = multiprocessing.get_context("spawn")
+            # The pid of the worker holding each share of the identifier spaces, 0 while a share is free
+            worker_shares = context.Array("i", workers)
+            pool = context.Pool(workers, initializer=init_worker_processor, 
+                                initargs=(self.hl7_folder_path, self.messageType, self.engine, self.output, 
+                                          worker_shares, self.upload))
+            file_results = pool.imap(process_file_in_worker, pending_files)
+        else:
+            pool = None
+            file_results = (self.process_file_safely(file) for file in pending_files)
+
+        results = []
+        # Positions in results of patients still waiting to be uploaded
+        pending_uploads = []
         try:
             # Iterate through FHIR JSON files in the work folder
-            for file in work_folder_path.glob("*.json"):
-                with open(file, "r") as f:
-                    fhir_message = f.read()
-
-                    # At this point, patient_info has creation_date
-                    patient_info = parse_fhir_message(fhir_message)
-                    if patient_info:
-
-                        # Writing hl7 message to file 
-                        if self.messageType == "ADT_A01":
-                            hl7_message = create_adt_message(patient_info, self.messageType)
-                        elif self.messageType == "ORM_O01":
-                            hl7_message = create_orm_message(patient_info, self.messageType)
-                        elif self.messageType == "ORU_R01":
-                            hl7_message = create_oru_message(patient_info, self.messageType)
-                        print("Generated HL7 message:", str(hl7_message))
-                        self.save_hl7_message_to_file(hl7_message, patient_info.id)
-
-                        # Saving to firestore 
-                        patient_id = patient_info.id
-                        patient_ref = self.db.collection("full_fhir").document(patient_id)
-                        # Check if patient already exists
-                        if patient_ref.get().exists:
-                            print(
-                                f"Patient with ID {patient_id} already exists in Firestore. Skipping."
-                            )
-                        else:
-                            # Add patient to Firestore
-                            patient_data = {
-                                "id": patient_info.id,
-                                "birth_date": patient_info.birth_date.isoformat(),
-                                "gender": patient_info.gender,
-                                "ssn": patient_info.ssn,
-                                "first_name": patient_info.first_name,
-                                "last_name": patient_info.last_name,
-                                "city": patient_info.city,
-                                "state": patient_info.state,
-                                "country": patient_info.country,
-                                "postal_code": patient_info.postal_code,
-                                "age": patient_info.age,
-                                "creation_date":patient_info.creation_date.isoformat(),
-                            }
-                            patient_ref.set(patient_data)
-                            print(f"Added patient with ID {patient_id} to Firestore.")
-
-                    else:
-                        print("no patient info")
+            for result in file_results:
+                results.append(result)
+                if result.error:
+                    logging.error(
+                        f"An error occurred while processing {result.file}: {result.error}\n{result.traceback}"
+                    )
+                elif result.patient_info:
+                    pending_uploads.append(len(results) - 1)
+                    if len(pending_uploads) >= self.upload_batch_size:
+                        self.upload_results(results, pending_uploads)
+                        pending_uploads = []
+
+            self.upload_results(results, pending_uploads)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+            # Finishes the current batch file, or waits for background writes, before returning
+            self.output.close()
+
+        if self.skipped:
+            print(f"Skipped {self.skipped} unchanged file(s) already in the ledger.")
+
+        return results
+
+
+    def pending_files(self, fhir_files):
+        """Yields the fhir files which still need processing, counting those skipped by the ledger.
+
+        A file the ledger cannot check, e.g. one which has vanished, is passed on rather than ending the
+        run, so it is processed and any error is reported in its own FileResult."""
+        for file in fhir_files:
+            try:
+                processed = self.ledger and self.ledger.is_processed(file, self.messageType)
+            except Exception as e:
+                logging.error(f"Could not check {file} against the ledger: {type(e).__name__}: {e}")
+                processed = False
+            if processed:
+                self.skipped += 1
+                continue
+            yield file
+
+
+    def process_file_safely(self, file):
+        """Runs process_file without uploading and captures the outcome, including any error, as a FileResult."""
+        try:
+            patient_info = self.process_file(file, upload=False)
+            if patient_info:
+                return FileResult(str(file), patient_info.id, None, None, patient_info=patient_info, 
+                                  hl7_path=self.hl7_path)
+            return FileResult(str(file), None, None, None)
         except Exception as e:
-            logging.error(
-                f"An error of type {type(e).__name__} occurred. Arguments:\n{e.args}"
-            )
-            logging.error(traceback.format_exc())
+            return FileResult(str(file), None, f"{type(e).__name__}: {e}", traceback.format_exc())
+
+
+    def upload_results(self, results, positions):
+        """Uploads the patients held by results[positions] in one batch, then records each 
+        outcome in its FileResult and in the ledger. With upload off, the files are only recorded."""
+        if not positions:
+            return
+
+        outcomes = {}
+        if self.upload:
+            outcomes = save_patients_to_firestore(self.db, (results[i].patient_info for i in positions))
+
+        for i in positions:
+            result = results[i]
+            upload = outcomes.get(result.patient_id)
+            results[i] = result._replace(upload=upload, patient_info=None)
+            if self.ledger and (upload in ("added", "exists") or not self.upload):
+                self.ledger.record(result.file, self.messageType, result.patient_id, result.hl7_path)
+
+
+    def process_file(self, file, upload=True):
+        """
+        Parses a single fhir doc, writes its HL7 message, and uploads the patient info to firestore. 
+
+        Mandatory args: file: path to a fhir json file
+        Optional args: upload: bool, set to False when the caller uploads the patient itself
+        Returns the parsed PatientInfo, or None if the file held no patient
+        """
+        # At this point, patient_info has creation_date
+        patient_info = parse_fhir_file(self.db, file)
+        if patient_info:
+
+            # Writing hl7 message to file 
+            if self.engine == "template":
+                hl7_message = render_er7_message(patient_info, self.messageType)
+            elif self.messageType == "ADT_A01":
+                hl7_message = create_adt_message(patient_info, self.messageType)
+            elif self.messageType == "ORM_O01":
+                hl7_message = create_orm_message(patient_info, self.messageType)
+            elif self.messageType == "ORU_R01":
+                hl7_message = create_oru_message(patient_info, self.messageType)
+            print("Generated HL7 message:", str(hl7_message))
+            self.hl7_path = self.save_hl7_message_to_file(hl7_message, patient_info.id)
+
+            # Saving to firestore 
+            if upload:
+                save_to_firestore(db=self.db, patient_info=patient_info)
+
+        else:
+            print("no patient info")
+
+        return patient_info
 
 
     def save_hl7_message_to_file(self, hl7_message, patient_id):
-        hl7_file_path = self.hl7_folder_path / f"{patient_id}.hl7"
-        with open(hl7_file_path, "w") as hl7_file:
-            hl7_file.write(str(hl7_message.msh.value) + "\r")
-            if self.messageType in ["ADT_A01"]:
-                hl7_file.write(str(hl7_message.evn.value) + "\r")
-            hl7_file.write(str(hl7_message.pid.value) + "\r")
-            hl7_file.write(str(hl7_message.pv1.value) + "\r")
-            if self.messageType in ["ORU_R01", "ORM_O01"]:
-                #hl7_file.write(str(hl7_message.obx.value) + "\r")
-                hl7_file.write(str(hl7_message.orc.value) + "\r")
-                hl7_file.write(str(hl7_message.obr.value) + "\r")
+        """Writes an hl7apy message, or ER7 text from the template engine, through self.output 
+        and returns the path of the file it went to"""
+        if not isinstance(hl7_message, str):
+            hl7_message = message_to_er7(hl7_message, self.messageType)
+        return self.output.write(hl7_message, patient_id)
+
+
+# Per-process HL7MessageProcessor used by the worker pool in HL7MessageProcessor.main
+worker_processor = None
+worker_init_error = None
+
+
+def process_is_alive(pid):
+    # The pool reaps a dead worker before starting its replacement, so the dead worker's pid is gone by then
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def claim_worker_share(worker_shares):
+    """Takes the first share of the identifier spaces that no live worker holds, so a worker which 
+    replaces one that died takes over the dead worker's share and never a live worker's."""
+    with worker_shares.get_lock():
+        for share, pid in enumerate(worker_shares):
+            if not pid or not process_is_alive(pid):
+                worker_shares[share] = os.getpid()
+                return share
+    raise RuntimeError("Every share of the identifier spaces is held by a live worker")
+
+
+def init_worker_processor(hl7_folder_path, message_type, engine, output, worker_shares, upload=True):
+    """Creates the worker's own HL7MessageProcessor, and with it its own firestore client when patients 
+    are uploaded, and gives the worker its own share of the identifier spaces within this process's share."""
+    global worker_processor, worker_init_error
+    # A failing initializer would make the pool restart workers forever, so keep the error instead
+    try:
+        share = claim_worker_share(worker_shares)
+        index, count = identifier_partition()
+        partition_identifiers(index + count * share, count * len(worker_shares))
+
+        worker_processor = HL7MessageProcessor(hl7_folder_path, engine=engine, output=output, upload=upload)
+        worker_processor.messageType = message_type
+        # Each worker writes its own batch files; finish the last one when the worker exits
+        multiprocessing.util.Finalize(output, output.close, exitpriority=10)
+    except Exception as e:
+        worker_init_error = (f"{type(e).__name__}: {e}", traceback.format_exc())
+
+
+def process_file_in_worker(file):
+    if worker_init_error:
+        return FileResult(str(file), None, *worker_init_error)
+    return worker_processor.process_file_safely(file)
 
 
 def initialize_firestore() -> firestore.client:
@@ -211,57 +388,123 @@ def initialize_firestore() -> firestore.client:
             exit(1)
 
 
-def produce_ADT_A01_from_firestore(db: firestore.client, num_of_patients: int, lower: int, upper: int, peter_pan: bool) -> bool: 
+def stream_ADT_A01_from_firestore(db: firestore.client, num_of_patients: int, lower: int, upper: int, 
+                                  peter_pan: bool, cache = None, histogram = None) -> Iterator[tuple[PatientInfo, core.Message]]: 
+    """Yields an ADT_A01 message for each patient record retrieved from firestore, as each 
+    document arrives, so memory stays bounded and the first message is ready after one read. 
+
+    Args: 
+    - db: ``firestore.client``
+    - num_of_patients: ``int``
+    - lower: ``int``, youngest age
+    - upper: ``int``, oldest age
+    - peter_pan: ``bool``, whether patients keep the age they were created with
+    - cache: ``PatientCache``, optional local cache consulted before Firestore
+    - histogram: ``AgeHistogram``, optional counts of patients by age, used instead of a count query
+
+    Returns:
+    - ``Iterator[tuple[PatientInfo, core.Message]]``, each patient with its hl7apy message
+    """
+    for patient in iter_firestore_age_range(db, num_of_patients, lower, upper, peter_pan, cache=cache, histogram=histogram):
+        yield patient, create_adt_message(patient, "ADT_A01")
+
+
+def produce_ADT_A01_from_firestore(db: firestore.client, num_of_patients: int, lower: int, upper: int, peter_pan: bool, 
+                                   output = None, cache = None, histogram = None) -> bool: 
     """Produces an ADT_A01 message for each patient record retrieved from firestore. 
     
-    The HL7 messages are saved in the 'hl7_folder_path' using patientID as filename. 
+    The HL7 messages are saved in the 'hl7_folder_path' using patientID as filename, or 
+    through ``output``, e.g. an ``HL7BatchWriter`` to write FHS/BHS batch files. Each 
+    message is written as soon as its patient is read. Pass a ``PatientCache`` as ``cache`` to 
+    read patients already downloaded from disk. 
 
     """
-    patients: list[PatientInfo] = get_firestore_age_range(db, num_of_patients, lower, upper, peter_pan)
-
-    if patients:
-        for patient in patients: 
+    output = output or HL7FileWriter(hl7_folder_path)
+    if getattr(output, "hl7_folder_path", None):
+        use_identifier_store(output.hl7_folder_path)
+    produced = False
 
-            hl7_message = create_adt_message(patient, "ADT_A01")
+    try:
+        for patient, hl7_message in stream_ADT_A01_from_firestore(db, num_of_patients, lower, upper, peter_pan, cache, histogram): 
 
             # Testing purposes 
             print("Generated HL7 message:", str(hl7_message))
 
-            hl7_file_path = hl7_folder_path / f"{patient.id}.hl7"
-            with open(hl7_file_path, "w") as hl7_file:
-                hl7_file.write(str(hl7_message.msh.value) + "\r")
-                hl7_file.write(str(hl7_message.evn.value) + "\r")
-                hl7_file.write(str(hl7_message.pid.value) + "\r")
-                hl7_file.write(str(hl7_message.pv1.value) + "\r")
-        
-        return True 
-    else: 
-        return False 
+            output.write(message_to_er7(hl7_message, "ADT_A01"), patient.id)
+            produced = True
+    finally:
+        output.close()
 
+    return produced
 
-def produce_OML_O21_from_firestore(db: firestore.client, num_of_patients: int, age: int, assign_age: bool) -> bool: 
-    """Produces an OML_O21 message for each patient record retrieved from firestore. 
-    
-    The HL7 messages are saved in the 'hl7_folder_path' using patientID as filename. 
 
-    """
+def stream_OML_O21_from_firestore(db: firestore.client, num_of_patients: int, age: int, 
+                                  assign_age: bool, cache = None, histogram = None) -> Iterator[tuple[PatientInfo, core.Message]]: 
+    """Yields an OML_O21 message for each patient record retrieved from firestore, as each 
+    document arrives, so memory stays bounded and the first message is ready after one read. 
+
+    Args: 
+    - db: ``firestore.client``
+    - num_of_patients: ``int``
+    - age: ``int``
+    - assign_age: ``bool``, give every patient ``age``, whatever age they were stored with
+    - cache: ``PatientCache``, optional local cache consulted before Firestore
+    - histogram: ``AgeHistogram``, optional counts of patients by age, used instead of a count query
 
+    Returns:
+    - ``Iterator[tuple[PatientInfo, core.Message]]``, each patient with its hl7apy message
+    """
     if assign_age:
-        patients: list[PatientInfo] = get_firestore_age_range(db=db, num_of_patients=num_of_patients, lower=1, upper=100, peter_pan=True)
-        for i, patient in enumerate(patients): 
-            patient = assign_age_to_patient(patient_info=patient, desired_age=age, index=i)
+        patients = iter_firestore_age_range(db=db, num_of_patients=num_of_patients, lower=1, upper=100, peter_pan=True, 
+                                            cache=cache, histogram=histogram)
     else:
-        patients: list[PatientInfo] = get_firestore_age_range(db=db, num_of_patients=num_of_patients, lower=age, upper=age, peter_pan=True)
+        patients = iter_firestore_age_range(db=db, num_of_patients=num_of_patients, lower=age, upper=age, peter_pan=True, 
+                                            cache=cache, histogram=histogram)
+
+    for i, patient in enumerate(patients):
+        if assign_age:
+            patient = assign_age_to_patient(patient_info=patient, desired_age=age, index=i)
+        yield patient, create_oml_message(patient, "OML_O21")
+
+
+def produce_OML_O21_from_firestore(db: firestore.client, num_of_patients: int, age: int, assign_age: bool, 
+                                   output = None, cache = None, histogram = None) -> bool: 
+    """Produces an OML_O21 message for each patient record retrieved from firestore. 
+    
+    The HL7 messages are saved in the 'hl7_folder_path' using patientID as filename. If ``output`` 
+    is given, e.g. an ``MLLPSender``, each message is also written through it. Pass a 
+    ``PatientCache`` as ``cache`` to read patients already downloaded from disk. 
+
+    Returns the list of messages; use ``stream_OML_O21_from_firestore`` to avoid holding them all. 
+    """
 
     hl7_messages = []
 
-    for patient in patients:
-        hl7 = create_oml_message(patient, "OML_O21")
+    for patient, hl7 in stream_OML_O21_from_firestore(db, num_of_patients, age, assign_age, cache, histogram):
         hl7_messages.append(hl7)
+        if output:
+            output.write(message_to_er7(hl7, "OML_O21"), patient.id)
+
+    if output:
+        output.close()
     
     return hl7_messages
 
 
+def stream_patients_to_hl7(info: dict, message_type: str, db: firestore.client = None) -> None:
+    """Generates patients with Synthea and processes each FHIR bundle as soon as it is written, 
+    so parsing, HL7 building and upload overlap with generation. 
+
+    Args: 
+    - info: ``dict{number_of_patients, age_from, age_to, sex}``
+    - message_type: ``str``, one of ORU_R01, ADT_A01 or ORM_O01
+    - db: ``firestore.client``, optional initialised firestore client
+    """
+    processor = HL7MessageProcessor(hl7_folder_path, db)
+    fhir_files = stream_synthea(info["number_of_patients"], f"{info['age_from']}-{info['age_to']}", info["sex"])
+    processor.main(predetermined_message_type=message_type, fhir_files=fhir_files)
+
+
 if __name__ == "__main__":
     logging.basicConfig(filename="main.log", level=logging.INFO)
     import poll_synthea
@@ -270,5 +513,5 @@ if __name__ == "__main__":
 
     # Create an instance of HL7MessageProcessor and call its 'main' method
     hl7_folder = hl7_folder_path  # Make sure this path is correct
-    processor = HL7MessageProcessor(hl7_folder)
+    processor = HL7MessageProcessor(hl7_folder, ledger=ProcessingLedger())
     processor.main()
@@ -0,0 +1,412 @@
+# Author Paul Olphert 2023
+
+# This file contains an MLLP sender which delivers HL7 messages straight to an interface engine.
+# It keeps a pool of persistent TCP connections, allows several messages in flight on each one,
+# matches every ACK to its message by MSH-10 and resends messages which are NAKed.
+# MLLPSender has the same write/close methods as the writers in hl7_output.py, so it can be passed
+# as the output of HL7MessageProcessor or produce_ADT_A01_from_firestore.
+#
+# MLLPLoopbackServer is a local stand-in for an interface engine, used by the tests.
+
+import itertools
+import logging
+import socket
+import socketserver
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import Future
+from datetime import datetime
+
+# MLLP frame: <VT> message <FS><CR>
+START_BLOCK = b"\x0b"
+END_BLOCK = b"\x1c\r"
+
+ACCEPT_CODES = ("AA", "CA")
+# Errors which may clear on a resend; a reject (AR/CR) means the message must not be sent again
+RETRY_CODES = ("AE", "CE")
+
+# The acknowledgement for one message; code is the MSA-1 code, or None if it was never acknowledged
+MLLPAck = namedtuple("MLLPAck", ["control_id", "code", "text", "attempts"])
+
+
+def frame(message) -> bytes:
+    """Wraps an ER7 message in an MLLP frame."""
+    return START_BLOCK + message.encode() + END_BLOCK
+
+
+def read_frames(sock, keep_waiting=None):
+    """
+    Yields the messages framed in the data read from a socket, until it is closed. If a read times
+    out and keep_waiting() returns True, e.g. because nothing is waiting for a reply, it reads again.
+    """
+    buffer = b""
+    while True:
+        try:
+            data = sock.recv(65536)
+        except socket.timeout:
+            if keep_waiting is not None and keep_waiting():
+                continue
+            raise
+        if not data:
+            return
+        buffer += data
+        while True:
+            end = buffer.find(END_BLOCK)
+            if end == -1:
+                break
+            start = buffer.find(START_BLOCK, 0, end)
+            yield buffer[start + 1:end].decode()
+            buffer = buffer[end + len(END_BLOCK):]
+
+
+def get_segment_fields(message, segment):
+    """Returns the fields of the first segment with the given name, with fields[1] being field 1."""
+    for line in message.split("\r"):
+        if line.startswith(segment + "|"):
+            fields = line.split("|")
+            if segment == "MSH":
+                # MSH-1 is the field separator itself
+                fields.insert(1, "|")
+            return fields
+    return []
+
+
+# Returns MSH-10 of an ER7 message
+def get_control_id(message) -> str:
+    fields = get_segment_fields(message, "MSH")
+    return fields[10] if len(fields) > 10 else ""
+
+
+def build_ack(message, code="AA", text=""):
+    """Builds the ACK a receiver would send back for an ER7 message."""
+    msh = get_segment_fields(message, "MSH")
+    field = lambda i: msh[i] if len(msh) > i else ""
+    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+    return (
+        f"MSH|^~\\&|{field(5)}|{field(6)}|{field(3)}|{field(4)}|{timestamp}||ACK|ACK{field(10)}|{field(11)}|{field(12)}\r"
+        f"MSA|{code}|{field(10)}|{text}\r"
+    )
+
+
+class MLLPConnection:
+    """
+    One persistent MLLP connection with up to window messages in flight. A reader thread matches
+    each ACK to its message by MSA-2, resends messages answered with AE up to retries times and
+    resolves the message's Future with an MLLPAck. If the connection drops, or the receiver stops
+    answering for timeout seconds, it reconnects and resends everything still in flight; each
+    resend counts against retries, so a receiver which never answers fails the messages in the end.
+
+    Mandatory args: host: string, port: int
+    Optional args: window: int, retries: int, timeout: float, seconds to wait for the receiver
+    """
+
+    def __init__(self, host, port, window=8, retries=3, timeout=30):
+        self.host = host
+        self.port = port
+        self.window = threading.BoundedSemaphore(window)
+        self.retries = retries
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        # control id -> [message, future, attempts]
+        self.in_flight = {}
+        self.sock = None
+        self.closed = False
+        self.reader = None
+
+    def connect(self):
+        self.sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = threading.Thread(target=self.read_acks, args=(self.sock,), daemon=True)
+        self.reader.start()
+
+    def send(self, message) -> Future:
+        """Sends one message, blocking while the window is full, and returns a Future of its MLLPAck."""
+        control_id = get_control_id(message)
+        future = Future()
+        self.window.acquire()
+        with self.lock:
+            if control_id in self.in_flight:
+                self.window.release()
+                raise ValueError(f"Message {control_id} is already in flight; MSH-10 must be unique")
+            self.in_flight[control_id] = [message, future, 1]
+        try:
+            self.transmit(message)
+        except OSError:
+            self.reconnect()
+        return future
+
+    def transmit(self, message):
+        with self.send_lock:
+            if self.sock is None:
+                self.connect()
+            self.sock.sendall(frame(message))
+
+    def read_acks(self, sock):
+        try:
+            # An idle connection may time out; one with messages in flight has lost its receiver
+            for ack in read_frames(sock, keep_waiting=lambda: not self.in_flight):
+                msa = get_segment_fields(ack, "MSA")
+                if len(msa) < 3:
+                    logging.error(f"MLLP: ignoring a reply without MSA: {ack!r}")
+                    continue
+                self.acknowledge(msa[2], msa[1], msa[3] if len(msa) > 3 else "")
+        except OSError:
+            pass
+        if not self.closed and sock is self.sock:
+            self.reconnect()
+
+    def acknowledge(self, control_id, code, text):
+        with self.lock:
+            entry = self.in_flight.get(control_id)
+            if entry is None:
+                logging.error(f"MLLP: ACK for unknown message {control_id}")
+                return
+            message, future, attempts = entry
+            retry = code in RETRY_CODES and attempts <= self.retries
+            if retry:
+                entry[2] += 1
+            else:
+                del self.in_flight[control_id]
+
+        if retry:
+            logging.warning(f"MLLP: {code} for {control_id}, resending (attempt {attempts + 1})")
+            try:
+                self.transmit(message)
+            except OSError:
+                self.reconnect()
+        else:
+            self.window.release()
+            future.set_result(MLLPAck(control_id, code, text, attempts))
+
+    def reconnect(self):
+        """Opens a new connection and resends every message still in flight which has attempts left."""
+        with self.send_lock:
+            if self.sock is not None:
+                try:
+                    self.sock.close()
+                except OSError:
+                    pass
+                self.sock = None
+
+            for attempt in range(1, self.retries + 2):
+                if self.closed:
+                    break
+                try:
+                    self.connect()
+                    expired = []
+                    messages = []
+                    with self.lock:
+                        for control_id, entry in self.in_flight.items():
+                            if entry[2] > self.retries:
+                                expired.append(control_id)
+                            else:
+                                entry[2] += 1
+                                messages.append(entry[0])
+                    self.fail(expired, "no acknowledgement")
+                    for message in messages:
+                        self.sock.sendall(frame(message))
+                    return
+                except OSError as e:
+                    logging.error(f"MLLP: could not reconnect to {self.host}:{self.port}: {e}")
+                    self.sock = None
+                    time.sleep(min(2 ** attempt * 0.1, 5))
+
+        # Give up on everything in flight
+        self.fail(None, "connection lost")
+
+    def fail(self, control_ids, text):
+        """Resolves the messages still in flight with these control ids, or all of them if None, as never acknowledged."""
+        with self.lock:
+            if control_ids is None:
+                control_ids = list(self.in_flight)
+            failed = [(control_id, self.in_flight.pop(control_id)) for control_id in control_ids
+                      if control_id in self.in_flight]
+        for control_id, (message, future, attempts) in failed:
+            self.window.release()
+            future.set_result(MLLPAck(control_id, None, text, attempts))
+
+    def pending(self):
+        return len(self.in_flight)
+
+    def close(self):
+        self.closed = True
+        with self.send_lock:
+            if self.sock is not None:
+                self.sock.close()
+                self.sock = None
+
+
+class MLLPSender:
+    """
+    Delivers HL7 messages over a pool of persistent MLLP connections. Each message goes to the
+    connection with the fewest messages in flight.
+
+    write(message, patient_id) queues a message like the writers in hl7_output.py, and close waits
+    for every ACK and prints the delivery counts. send returns a Future of the message's MLLPAck.
+
+    Mandatory args: host: string, port: int
+    Optional args: connections: int, window: int, messages in flight per connection,
+    retries: int, times a NAKed message is resent, timeout: float
+    """
+
+    def __init__(self, host, port, connections=4, window=8, retries=3, timeout=30):
+        self.host = host
+        self.port = port
+        self.connection_count = connections
+        self.window = window
+        self.retries = retries
+        self.timeout = timeout
+        self.connections = []
+        self.started_at = None
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # Sent to worker processes without the sockets; each process opens its own connections
+        return {"host": self.host, "port": self.port, "connections": self.connection_count,
+                "window": self.window, "retries": self.retries, "timeout": self.timeout}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def start(self):
+        self.connections = [
+            MLLPConnection(self.host, self.port, self.window, self.retries, self.timeout)
+            for _ in range(self.connection_count)
+        ]
+        self.started_at = time.perf_counter()
+        # Only counts are kept, so a long run does not hold on to every acknowledgement
+        self.done = threading.Condition()
+        self.sent = 0
+        self.acknowledged = 0
+        self.accepted = 0
+        self.resent = 0
+        self.rejected = []
+
+    def send(self, message) -> Future:
+        with self.lock:
+            if not self.connections:
+                self.start()
+            connection = min(self.connections, key=MLLPConnection.pending)
+        future = connection.send(message)
+        with self.done:
+            self.sent += 1
+        future.add_done_callback(self.count_ack)
+        return future
+
+    def count_ack(self, future):
+        ack = future.result()
+        with self.done:
+            self.acknowledged += 1
+            if ack.code in ACCEPT_CODES:
+                self.accepted += 1
+            else:
+                self.rejected.append(ack)
+            if ack.attempts > 1:
+                self.resent += 1
+            self.done.notify_all()
+
+    def write(self, message, patient_id=None):
+        """Sends one message; there is no file, so None is returned as its path."""
+        self.send(message)
+        return None
+
+    def stats(self):
+        """Returns the messages sent, acknowledged, accepted and resent since the connections opened, and the rate."""
+        seconds = time.perf_counter() - self.started_at
+        return {
+            "sent": self.sent,
+            "acknowledged": self.acknowledged,
+            "accepted": self.accepted,
+            "resent": self.resent,
+            "seconds": seconds,
+            "messages_per_second": self.acknowledged / seconds if seconds else 0.0,
+        }
+
+    def close(self, timeout=None):
+        """
+        Waits for every message to be acknowledged, closes the connections and reports the results.
+        Messages still unacknowledged after timeout seconds, by default long enough for every retry
+        to time out, are given up on. Returns the MLLPAck of every message which was not accepted.
+        """
+        if not self.connections:
+            return []
+
+        if timeout is None:
+            timeout = self.timeout * (self.retries + 2)
+        with self.done:
+            finished = self.done.wait_for(lambda: self.acknowledged == self.sent, timeout)
+        for connection in self.connections:
+            connection.close()
+            if not finished:
+                connection.fail(None, "no acknowledgement before close")
+        self.connections = []
+
+        stats = self.stats()
+        print(f"Delivered {stats['accepted']} of {stats['sent']} messages to {self.host}:{self.port} in "
+              f"{stats['seconds']:.1f}s, {stats['messages_per_second']:.0f} messages/s, {stats['resent']} resent ✓")
+        if self.rejected:
+            print(f"x {len(self.rejected)} messages were not accepted, see the log")
+            for ack in self.rejected:
+                logging.error(f"MLLP: {ack.control_id} was not accepted: {ack.code} {ack.text}")
+        return self.rejected
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class MLLPLoopbackHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        server = self.server
+        for message in read_frames(self.request):
+            control_id = get_control_id(message)
+            with server.lock:
+                server.received.append(message)
+                attempt = server.attempts[control_id] = server.attempts.get(control_id, 0) + 1
+                number = next(server.counter)
+            if server.silent:
+                continue
+            if server.delay:
+                time.sleep(server.delay)
+            if server.nak_every and attempt == 1 and number % server.nak_every == 0:
+                ack = build_ack(message, server.nak_code, "loopback NAK")
+            else:
+                ack = build_ack(message, "AA")
+            self.request.sendall(frame(ack))
+
+
+class MLLPLoopbackServer(socketserver.ThreadingTCPServer):
+    """
+    A local MLLP receiver for tests. It ACKs every message with AA, except that when nak_every is
+    set, every nak_every-th message received is NAKed with nak_code on its first attempt.
+
+    Optional args: host: string, port: int, 0 picks a free port, nak_every: int, delay: float,
+    seconds to wait before each ACK, nak_code: string, AE or AR, silent: bool, never ACK at all
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=0, nak_every=None, delay=0, nak_code="AE", silent=False):
+        super().__init__((host, port), MLLPLoopbackHandler)
+        self.nak_every = nak_every
+        self.nak_code = nak_code
+        self.silent = silent
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.received = []
+        self.attempts = {}
+        self.counter = itertools.count(1)
+
+    def start(self):
+        """Serves from a background thread and returns (host, port)."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self.server_address
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
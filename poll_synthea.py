@@ -1,8 +1,14 @@
 # Author Paul Olphert 2023
 
+import errno
+import json
 import subprocess
 import shutil
 import os
+import random
+import threading
+import time
+from datetime import datetime
 from pathlib import Path
 
 BASE_DIR = Path.cwd()
@@ -16,8 +22,22 @@ work_fhir_folder_path = BASE_DIR / "Work"
 # Path to the metadata folder
 metadata_folder_path = BASE_DIR / "output/metadata"
 
+# Path to the per-run manifests written by run_synthea
+manifest_folder_path = work_fhir_folder_path / "manifests"
 
-def run_synthea(x,age, sex):
+# Path to the per-shard output folders used by run_synthea_sharded
+shard_output_folder_path = BASE_DIR / "output/shards"
+
+# Held while a file is moved into Work, so threads merging at once, e.g. the warm worker pool's
+# job handlers, never pick the same new name for colliding files
+work_folder_lock = threading.Lock()
+
+
+def build_synthea_command(x, age, sex, seed=None, base_directory=None):
+    """Builds the command line used to run Synthea.
+
+    Optional args: seed: int, base_directory: Path for the Synthea output folder
+    """
     # Command to run Synthea
     command = [
         "java",
@@ -42,89 +62,293 @@ def run_synthea(x,age, sex):
         "--exporter.fhir.use_synthea_extensions=false"
 
     ]
-    temp_count: int = 0
-    work_count: int = 0
+
+    if seed is not None:
+        command[3:3] = ["-s", str(seed)]
+    if base_directory is not None:
+        command.append(f"--exporter.baseDirectory={base_directory}")
+
+    return command
+
+
+class RunManifest:
+    """
+    Records which FHIR files a single Synthea run produced, which were trimmed as extra, 
+    and where each file was moved in the Work folder. Counts and extra/missing reporting 
+    come from the manifest rather than from scanning the output and Work folders.
+
+    Mandatory args: requested: int, the number of patients asked for
+    """
+
+    def __init__(self, requested, age=None, sex=None):
+        self.run_id = datetime.now().strftime("%Y%m%d%H%M%S%f")
+        self.requested = requested
+        self.age = age
+        self.sex = sex
+        self.produced: list[str] = []
+        self.trimmed: list[str] = []
+        # Work file name -> the output file it was moved from
+        self.moved: dict[str, str] = {}
+
+    @property
+    def extra(self):
+        return len(self.trimmed)
+
+    @property
+    def missing(self):
+        return max(0, self.requested - len(self.moved))
+
+    def save(self):
+        """Writes the manifest to Work/manifests/<run_id>.json and returns its path."""
+        os.makedirs(manifest_folder_path, exist_ok=True)
+        manifest_path = manifest_folder_path / f"{self.run_id}.json"
+        with open(manifest_path, "w") as manifest_file:
+            json.dump({
+                "run_id": self.run_id,
+                "requested": self.requested,
+                "age": self.age,
+                "sex": self.sex,
+                "produced": self.produced,
+                "trimmed": self.trimmed,
+                "moved": self.moved,
+            }, manifest_file, indent=2)
+        return manifest_path
+
+    def report(self):
+        print("output from synthea completed ✓ \n total output = ", len(self.produced))
+        if self.extra:
+            print(self.extra, " files extra than requested have been removed")
+        print(len(self.moved), " new files added to work ✓ ")
+        if self.missing:
+            print(self.missing, " files less than requested have been added")
+
+
+def run_synthea(x,age, sex):
+    command = build_synthea_command(x, age, sex)
+    manifest = RunManifest(x, age, sex)
 
     # Run the synthea command
     subprocess.run(command)
 
-    # Ensure the Work folder exists
-    os.makedirs(work_fhir_folder_path, exist_ok=True)
-
     # Check if Temp_Work/fhir folder exists
     if os.path.exists(output_fhir_folder_path):
         print("checking synthea-ouput completed successfully...")
 
-    # Count and keep a record of number of json files in output
-    for file in output_fhir_folder_path.glob("*.json"):
-        if not file.exists():
-            pass
-        else:
-            temp_count += 1
-
-    print("output from synthea completed ✓ \n total output = ", temp_count)
-
-    # remove extra patient files if generated
-    if temp_count > x != 1:
-        for files in output_fhir_folder_path.glob("*.json"):
-            if not files.exists():
-                pass
-            else:
-                while temp_count > x:
-                    if not files.exists():
-                        pass
-                    else:
-                        os.remove(files)
-                    temp_count -= 1
-
-    # Count the number of files already in the Work folder before this run
-    existing_files_count = len(list(work_fhir_folder_path.glob("*.json")))
-
-    # Copy contents of temporary fhir folder to Work fhir folder
-    if os.path.exists(output_fhir_folder_path):
-        for item in os.listdir(output_fhir_folder_path):
-            source_path = os.path.join(output_fhir_folder_path, item)
-            dest_path = os.path.join(work_fhir_folder_path, item)
-            shutil.copy2(source_path, dest_path)
-        print("Copied to Work folder successfully ✓")
-
-        # Clean up temporary fhir folder
-        shutil.rmtree(os.path.join(output_fhir_folder_path))
+        # Move contents of the output fhir folder to the Work folder
+        merge_into_work(output_fhir_folder_path, x, "run", manifest)
         print("Transferred files to Work folder successfully ✓")
+
+        # Clean up output fhir folder
+        shutil.rmtree(output_fhir_folder_path)
     else:
         print("No files found in Temp_Work/fhir x")
         print("Temp_Work/fhir folder not found x")
 
-    # Clean up output fhir folder (remove only files)
-    if os.path.exists(output_fhir_folder_path):
-        for item in os.listdir(output_fhir_folder_path):
-            item_path = os.path.join(output_fhir_folder_path, item)
-            if os.path.isfile(item_path):
-                os.remove(item_path)
-
     # Clean up metadata folder
     if os.path.exists(metadata_folder_path):
         shutil.rmtree(metadata_folder_path)
 
-    # count the number of files created in Work
-    for file in work_fhir_folder_path.glob("*.json"):
-        if file.exists():
-            work_count += 1
+    manifest.save()
+    manifest.report()
 
-    print("files in Work  = ", work_count)
+    print("Done! ✓ ")
 
-    if work_count < temp_count:
-        print("incomplete transfer missing ", temp_count - work_count, "files x")
-    else:
-        if work_count > temp_count:
-            # Calculate the difference between the number of files in Work before and after this run
-            new_files_added = work_count - existing_files_count
-            print(new_files_added, " new files added to work ✓ ")
-            if new_files_added > x:
-                print(new_files_added - x, " files extra than requested have been added")
-            else:
-                if x > new_files_added:
-                    print(x - new_files_added, " files less than requested have been added")
+
+def is_complete_bundle(path, tail_size=64):
+    """
+    Returns whether a FHIR file ends with the closing brace of its bundle, i.e. Synthea has finished 
+    writing it. A stable size alone is not enough, as Synthea can pause part way through a large bundle. 
+    Only the last ``tail_size`` bytes are read, so the bundle is not parsed twice.
+    """
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(f.tell() - tail_size, 0))
+        return f.read().rstrip().endswith(b"}")
+
+
+def stream_synthea(x, age, sex, poll_interval=0.5):
+    """
+    Runs Synthea and yields each finished FHIR bundle as soon as it has been moved into the 
+    Work folder, while Synthea keeps generating the rest. While Synthea runs, a bundle counts 
+    as finished once its size has stopped changing between two polls and it ends with the bundle's 
+    closing brace; any other bundle is checked again at the next poll. Once Synthea has 
+    exited every bundle is finished.
+
+    Optional args: poll_interval: float, seconds between scans of the output folder
+    """
+    if os.path.exists(output_fhir_folder_path):
+        shutil.rmtree(output_fhir_folder_path)
+
+    process = subprocess.Popen(build_synthea_command(x, age, sex))
+    manifest = RunManifest(x, age, sex)
+
+    seen_sizes = {}
+    yielded = 0
+    try:
+        while yielded < x:
+            finished = process.poll() is not None
+
+            ready = []
+            if os.path.exists(output_fhir_folder_path):
+                for entry in os.scandir(output_fhir_folder_path):
+                    if not entry.name.endswith(".json"):
+                        continue
+                    size = entry.stat().st_size
+                    if finished or (size > 0 and seen_sizes.get(entry.name) == size and is_complete_bundle(entry.path)):
+                        ready.append(Path(entry.path))
+                    seen_sizes[entry.name] = size
+
+            for source_path in sorted(ready):
+                if yielded >= x:
+                    break
+                manifest.produced.append(source_path.name)
+                dest_path = transfer_to_work(source_path, "stream", manifest)
+                del seen_sizes[source_path.name]
+                yielded += 1
+                yield dest_path
+
+            if finished:
+                break
+
+            time.sleep(poll_interval)
+    finally:
+        # Stop generating if the consumer is done with the stream
+        if process.poll() is None:
+            process.terminate()
+        process.wait()
+
+        # Anything left in the output folder is beyond the requested number
+        if os.path.exists(output_fhir_folder_path):
+            manifest.trimmed.extend(entry.name for entry in os.scandir(output_fhir_folder_path) 
+                                    if entry.name.endswith(".json"))
+            manifest.produced.extend(manifest.trimmed)
+            shutil.rmtree(output_fhir_folder_path)
+        if os.path.exists(metadata_folder_path):
+            shutil.rmtree(metadata_folder_path)
+
+        manifest.save()
+
+    manifest.report()
+
+
+def transfer_to_work(source_path, tag, manifest=None):
+    """
+    Moves a single FHIR file into the Work folder, renaming it using tag if it would 
+    overwrite an existing file. Returns the new path in Work.
+
+    The file is hard linked into Work and then unlinked from the output folder, so it is 
+    never copied and an existing file in Work is never replaced. If the folders are on 
+    different filesystems the file is copied instead.
+    """
+    # Ensure the Work folder exists
+    os.makedirs(work_fhir_folder_path, exist_ok=True)
+
+    dest_path = work_fhir_folder_path / source_path.name
+    copy_number = 0
+    with work_folder_lock:
+        while True:
+            try:
+                os.link(source_path, dest_path)
+                os.remove(source_path)
+                break
+            except FileExistsError:
+                copy_number += 1
+                dest_path = work_fhir_folder_path / f"{source_path.stem}_{tag}_{copy_number}{source_path.suffix}"
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.ENOTSUP):
+                    raise
+                # Cross-device or no hard link support; fall back to copying
+                if os.path.exists(dest_path):
+                    copy_number += 1
+                    dest_path = work_fhir_folder_path / f"{source_path.stem}_{tag}_{copy_number}{source_path.suffix}"
+                    continue
+                shutil.move(source_path, dest_path)
+                break
+
+    if manifest is not None:
+        manifest.moved[dest_path.name] = str(source_path)
+
+    return dest_path
+
+
+def split_population(x, shards):
+    """Splits x patients as evenly as possible across a number of shards."""
+    shards = max(1, min(shards, x))
+    return [x // shards + (1 if i < x % shards else 0) for i in range(shards)]
+
+
+def merge_into_work(fhir_folder_path, expected_count, tag, manifest=None):
+    """
+    Moves up to expected_count FHIR files from fhir_folder_path into the Work folder, 
+    renaming any file that would overwrite an existing one using tag. Extra files are removed. 
+
+    Optional args: manifest: RunManifest recording the produced, trimmed and moved files
+    Returns the list of paths created in Work.
+    """
+    fhir_files = sorted(entry.name for entry in os.scandir(fhir_folder_path) if entry.name.endswith(".json"))
+
+    # remove extra patient files if generated
+    for extra_file in fhir_files[expected_count:]:
+        os.remove(Path(fhir_folder_path) / extra_file)
+
+    if manifest is not None:
+        manifest.produced.extend(fhir_files)
+        manifest.trimmed.extend(fhir_files[expected_count:])
+
+    return [transfer_to_work(Path(fhir_folder_path) / name, tag, manifest) for name in fhir_files[:expected_count]]
+
+
+def run_synthea_sharded(x, age, sex, shards=None, seed=None):
+    """
+    Splits the requested population into shards and runs one Synthea process per shard 
+    at the same time. Each shard has its own seed and output directory, and the results 
+    are merged into the Work folder without overwriting existing files.
+
+    Optional args: shards: int (defaults to the number of cores), seed: int
+    """
+    if x <= 0:
+        print("No patients requested x")
+        return
+
+    if not shards:
+        shards = os.cpu_count() or 1
+
+    if seed is None:
+        seed = random.randrange(1, 2**31 - 1)
+
+    shard_sizes = split_population(x, shards)
+    print(f"Running Synthea in {len(shard_sizes)} shard(s) of {shard_sizes}")
+
+    # Start every shard before waiting on any of them
+    processes = []
+    for shard, shard_size in enumerate(shard_sizes):
+        shard_folder_path = shard_output_folder_path / f"shard_{shard}"
+        if os.path.exists(shard_folder_path):
+            shutil.rmtree(shard_folder_path)
+        command = build_synthea_command(shard_size, age, sex, seed=seed + shard, base_directory=shard_folder_path)
+        processes.append((shard, shard_size, shard_folder_path, subprocess.Popen(command)))
+
+    for shard, _, _, process in processes:
+        if process.wait() != 0:
+            print(f"shard {shard} exited with code {process.returncode} x")
+
+    manifest = RunManifest(x, age, sex)
+    for shard, shard_size, shard_folder_path, _ in processes:
+        shard_fhir_folder_path = shard_folder_path / "fhir"
+        if not os.path.exists(shard_fhir_folder_path):
+            print(f"No output found for shard {shard} x")
+            continue
+
+        moved = merge_into_work(shard_fhir_folder_path, shard_size, f"shard{shard}", manifest)
+
+        print(f"shard {shard}: {len(moved)} of {shard_size} files moved to Work ✓")
+
+    # Clean up the shard output folders
+    if os.path.exists(shard_output_folder_path):
+        shutil.rmtree(shard_output_folder_path)
+
+    manifest.save()
+    manifest.report()
 
     print("Done! ✓ ")
 
@@ -186,12 +410,16 @@ def get_valid_sex_input():
             print("Please enter M or F")
         
 
-def call_for_patients(info=None):
+def call_for_patients(info=None, sharded=False, shards=None, worker=None):
     """
     Generates a number of patients of a certain sex within an age range 
 
-    Optional args: info: dict{number_of_patients, age_from, age_to, sex}
+    Optional args: info: dict{number_of_patients, age_from, age_to, sex}, 
+    sharded: bool to run several Synthea processes at once, shards: int (defaults to the number of cores), 
+    worker: "host:port" of a warm synthea_worker pool (defaults to the POLL_SYNTHEA_WORKER environment variable)
     """
+    if worker is None:
+        worker = os.environ.get("POLL_SYNTHEA_WORKER")
 
     if info:
         number_of_patients = info["number_of_patients"]
@@ -209,7 +437,20 @@ def call_for_patients(info=None):
 
     print(age)
     print(sex)
-    run_synthea(number_of_patients, age, sex)
+    if worker:
+        from .synthea_worker import request_patients
+        try:
+            files = request_patients({"number_of_patients": number_of_patients, "age_from": age_from, 
+                                      "age_to": age_to, "sex": sex}, worker)
+            print(len(files), " new files added to work by the Synthea worker ✓ ")
+            return
+        except OSError as e:
+            print(f"Synthea worker at {worker} is unavailable ({e}), starting Synthea instead x")
+
+    if sharded:
+        run_synthea_sharded(number_of_patients, age, sex, shards=shards)
+    else:
+        run_synthea(number_of_patients, age, sex)
 
 
 # call_for_patients()
\ No newline at end of file
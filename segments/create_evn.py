@@ -6,12 +6,16 @@ import traceback
 from ..generators.utilities import create_obr_time
 
 
+EVN_STATIC_FIELDS = {"evn_1": "A03"}
+
+
 # Creates a OBR segment for the HL7 message requires a patient_info object and the hl7 message
-def create_evn(hl7):
+def create_evn(hl7, static_fields=True):
     try:
         request_date = create_obr_time()
 
-        hl7.evn.evn_1 = "A03"
+        if static_fields:
+            hl7.evn.evn_1 = EVN_STATIC_FIELDS["evn_1"]
         hl7.evn.evn_2 = request_date
         
     except Exception as ae:
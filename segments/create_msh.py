@@ -8,27 +8,38 @@ from pathlib import Path
 from hl7apy import core
 
 
-def create_msh(messageType, control_id, hl7, current_date):
+# The MSH fields which only depend on the message type
+def msh_static_fields(messageType):
+    # convert the message type to a string replacing the underscore with ^
+    messageTypeSegment = str(messageType)
+    messageTypeSegment = messageTypeSegment.replace("_", "^")
+
+    return {
+        "msh_3": "ULTRA",  # Sending Application
+        "msh_4": "TEST",  # Sending Facility
+        "msh_5": "ULTRA",  # Receiving Application
+        "msh_6": "NUFFIELD",  # Receiving Facility
+        "msh_9": messageTypeSegment,  # Message Type
+        "msh_11": "T",  # Processing ID
+        "msh_12": "2.4",  # Version ID
+        "msh_15": "AL",  # Accept Acknowledgment Type
+        "msh_16": "NE",  # Application Acknowledgment Type
+    }
+
+
+# static_fields is False when the message comes from a MessageSkeleton which already holds them
+def create_msh(messageType, control_id, hl7, current_date, static_fields=True):
 # Initialize msh to None
     msh = None
 
     # Add MSH Segment
     try:
-        # convert the message type to a string replacing the underscore with ^
-        messageTypeSegment = str(messageType)
-        messageTypeSegment = messageTypeSegment.replace("_", "^")
-
-        hl7.msh.msh_3 = "ULTRA"  # Sending Application
-        hl7.msh.msh_4 = "TEST"  # Sending Facility
-        hl7.msh.msh_5 = "ULTRA"  # Receiving Application
-        hl7.msh.msh_6 = "NUFFIELD"  # Receiving Facility
+        if static_fields:
+            for name, value in msh_static_fields(messageType).items():
+                setattr(hl7.msh, name, value)
+
         hl7.msh.msh_7 = current_date.strftime("%Y%m%d%H%M")  # Date/Time of Message
-        hl7.msh.msh_9 = messageTypeSegment  # Message Type
         hl7.msh.msh_10 = control_id  # Message Control ID
-        hl7.msh.msh_11 = "T"  # Processing ID
-        hl7.msh.msh_12 = "2.4"  # Version ID
-        hl7.msh.msh_15 = "AL"  # Accept Acknowledgment Type
-        hl7.msh.msh_16 = "NE"  # Application Acknowledgment Type
     except Exception as ae:
         print("An AssertionError occurred:", ae)
         print(f"Could not create MSH Segment: {ae}")
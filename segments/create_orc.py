@@ -5,10 +5,14 @@ import logging
 import traceback
 
 
+ORC_STATIC_FIELDS = {"orc_1": "O"}  # New Order
+
+
 # creates a ORC segment for the HL7 message requires a patient_info object and the hl7 message
-def create_orc(hl7, placer_order_num, filler_order_id):
+def create_orc(hl7, placer_order_num, filler_order_id, static_fields=True):
     try:
-        hl7.orc.orc_1 = "O"  # New Order
+        if static_fields:
+            hl7.orc.orc_1 = ORC_STATIC_FIELDS["orc_1"]
         hl7.orc.orc_2 = placer_order_num  # Some dummy placer order ID up to 75 characters
         hl7.orc.orc_3 = filler_order_id  # Some dummy filler order ID up to 75 characters
     except Exception as ae:
@@ -5,17 +5,26 @@ import logging
 import traceback
 from ..generators.utilities import create_visit_number, create_visit_instiution, PatientInfo
 
+PID_STATIC_FIELDS = {"pid_1": "1"}
+
+
 # Creates a PID segment for the HL7 message requires a patient_info object and the hl7 message
-def create_pid(patient_info:PatientInfo, hl7):
+def create_pid(patient_info:PatientInfo, hl7, static_fields=True):
     try:
-       hl7.pid.pid_1 = "1"
-       hl7.pid.pid_3 = patient_info.hl7v2_id
+       if static_fields:
+           hl7.pid.pid_1 = PID_STATIC_FIELDS["pid_1"]
+       hl7v2_id = patient_info.hl7v2_id
+       # patients read back from firestore hold a list of ids; the first is the current one
+       if isinstance(hl7v2_id, list):
+           hl7v2_id = hl7v2_id[0]
+       hl7.pid.pid_3 = hl7v2_id
        # PID 3 defaults to P
        #hl7.pid.pid_3 = patient_info.id
        hl7.pid.pid_5 = f"{patient_info.last_name}^{patient_info.first_name}^{patient_info.middle_name}"
        hl7.pid.pid_7 = patient_info.birth_date.strftime("%Y%m%d")
        hl7.pid.pid_8 = patient_info.gender[0].upper()
-       hl7.pid.pid_11 = f"^^^{patient_info.city}^{patient_info.state}^{patient_info.postal_code}^{patient_info.country}"
+       # pid 11 - street^other^city^state^post code^country
+       hl7.pid.pid_11 = f"{patient_info.address}^{patient_info.address_2 or ''}^{patient_info.city}^^{patient_info.post_code}^{patient_info.country}"
        visitNo = create_visit_number()
        visitInstitution = create_visit_instiution()
        #pid 18 - 1 component 1 COMMON.Visit.num  2 component 1 lab.Request.bill_number 3 component 4 COMMON.Visit.institution 
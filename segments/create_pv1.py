@@ -7,15 +7,22 @@ from ..generators.utilities import create_visit_instiution
 
 
 
+PV1_STATIC_FIELDS = {
+    "pv1_1": "1",  # Set Patient Class to Inpatient
+    "pv1_2": "O",  # Set Visit Number
+    "pv1_7": "^ACON",  # Set Patient Class to Inpatient
+    "pv1_8": "^ANAESTHETICS CONS^^^^^^L",  # Set Patient Type to Ambulatory
+    "pv1_9": "^ANAESTHETICS CONS^^^^^^^AUSHICPR",
+}
+
+
 # Creates a PV1 segment for the HL7 message requires a patient_info object and the hl7 message
-def create_pv1(patient_info, hl7):
+def create_pv1(patient_info, hl7, static_fields=True):
     try:
-        hl7.pv1.pv1_1 = "1"  # Set Patient Class to Inpatient
-        hl7.pv1.pv1_2 = "O"  # Set Visit Number
+        if static_fields:
+            for name, value in PV1_STATIC_FIELDS.items():
+                setattr(hl7.pv1, name, value)
         hl7.pv1.pv1_3 = create_visit_instiution()  # Set Visit Institution
-        hl7.pv1.pv1_7 = "^ACON"  # Set Patient Class to Inpatient
-        hl7.pv1.pv1_8 = "^ANAESTHETICS CONS^^^^^^L"  # Set Patient Type to Ambulatory
-        hl7.pv1.pv1_9 = "^ANAESTHETICS CONS^^^^^^^AUSHICPR"
     except Exception as ae:
         print("An AssertionError occurred:", ae)
         print(f"Could not create PV1 Segment: {ae}")
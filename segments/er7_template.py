@@ -0,0 +1,122 @@
+# Author: Paul Olphert 2023
+
+# This file contains a template engine which writes HL7 messages straight to ER7 text. Each message
+# type's segment layout is compiled once into a format string, so a message is built by formatting
+# the patient's values into it rather than building an hl7apy Message field by field.
+# The output is byte-identical to create_*_message in main.py followed by message_to_er7.
+from datetime import date
+from ..generators.utilities import create_control_id, create_filler_order_num, create_obr_time, \
+    create_placer_order_num, create_visit_instiution, create_visit_number, PatientInfo
+
+# Segments written for each message type, in order
+MESSAGE_LAYOUTS = {
+    "ADT_A01": ("MSH", "EVN", "PID", "PV1"),
+    "ORM_O01": ("MSH", "PID", "PV1", "ORC", "OBR"),
+    "ORU_R01": ("MSH", "PID", "PV1", "ORC", "OBR"),
+    "OML_O21": ("MSH", "PID", "ORC", "OBR"),
+}
+
+# Field number -> value for each segment, mirroring segments/create_*.py. {name} is filled in per message.
+SEGMENT_FIELDS = {
+    "MSH": {3: "ULTRA", 4: "TEST", 5: "ULTRA", 6: "NUFFIELD", 7: "{message_date}", 9: "{message_type}",
+            10: "{control_id}", 11: "T", 12: "2.4", 15: "AL", 16: "NE"},
+    "EVN": {1: "A03", 2: "{event_date}"},
+    "PID": {1: "1", 3: "{hl7v2_id}", 5: "{patient_name}", 7: "{birth_date}", 8: "{gender}",
+            11: "{patient_address}", 18: "{visit}"},
+    "PV1": {1: "1", 2: "O", 3: "{visit_institution}", 7: "^ACON", 8: "^ANAESTHETICS CONS^^^^^^L",
+            9: "^ANAESTHETICS CONS^^^^^^^AUSHICPR"},
+    "ORC": {1: "O", 2: "{placer_order_num}", 3: "{filler_order_id}"},
+    "OBR": {1: "1", 2: "{placer_order_num}", 3: "{filler_order_id}", 4: "{patient_id}", 6: "{request_date}",
+            7: "{observation_date}", 16: "WACON^TEST", 24: "BI^UHC", 27: "^^^{quantity_timing}^^E"},
+}
+
+# The OML filler order id is fixed rather than generated
+OML_FILLER_ORDER_ID = "24325-3^Liver^Function^Test"
+
+
+# Escapes the ER7 delimiters which hl7apy escapes when a field is assigned
+def escape_er7(value) -> str:
+    value = str(value)
+    if "\\" in value or "|" in value or "~" in value:
+        return value.replace("\\", "\\E\\").replace("|", "\\F\\").replace("~", "\\R\\")
+    return value
+
+
+# Builds an ER7 field from components, dropping trailing empty components as hl7apy does
+def er7_field(*components) -> str:
+    return "^".join(escape_er7(component) for component in components).rstrip("^")
+
+
+# Compiles a segment's fields into a single format string
+def compile_segment(segment) -> str:
+    fields = SEGMENT_FIELDS[segment]
+    if segment == "MSH":
+        # MSH-1 is the field separator itself and MSH-2 the encoding characters
+        return "MSH|^~\\&|" + "|".join(fields.get(i, "") for i in range(3, max(fields) + 1))
+    return "|".join([segment] + [fields.get(i, "") for i in range(1, max(fields) + 1)])
+
+
+# Compiles a message type into one format string, each segment ending in a carriage return
+def compile_message_template(messageType) -> str:
+    return "".join(compile_segment(segment) + "\r" for segment in MESSAGE_LAYOUTS[messageType])
+
+
+MESSAGE_TEMPLATES = {messageType: compile_message_template(messageType) for messageType in MESSAGE_LAYOUTS}
+
+
+def generate_message_values(messageType) -> dict:
+    """Generates the random ids and dates for one message.
+
+    They are generated in the same order as create_*_message in main.py, so both engines give the
+    same message for the same random seed.
+    """
+    values = {"control_id": create_control_id()}
+    if messageType == "ADT_A01":
+        values["event_date"] = create_obr_time()
+    values["visit"] = er7_field(create_visit_number(), create_visit_instiution())
+    if messageType != "OML_O21":
+        values["visit_institution"] = create_visit_instiution()
+    if messageType in ("ORM_O01", "ORU_R01", "OML_O21"):
+        values["placer_order_num"] = create_placer_order_num()
+        if messageType == "OML_O21":
+            values["filler_order_id"] = OML_FILLER_ORDER_ID
+        else:
+            values["filler_order_id"] = create_filler_order_num()
+        values["request_date"] = create_obr_time()
+        values["observation_date"] = create_obr_time()
+        values["quantity_timing"] = create_obr_time()
+    return values
+
+
+def render_er7_message(patient_info: PatientInfo, messageType, values=None, current_date=None) -> str:
+    """Formats a patient into the compiled template for a message type.
+
+    Args:
+    - patient_info: ``PatientInfo``
+    - messageType: ``str``, one of ``ADT_A01``, ``ORM_O01``, ``ORU_R01`` or ``OML_O21``
+    - values: ``dict``, ids and dates from ``generate_message_values``; generated when not given
+    - current_date: ``date``, message date, defaults to today
+
+    Returns:
+    - message: ``str``, the ER7 message with each segment ending in a carriage return
+    """
+    if values is None:
+        values = generate_message_values(messageType)
+
+    hl7v2_id = patient_info.hl7v2_id
+    if isinstance(hl7v2_id, list):
+        hl7v2_id = hl7v2_id[0]
+
+    return MESSAGE_TEMPLATES[messageType].format_map({
+        **values,
+        "message_date": (current_date or date.today()).strftime("%Y%m%d%H%M"),
+        "message_type": messageType.replace("_", "^"),
+        "control_id": escape_er7(values["control_id"]),
+        "hl7v2_id": er7_field(hl7v2_id),
+        "patient_name": er7_field(patient_info.last_name, patient_info.first_name, patient_info.middle_name),
+        "birth_date": patient_info.birth_date.strftime("%Y%m%d"),
+        "gender": patient_info.gender[0].upper(),
+        "patient_address": er7_field(patient_info.address, patient_info.address_2 or "", patient_info.city, "",
+                                     patient_info.post_code, patient_info.country),
+        "patient_id": er7_field(patient_info.id),
+    })
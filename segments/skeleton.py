@@ -0,0 +1,70 @@
+# Author: Paul Olphert 2023
+
+# This file contains a cache of hl7apy message skeletons, one per message type. The static fields
+# of each segment (the same for every patient) are parsed by hl7apy once, and every new message
+# is given those parsed fields instead of building them again from strings.
+from hl7apy import core
+from .create_msh import msh_static_fields
+from .create_evn import EVN_STATIC_FIELDS
+from .create_pid import PID_STATIC_FIELDS
+from .create_pv1 import PV1_STATIC_FIELDS
+from .create_orc import ORC_STATIC_FIELDS
+from .create_obr import OBR_STATIC_FIELDS
+from .er7_template import MESSAGE_LAYOUTS
+
+SEGMENT_STATIC_FIELDS = {
+    "EVN": EVN_STATIC_FIELDS,
+    "PID": PID_STATIC_FIELDS,
+    "PV1": PV1_STATIC_FIELDS,
+    "ORC": ORC_STATIC_FIELDS,
+    "OBR": OBR_STATIC_FIELDS,
+}
+
+
+class MessageSkeleton:
+    """The static fields of one message type, parsed once by hl7apy.
+
+    ``new_message`` returns an hl7apy Message holding the static fields, ready for the
+    segments/create_*.py functions to fill in the patient's fields with ``static_fields=False``.
+    The static field objects are shared by every message made from the skeleton, so they must
+    be treated as read only; the variable fields belong to each message.
+
+    Args:
+    - messageType: ``str``, e.g. ``ORU_R01``
+    - version: ``str``, HL7 version
+    """
+    def __init__(self, messageType, version="2.4"):
+        self.messageType = messageType
+        self.version = version
+
+        static_fields = {"MSH": msh_static_fields(messageType)}
+        for segment in MESSAGE_LAYOUTS[messageType]:
+            if segment in SEGMENT_STATIC_FIELDS:
+                static_fields[segment] = SEGMENT_STATIC_FIELDS[segment]
+
+        # Parse every static field once and keep the parsed hl7apy Field
+        prototype = core.Message(messageType, version=version)
+        self.fields = []
+        for segment, fields in static_fields.items():
+            for name, value in fields.items():
+                setattr(getattr(prototype, segment.lower()), name, value)
+                self.fields.append((segment.lower(), name, getattr(getattr(prototype, segment.lower()), name)[0]))
+
+
+    def new_message(self):
+        """Returns a new hl7apy Message which already holds the static fields."""
+        hl7 = core.Message(self.messageType, version=self.version)
+        for segment, name, field in self.fields:
+            setattr(getattr(hl7, segment), name, field)
+        return hl7
+
+
+# Skeletons built so far, by message type
+message_skeletons = {}
+
+
+def get_message_skeleton(messageType) -> MessageSkeleton:
+    """Returns the cached skeleton for a message type, building it on first use."""
+    if messageType not in message_skeletons:
+        message_skeletons[messageType] = MessageSkeleton(messageType)
+    return message_skeletons[messageType]
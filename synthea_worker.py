@@ -0,0 +1,244 @@
+# Author Paul Olphert 2023
+
+# This file contains a long-lived Synthea worker pool. Each worker keeps a JVM with Synthea
+# loaded (through jshell) so that generation jobs do not pay JVM start up and module loading.
+# Jobs are accepted as JSON lines over a local socket.
+#
+# Start the pool with:  python -m poll_synthea.synthea_worker --port 8765 --workers 2
+# and point call_for_patients at it with the POLL_SYNTHEA_WORKER=127.0.0.1:8765 environment variable.
+
+import argparse
+import itertools
+import json
+import os
+import queue
+import shutil
+import socket
+import socketserver
+import subprocess
+import uuid
+from .poll_synthea import BASE_DIR, RunManifest, build_synthea_command, merge_into_work
+
+# Path to the per-job output folders used by the workers
+worker_output_folder_path = BASE_DIR / "output/workers"
+
+SYNTHEA_JAR = "synthea-with-dependencies.jar"
+
+JOB_OK = "__SYNTHEA_JOB_OK__"
+JOB_FAILED = "__SYNTHEA_JOB_FAILED__"
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+
+
+def java_string(value):
+    """Quotes a python string as a java string literal."""
+    return '"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def java_sentinel(sentinel, job_id):
+    """
+    Returns java code printing "<sentinel> <job_id>". The sentinel is split in two and joined at
+    run time, so jshell echoing the snippet back can never be mistaken for the job finishing.
+    """
+    half = len(sentinel) // 2
+    return f"System.out.println({java_string(sentinel[:half])} + {java_string(sentinel[half:] + ' ' + job_id)}); "
+
+
+class SyntheaWorker:
+    """
+    A single warm Synthea JVM. Synthea is started once inside jshell and each job calls
+    org.mitre.synthea.App.main again, so loaded classes and modules are reused between jobs.
+
+    Mandatory args: name: string
+    Optional args: jvm_options: list[str], e.g. ["-Xmx4g"]
+    """
+
+    def __init__(self, name, jvm_options=None):
+        self.name = name
+        self.jvm_options = jvm_options or []
+        self.process = None
+        self.job_numbers = itertools.count(1)
+
+    def start(self):
+        command = ["jshell", "-q", "--feedback", "silent", "--class-path", SYNTHEA_JAR]
+        command += [f"-R{option}" for option in self.jvm_options]
+
+        self.process = subprocess.Popen(
+            command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            bufsize=1,
+        )
+
+        # Warm up with a single patient so Synthea's modules are loaded before the first real job
+        print(f"{self.name}: warming up Synthea...")
+        warm_up_folder_path = self.run_job(1, "1-100", "F")
+        shutil.rmtree(warm_up_folder_path.parent, ignore_errors=True)
+        print(f"{self.name}: ready ✓")
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def run_job(self, x, age, sex):
+        """
+        Runs one generation job in the warm JVM and returns the folder holding the fhir output.
+        """
+        job_folder_path = worker_output_folder_path / f"{self.name}_job_{next(self.job_numbers)}"
+        job_id = uuid.uuid4().hex
+        if os.path.exists(job_folder_path):
+            shutil.rmtree(job_folder_path)
+
+        # Same arguments as the command line run, without "java -jar synthea-with-dependencies.jar"
+        arguments = build_synthea_command(x, age, sex, base_directory=job_folder_path)[3:]
+        java_arguments = ", ".join(java_string(argument) for argument in arguments)
+
+        snippet = (
+            "try { "
+            f"org.mitre.synthea.App.main(new String[]{{{java_arguments}}}); "
+            + java_sentinel(JOB_OK, job_id) +
+            "} catch (Throwable t) { "
+            "t.printStackTrace(System.out); "
+            + java_sentinel(JOB_FAILED, job_id) +
+            "}"
+        )
+        self.process.stdin.write(snippet + "\n")
+        self.process.stdin.flush()
+
+        # Wait for the sentinel of this job, printed as a whole line once it has finished
+        for line in self.process.stdout:
+            if line.strip() == f"{JOB_OK} {job_id}":
+                return job_folder_path / "fhir"
+            if line.strip() == f"{JOB_FAILED} {job_id}":
+                raise RuntimeError(f"{self.name}: Synthea job failed")
+
+        raise RuntimeError(f"{self.name}: Synthea worker exited")
+
+    def stop(self):
+        if self.is_alive():
+            self.process.stdin.write("/exit\n")
+            self.process.stdin.flush()
+            self.process.wait(timeout=30)
+
+
+class SyntheaWorkerPool:
+    """
+    A pool of warm Synthea workers. Jobs are handed to the next idle worker.
+
+    Optional args: workers: int, jvm_options: list[str]
+    """
+
+    def __init__(self, workers=1, jvm_options=None):
+        self.workers = [SyntheaWorker(f"worker_{i}", jvm_options) for i in range(workers)]
+        self.idle_workers = queue.Queue()
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+            self.idle_workers.put(worker)
+
+    def generate(self, info):
+        """
+        Generates patients and moves them into the Work folder.
+
+        Mandatory args: info: dict{number_of_patients, age_from, age_to, sex}
+        Returns the list of file names added to Work.
+        """
+        number_of_patients = int(info["number_of_patients"])
+        age = f"{info['age_from']}-{info['age_to']}"
+
+        worker = self.idle_workers.get()
+        try:
+            if not worker.is_alive():
+                print(f"{worker.name}: restarting Synthea...")
+                worker.start()
+            manifest = RunManifest(number_of_patients, age, info["sex"])
+            fhir_folder_path = worker.run_job(number_of_patients, age, info["sex"])
+            moved = merge_into_work(fhir_folder_path, number_of_patients, worker.name, manifest)
+            shutil.rmtree(fhir_folder_path.parent)
+            manifest.save()
+        finally:
+            self.idle_workers.put(worker)
+
+        return [path.name for path in moved]
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
+
+
+class SyntheaJobHandler(socketserver.StreamRequestHandler):
+    """Reads one JSON job per line and replies with one JSON result per line."""
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                info = json.loads(line)
+                files = self.server.pool.generate(info)
+                reply = {"status": "ok", "count": len(files), "files": files}
+            except Exception as e:
+                reply = {"status": "error", "error": f"{type(e).__name__}: {e}"}
+            self.wfile.write((json.dumps(reply) + "\n").encode())
+
+
+class SyntheaWorkerServer(socketserver.ThreadingTCPServer):
+    """Accepts generation jobs for a SyntheaWorkerPool on a local socket."""
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, pool, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        self.pool = pool
+        super().__init__((host, port), SyntheaJobHandler)
+
+
+def parse_worker_address(address):
+    """Turns "host:port" into a (host, port) tuple."""
+    if isinstance(address, tuple):
+        return address
+    host, _, port = address.rpartition(":")
+    return host or DEFAULT_HOST, int(port)
+
+
+def request_patients(info, address, timeout=None):
+    """
+    Sends a generation job to a running SyntheaWorkerServer and waits for the result.
+
+    Mandatory args: info: dict{number_of_patients, age_from, age_to, sex}, address: "host:port" or (host, port)
+    Returns the list of file names added to Work.
+    """
+    with socket.create_connection(parse_worker_address(address), timeout=timeout) as connection:
+        connection.sendall((json.dumps(info) + "\n").encode())
+        reply = json.loads(connection.makefile("r").readline())
+
+    if reply["status"] != "ok":
+        raise RuntimeError(reply["error"])
+
+    return reply["files"]
+
+
+def serve(host=DEFAULT_HOST, port=DEFAULT_PORT, workers=1, jvm_options=None):
+    pool = SyntheaWorkerPool(workers=workers, jvm_options=jvm_options)
+    pool.start()
+
+    with SyntheaWorkerServer(pool, host, port) as server:
+        print(f"Synthea worker pool listening on {host}:{port} ✓")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            pool.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a warm Synthea worker pool")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--jvm-option", action="append", dest="jvm_options")
+    args = parser.parse_args()
+
+    serve(args.host, args.port, args.workers, args.jvm_options)
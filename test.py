@@ -1,13 +1,24 @@
 from pathlib import Path
 from main import initialize_firestore, get_firestore_age_range, hl7_folder_path, produce_ADT_A01_from_firestore, \
-    produce_OML_O21_from_firestore
+    produce_OML_O21_from_firestore, stream_OML_O21_from_firestore, create_adt_message, create_orm_message, create_oru_message, create_oml_message, \
+    message_to_er7, HL7MessageProcessor, claim_worker_share
+from segments.er7_template import generate_message_values, render_er7_message
+from generators.identifiers import ControlIdGenerator, IdentifierSpace, IdentifierStore, format_digits_letters, \
+    format_six_digits, reset_identifiers
+from generators.ledger import ProcessingLedger
+from generators.patient_cache import PatientCache
+from generators.histogram import AgeHistogram
+from generators.paging import iter_parallel_pages, iter_query_pages, split_range
+from generators.columnar import ColumnarPopulation, export_population
+from mllp import MLLPLoopbackServer, MLLPSender
 from generators.utilities import PatientCondition, PatientInfo, PatientObservation, \
     assign_age_to_patient, calculate_age, count_patient_records, parse_fhir_message, save_to_firestore, \
         firestore_doc_to_patient_info, create_patient_id
-import unittest, datetime, numbers, os, os.path
+import unittest, unittest.mock, datetime, json, multiprocessing, numbers, os, os.path, random, tempfile, tracemalloc
 from poll_synthea import call_for_patients
 from google.cloud.firestore_v1.base_query import FieldFilter
 from google.cloud.firestore_v1 import aggregation
+from google.api_core import exceptions
 import requests
 
 BASE_DIR = Path.cwd()
@@ -31,6 +42,88 @@ def number_to_alphanumeric_upper(n):
     
     # Pad with leading zeros to ensure the result is 5 characters long
     return result_str.zfill(5)
+
+
+def synthea_bundle():
+    """Returns a small bundle shaped like Synthea's output, with the kinds of values the parsers treat 
+    differently: date-only and zoned dates, decimals, coded values, components and resources to skip."""
+    patient = "urn:uuid:patient"
+    coding = lambda system, code: {"coding": [{"system": system, "code": code}]}
+    loinc = lambda code, text: dict(coding("http://loinc.org", code), text=text)
+    category = lambda code: [coding("http://terminology.hl7.org/CodeSystem/observation-category", code)]
+    resources = [
+        {"resourceType": "Patient", "id": "patient",
+         "identifier": [{"system": "https://github.com/synthetichealth/synthea", "value": "patient"},
+                        {"system": "http://hl7.org/fhir/sid/us-ssn", "value": "999-12-3456"}],
+         "name": [{"use": "official", "family": "Doe123", "given": ["Jane456", "Ann"]}],
+         "gender": "female", "birthDate": "1980-06-15"},
+        {"resourceType": "Encounter", "id": "encounter", "status": "finished", "subject": {"reference": patient},
+         "class": {"system": "http://terminology.hl7.org/CodeSystem/v3-ActCode", "code": "AMB"}},
+        {"resourceType": "Condition", "id": "sinusitis",
+         "clinicalStatus": coding("http://terminology.hl7.org/CodeSystem/condition-clinical", "resolved"),
+         "verificationStatus": coding("http://terminology.hl7.org/CodeSystem/condition-ver-status", "confirmed"),
+         "code": dict(coding("http://snomed.info/sct", "444814009"), text="Viral sinusitis (disorder)"),
+         "subject": {"reference": patient}, "encounter": {"reference": "urn:uuid:encounter"},
+         "onsetDateTime": "2015-03-01T10:00:00-05:00", "abatementDateTime": "2015-03-20", "recordedDate": "2015-03-01"},
+        {"resourceType": "Condition", "id": "obesity",
+         "clinicalStatus": coding("http://terminology.hl7.org/CodeSystem/condition-clinical", "active"),
+         "verificationStatus": coding("http://terminology.hl7.org/CodeSystem/condition-ver-status", "confirmed"),
+         "code": dict(coding("http://snomed.info/sct", "162864005"), text="Body mass index 30+ - obesity (finding)"),
+         "subject": {"reference": patient}, "encounter": {"reference": "urn:uuid:encounter"}, "onsetDateTime": "2016", "recordedDate": "2016-03-01T10:00:00Z"},
+        {"resourceType": "Observation", "id": "height", "status": "final", "category": category("vital-signs"),
+         "code": loinc("8302-2", "Body Height"), "subject": {"reference": patient}, "encounter": {"reference": "urn:uuid:encounter"},
+         "effectiveDateTime": "2015-03-01", "issued": "2015-03-01T10:00:00.123-05:00",
+         "valueQuantity": {"value": 0.00012, "unit": "cm"}},
+        {"resourceType": "Observation", "id": "blood-pressure", "status": "final", "category": category("vital-signs"),
+         "code": loinc("85354-9", "Blood pressure panel"), "subject": {"reference": patient}, "encounter": {"reference": "urn:uuid:encounter"},
+         "effectiveDateTime": "2015-03-01T10:00:00-05:00", "issued": "2015-03-01T15:00:00Z",
+         "component": [{"code": loinc("8462-4", "Diastolic Blood Pressure"), "valueQuantity": {"value": 82, "unit": "mm[Hg]"}},
+                       {"code": loinc("8480-6", "Systolic Blood Pressure"), "valueQuantity": {"value": 120.50, "unit": "mm[Hg]"}}]},
+        {"resourceType": "Observation", "id": "smoking", "status": "final", "category": category("survey"),
+         "code": loinc("72166-2", "Tobacco smoking status"), "subject": {"reference": patient}, "encounter": {"reference": "urn:uuid:encounter"},
+         "effectiveDateTime": "2015-03", "issued": "2015-03-01T10:00:00-05:00",
+         "valueCodeableConcept": dict(coding("http://snomed.info/sct", "266919005"), text="Never smoked tobacco (finding)")},
+    ]
+    entries = [{"fullUrl": f"urn:uuid:{resource['id']}", "resource": resource,
+                "request": {"method": "POST", "url": resource["resourceType"]}} for resource in resources]
+    return {"resourceType": "Bundle", "type": "transaction", "entry": entries}
+
+
+def synthetic_patient_data(number):
+    """Returns the ``to_dict`` form of a made up patient with 4 conditions and 22 observations, about as many 
+    as a retrieved Synthea patient has."""
+    conditions = [{"condition": f"Condition {number % 40 + i}", "clinical_status": "resolved" if i % 2 else "active",
+                   "verification_status": "confirmed", "onset_date_time": f"2015-03-{i + 1:02d}T10:00:00-05:00",
+                   "recorded_date": f"2015-03-{i + 1:02d}T10:00:00-05:00", "abatement_time": None,
+                   "encounter_reference": f"urn:uuid:encounter-{number}-{i}", "subject_reference": f"urn:uuid:patient-{number}",
+                   "snomed_code": str(444814009 + i)} for i in range(4)]
+    observations = [{"category": "vital-signs" if i % 3 else "laboratory", "observation": f"Observation {i}", "status": "final",
+                     "effective_date_time": f"2015-03-01T10:{i:02d}:00-05:00", "issued": f"2015-03-01T10:{i:02d}:00.123-05:00",
+                     "value_quantity": f"{number % 97 + i / 10}mg/dL" if i % 4 else None,
+                     "value_codeable_concept": None if i % 4 else "Never smoked tobacco (finding)",
+                     "encounter_reference": f"urn:uuid:encounter-{number}-{i % 4}", "subject_reference": f"urn:uuid:patient-{number}",
+                     "component": [{"code_text": "Diastolic Blood Pressure", "result": f"{70 + number % 20}mm[Hg]"},
+                                   {"code_text": "Systolic Blood Pressure", "result": f"{110 + number % 30}mm[Hg]"}] if i == 0 else None}
+                    for i in range(22)]
+    return {"id": f"patient-{number}", "hl7v2_id": [f"SYN{number:05d}^^^PAS^MR"], "birth_date": f"{1940 + number % 80}-01-01",
+            "gender": "female" if number % 2 else "male", "ssn": f"999-{number % 100:02d}-{number:04d}", "first_name": f"Jane{number}",
+            "middle_name": None, "last_name": f"Doe{number}", "address": f"{number} Main St", "address_2": "", "city": "Belfast",
+            "country": "UK", "post_code": "BT1 1AA", "country_code": "GB", "age": 1 + number % 80, "creation_date": "2023-10-17",
+            "conditions": conditions, "observations": observations}
+
+
+class UnslottedRecord:
+    """A record holding its fields in a per-instance ``__dict__`` without interning, as the model classes did before 
+    they were slotted, to measure them against."""
+    def __init__(self, data):
+        self.__dict__.update(data)
+
+
+class UnslottedPatient(UnslottedRecord):
+    def __init__(self, data):
+        super().__init__(data)
+        self.conditions = [UnslottedRecord(condition) for condition in data["conditions"]]
+        self.observations = [UnslottedRecord(observation) for observation in data["observations"]]
   
 
 class Test(unittest.TestCase):
@@ -70,6 +163,110 @@ class Test(unittest.TestCase):
                 self.assertTrue(lower_bound <= calculate_age(patient.birth_date) <= upper_bound, "Should be within given range")
 
 
+    def test_parallel_patient_retrieval_in_age_range(self):
+        """Test that patients read by several paged readers are unique and within the age range"""
+
+        num_of_patients = 10
+        lower_bound = 10
+        upper_bound = 20
+
+        patients: list[PatientInfo] = get_firestore_age_range(db=firestore, num_of_patients=num_of_patients, \
+                                                              lower=lower_bound, upper=upper_bound, peter_pan=True, readers=3)
+
+        self.assertEqual(num_of_patients, len(patients))
+        self.assertEqual(num_of_patients, len({patient.id for patient in patients}), "Should not repeat patients")
+        for patient in patients: 
+            with self.subTest(patient = patient):
+                self.assertTrue(lower_bound <= patient.age <= upper_bound, "Should be within given range")
+
+
+    def test_paging_without_firestore(self):
+        """Testing cursor paging, retries after transient errors, range splitting and parallel reads 
+        against an in-memory stand-in for a Firestore query
+        """
+        class Snapshot:
+            def __init__(self, data):
+                self.id = data["id"]
+                self.data = data
+
+            def to_dict(self):
+                return self.data
+
+        class Query:
+            # Documents sorted by age then id, as the real query orders them, read in pages
+            def __init__(self, docs, low, high, log, failures=0, limit=None, after=None):
+                self.docs, self.low, self.high, self.log = docs, low, high, log
+                self.failures, self.page_limit, self.after = failures, limit, after
+
+            def order_by(self, field):
+                return self
+
+            def limit(self, count):
+                return Query(self.docs, self.low, self.high, self.log, self.failures, count, self.after)
+
+            def start_after(self, snapshot):
+                return Query(self.docs, self.low, self.high, self.log, self.failures, self.page_limit, snapshot)
+
+            def stream(self):
+                if self.log["failures"] < self.failures:
+                    self.log["failures"] += 1
+                    raise exceptions.ServiceUnavailable("dropped")
+                key = lambda data: (data["age"], data["id"])
+                page = [Snapshot(data) for data in self.docs if self.low <= data["age"] <= self.high
+                        and (self.after is None or key(data) > key(self.after.data))][:self.page_limit]
+                self.log["read"] += max(1, len(page))
+                return iter(page)
+
+        docs = sorted(({"id": f"patient-{i:05d}", "age": i % 100} for i in range(5000)), key=lambda d: (d["age"], d["id"]))
+
+        log = {"read": 0, "failures": 0}
+        paged = [doc.id for doc in iter_query_pages(Query(docs, 10, 19, log, failures=2), "age", 10**6, page_size=120)]
+        self.assertEqual([doc["id"] for doc in docs if 10 <= doc["age"] <= 19], paged)
+        self.assertEqual(2, log["failures"])
+        self.assertEqual(500, log["read"])
+
+        self.assertEqual([(0, 24), (25, 49), (50, 74), (75, 99)], split_range(0, 99, 4))
+        self.assertEqual([("2000-01-01", "2000-01-02"), ("2000-01-03", "2000-01-03")], split_range("2000-01-01", "2000-01-03", 2))
+
+        log = {"read": 0, "failures": 0}
+        queries = [Query(docs, low, high, log) for low, high in split_range(0, 99, 4)]
+        read = [doc.id for doc in iter_parallel_pages(queries, "age", 1234, page_size=100)]
+        self.assertEqual(1234, len(read))
+        self.assertEqual(1234, len(set(read)))
+        # Readers share the limit, so nothing beyond it is read
+        self.assertEqual(1234, log["read"])
+
+    def test_patient_cache_read_through(self):
+        """Test that patients read a second time come from the local cache, unchanged"""
+
+        with tempfile.TemporaryDirectory() as folder:
+            cache = PatientCache(Path(folder, "patients.sqlite"))
+
+            first = get_firestore_age_range(db=firestore, num_of_patients=5, lower=10, upper=20, peter_pan=True, cache=cache)
+            self.assertGreaterEqual(cache.count("age", 10, 20), 5)
+
+            second = get_firestore_age_range(db=firestore, num_of_patients=5, lower=10, upper=20, peter_pan=True, cache=cache)
+            self.assertEqual([patient.id for patient in first], [patient.id for patient in second])
+            cache.close()
+
+
+    def test_patient_cache_stores_patients_read_from_firestore(self):
+        """Test that patients missing from the cache are read from Firestore and then stored in it"""
+
+        with tempfile.TemporaryDirectory() as folder:
+            # A sync which has just run keeps the cache empty, so the patients must come from Firestore
+            cache = PatientCache(Path(folder, "patients.sqlite"), sync_interval=float("inf"))
+            cache.set_meta("last_sync", datetime.datetime.now().timestamp())
+            self.assertEqual(0, cache.count("age", 10, 20))
+
+            first = get_firestore_age_range(db=firestore, num_of_patients=5, lower=10, upper=20, peter_pan=True, cache=cache)
+            self.assertEqual(0, cache.sync(firestore))
+            self.assertEqual(len(first), cache.count("age", 10, 20))
+
+            cached_ids = {data["id"] for data in cache.query("age", 10, 20, len(first))}
+            self.assertEqual({patient.id for patient in first}, cached_ids)
+            cache.close()
+
     def test_assign_patient_age(self):
         """Test to ensure patients are correctly assigned their new age, along with a valid dob. 
         
@@ -109,6 +306,38 @@ class Test(unittest.TestCase):
         self.assertIsInstance(count, numbers.Number)
 
 
+    def test_age_histogram_matches_count(self):
+        """Testing that the age histogram counts the same patients as an aggregation query"""
+
+        histogram = AgeHistogram(firestore)
+        if not histogram.exists:
+            self.skipTest("The age histogram has not been built; run AgeHistogram(db).rebuild()")
+
+        count, query = count_patient_records(firestore, 10, 20, True)
+        self.assertEqual(count, histogram.count(10, 20))
+
+    def test_age_histogram_needs_rebuild_before_it_is_trusted(self):
+        """Testing that a counter document created by uploads alone is not trusted, and that counts fall back to 
+        the aggregation query until ``rebuild`` has marked it built. Runs without Firestore.
+        """
+        db = unittest.mock.MagicMock()
+        counts = {"female": {"15": 2}}
+        db.collection.return_value.document.return_value.get.return_value = \
+            unittest.mock.Mock(exists=True, to_dict=lambda: {"counts": counts})
+
+        aggregate_query = unittest.mock.Mock()
+        aggregate_query.get.return_value = [[unittest.mock.Mock(value=7)]]
+        with unittest.mock.patch("generators.utilities.aggregation.AggregationQuery", return_value=aggregate_query):
+            histogram = AgeHistogram(db)
+            self.assertFalse(histogram.exists)
+            self.assertEqual(7, count_patient_records(db, 10, 20, True, histogram)[0])
+
+            db.collection.return_value.document.return_value.get.return_value = \
+                unittest.mock.Mock(exists=True, to_dict=lambda: {"counts": counts, "built": True})
+            histogram.refresh()
+            self.assertTrue(histogram.exists)
+            self.assertEqual(2, count_patient_records(db, 10, 20, True, histogram)[0])
+
     def test_production_of_ADT_A01(self):
         """Testing the production of ADT_A01 messages using patient info from firestore.
         
@@ -152,6 +381,18 @@ class Test(unittest.TestCase):
             print("-----------------\n")
 
 
+    def test_streaming_of_OML_021(self):
+        """Testing that streamed OML_O21 messages are yielded one at a time, with the assigned age"""
+
+        messages = stream_OML_O21_from_firestore(db=firestore, num_of_patients=3, age=30, assign_age=True)
+
+        patient, hl7_message = next(messages)
+        self.assertEqual(30, patient.age)
+        self.assertEqual("OML^O21", hl7_message.msh.msh_9.value)
+
+        self.assertEqual(2, len(list(messages)))
+
+
     def test_generation_of_patients_following_low_count(self):
         num_of_patients = 35
         lower = 56
@@ -255,6 +496,25 @@ class Test(unittest.TestCase):
                                 self.assertTrue(component["result"])
 
 
+    def test_fast_and_validated_parsing_agree(self):
+        """Testing that the plain JSON parser builds the same ``PatientInfo`` as the fhir.resources models, 
+        down to the types of the dates. Runs without Firestore.
+        """
+        fhir_message = json.dumps(synthea_bundle())
+        address = dict(address="1 Main St", address_2="", city="Belfast", country="UK", post_code="BT1 1AA", country_code="GB")
+
+        with unittest.mock.patch("generators.utilities.create_patient_id", return_value="SYN00001^^^PAS^MR"), \
+                unittest.mock.patch("generators.utilities.request_random_address", return_value=address):
+            validated = parse_fhir_message(db=None, fhir_message=fhir_message, validate=True)
+            fast = parse_fhir_message(db=None, fhir_message=fhir_message)
+
+        self.assertEqual(2, len(validated.conditions))
+        self.assertEqual(3, len(validated.observations))
+        self.assertEqual(validated.to_dict(), fast.to_dict())
+        for expected, actual in zip(validated.conditions + validated.observations, fast.conditions + fast.observations):
+            self.assertEqual([type(value) for value in expected.to_dict().values()],
+                             [type(value) for value in actual.to_dict().values()])
+
     def test_fhir_conditions_observations_upload(self):
         """Testing the upload of patient conditions and observations to Firestore. 
         """
@@ -363,7 +623,8 @@ class Test(unittest.TestCase):
         """Testing the generation of a new patient hl7v2 id 
 
         Will need to manually check against the database that the printed value is 
-        an iteration above the highest stored id in the database. 
+        above the highest stored id in the database, and below the ``next`` value of 
+        the ``counters/hl7v2_id`` document. 
 
         """
         print(create_patient_id(db=firestore))
@@ -417,6 +678,255 @@ class Test(unittest.TestCase):
         print(response.json())
 
 
+    def test_er7_template_matches_hl7apy(self):
+        """Testing that the template engine writes the same ER7 text as the hl7apy messages
+
+        Both engines draw their ids from the same seeded random stream, starting a new identifier 
+        run each time; only the control id, which comes from the clock, is copied across. 
+        """
+        patient_info = PatientInfo(id="test-patient", birth_date=datetime.date(1985, 6, 1), gender="female", 
+                                   ssn="999-99-9999", first_name="Mary-Jane", middle_name=None, last_name="O'Neil", 
+                                   address="12 High Street", address_2="", city="Belfast", country="United Kingdom", 
+                                   post_code="BT1 1AA", country_code="GB", age=38, creation_date=None, hl7v2_id=["AB123"])
+        
+        builders = {"ADT_A01": create_adt_message, "ORM_O01": create_orm_message, 
+                    "ORU_R01": create_oru_message, "OML_O21": create_oml_message}
+
+        for message_type, create_message in builders.items():
+            for seed in range(10):
+                random.seed(seed)
+                reset_identifiers()
+                hl7_message = create_message(patient_info, message_type)
+
+                random.seed(seed)
+                reset_identifiers()
+                values = generate_message_values(message_type)
+                values["control_id"] = hl7_message.msh.msh_10.value
+
+                self.assertEqual(message_to_er7(hl7_message, message_type), 
+                                 render_er7_message(patient_info, message_type, values))
+
+
+    def test_mllp_delivery_to_loopback(self):
+        """Testing that every message sent over MLLP is accepted, with NAKed messages sent again"""
+        patient_info = PatientInfo(id="test-patient", birth_date=datetime.date(1985, 6, 1), gender="female", 
+                                   ssn="999-99-9999", first_name="Mary", middle_name=None, last_name="Smith", 
+                                   address="12 High Street", address_2="", city="Belfast", country="United Kingdom", 
+                                   post_code="BT1 1AA", country_code="GB", age=38, creation_date=None, hl7v2_id=["AB123"])
+
+        server = MLLPLoopbackServer(nak_every=5)
+        host, port = server.start()
+        try:
+            sender = MLLPSender(host, port, connections=2, window=4)
+            for _ in range(100):
+                sender.write(render_er7_message(patient_info, "ADT_A01"), patient_info.id)
+            rejected = sender.close()
+        finally:
+            server.stop()
+
+        self.assertEqual([], rejected)
+        self.assertEqual(100, sender.stats()["accepted"])
+        self.assertEqual(100, len(server.attempts))
+        self.assertGreater(sender.stats()["resent"], 0)
+        self.assertEqual(len(server.received), 100 + sender.stats()["resent"])
+
+
+    def test_mllp_gives_up_on_rejects_and_silence(self):
+        """Testing that messages rejected with AR are not sent again, and that messages to a receiver which 
+        never answers are resent up to retries times and then reported as not acknowledged
+        """
+        messages = [f"MSH|^~\\&|POLL|SYNTHEA|ENGINE|HOSPITAL|20230101||ADT^A01|MSG{i:05d}|P|2.4\r" for i in range(10)]
+
+        server = MLLPLoopbackServer(nak_every=2, nak_code="AR")
+        host, port = server.start()
+        try:
+            sender = MLLPSender(host, port, connections=1, window=4)
+            for message in messages:
+                sender.write(message)
+            rejected = sender.close()
+        finally:
+            server.stop()
+
+        self.assertEqual(5, len(rejected))
+        self.assertTrue(all(ack.code == "AR" and ack.attempts == 1 for ack in rejected))
+        self.assertEqual(10, len(server.received))
+
+        server = MLLPLoopbackServer(silent=True)
+        host, port = server.start()
+        try:
+            sender = MLLPSender(host, port, connections=2, window=4, retries=2, timeout=0.5)
+            for message in messages:
+                sender.write(message)
+            rejected = sender.close()
+        finally:
+            server.stop()
+
+        self.assertEqual(10, len(rejected))
+        self.assertTrue(all(ack.code is None and ack.attempts == 3 for ack in rejected))
+        self.assertEqual(30, len(server.received))
+
+
+    def test_columnar_population_round_trip(self):
+        """Testing that patients exported to Parquet are rebuilt unchanged, with their conditions and observations, 
+        and that a patient shaped like a Firestore document is normalised as documented. Runs without Firestore.
+        """
+        try:
+            import pyarrow
+        except ImportError:
+            self.skipTest("pyarrow is not installed")
+
+        address = dict(address="1 Main St", address_2="", city="Belfast", country="UK", post_code="BT1 1AA", country_code="GB")
+        with unittest.mock.patch("generators.utilities.create_patient_id", return_value="SYN00001^^^PAS^MR"), \
+                unittest.mock.patch("generators.utilities.request_random_address", return_value=address):
+            parsed = parse_fhir_message(db=None, fhir_message=json.dumps(synthea_bundle()))
+
+        patients = []
+        for i in range(20):
+            patient_data = parsed.to_dict()
+            patient_data.update(id=f"patient-{i}", age=i * 5, conditions=patient_data["conditions"][:i % 3],
+                                observations=patient_data["observations"][:i % 4])
+            patients.append(PatientInfo.from_dict(patient_data))
+
+        # As read from Firestore: a single hl7v2_id and ISO text dates
+        stored = dict(patients[0].to_dict(), id="stored", hl7v2_id="SYN00002^^^PAS^MR", birth_date="1980-01-01",
+                      creation_date="2023-10-17")
+        patients.append(PatientInfo.from_dict(stored))
+
+        with tempfile.TemporaryDirectory() as folder:
+            self.assertEqual(len(patients), export_population(patients, folder, batch_size=7))
+            population = ColumnarPopulation(folder)
+            reloaded = list(population)
+
+            self.assertEqual(len(patients), len(population))
+            for patient_info, reloaded_info in zip(patients[:-1], reloaded):
+                self.assertEqual(patient_info.to_dict(), reloaded_info.to_dict())
+                self.assertEqual(repr(patient_info), repr(reloaded_info))
+
+            normalised = dict(stored, hl7v2_id=["SYN00002^^^PAS^MR"], birth_date=datetime.date(1980, 1, 1),
+                              creation_date=datetime.date(2023, 10, 17))
+            self.assertEqual(normalised, reloaded[-1].to_dict())
+
+            self.assertEqual([patient_info.id for patient_info in patients if 30 <= patient_info.age <= 60],
+                             [patient_info.id for patient_info in population.iter_age_range(30, 60)])
+
+
+    def test_slotted_patients_memory(self):
+        """Testing that patients rebuilt with ``from_dict`` match their dicts, and that a synthetic population held in 
+        the slotted, interned classes takes less memory than in equivalent classes with a per-instance ``__dict__``. 
+        Runs without Firestore.
+        """
+        population = json.dumps([synthetic_patient_data(number) for number in range(2000)])
+
+        def traced_bytes(build):
+            # Decoded inside the trace, so every patient gets its own copy of each string, as when read from Firestore
+            tracemalloc.start()
+            try:
+                patients = build(json.loads(population))
+                return tracemalloc.get_traced_memory()[0], patients
+            finally:
+                tracemalloc.stop()
+
+        slotted_bytes, slotted = traced_bytes(lambda data: [PatientInfo.from_dict(patient_data) for patient_data in data])
+        unslotted_bytes, unslotted = traced_bytes(lambda data: [UnslottedPatient(patient_data) for patient_data in data])
+
+        for patient_info, patient in zip(slotted[:50], unslotted):
+            self.assertEqual(repr(patient_info), repr(PatientInfo.from_dict(patient_info.to_dict())))
+            self.assertEqual(patient_info.to_dict(), {**vars(patient), "conditions": [vars(condition) for condition in patient.conditions],
+                                                      "observations": [vars(observation) for observation in patient.observations]})
+
+        # The caller's component dicts, e.g. those of a cached document, are left as they were
+        observation_data = dict(synthetic_patient_data(0)["observations"][0], component=[{"result": "Never"}])
+        PatientObservation.from_dict(observation_data)
+        self.assertEqual([{"result": "Never"}], observation_data["component"])
+
+        observations = sum(len(patient_info.observations) for patient_info in slotted)
+        print(f"{len(slotted)} patients with {observations} observations: {unslotted_bytes / 2**20:.1f} MB with a __dict__, "
+              f"{slotted_bytes / 2**20:.1f} MB slotted")
+        self.assertLess(slotted_bytes, unslotted_bytes * 0.8)
+
+    def test_identifier_partitions_never_overlap(self):
+        """Testing that processes given different shares of an identifier space never hand out the same identifier"""
+        shares = [IdentifierSpace("placer order number", 676000, format_digits_letters) for _ in range(3)]
+        for index, space in enumerate(shares):
+            space.partition(index, 3)
+
+        identifiers = [identifier for space in shares for identifier in space.take(space.size)]
+        self.assertEqual(676000, len(identifiers))
+        self.assertEqual(676000, len(set(identifiers)))
+        self.assertRaises(RuntimeError, shares[0].take, 1)
+
+    def test_identifiers_never_repeat_within_an_output_folder(self):
+        """Testing that a second run recording identifiers in the same folder's store never hands out one 
+        handed out by the first run"""
+        with tempfile.TemporaryDirectory() as folder:
+            runs = []
+            for count in (600, 400):
+                store = IdentifierStore(Path(folder) / ".identifiers.sqlite")
+                space = IdentifierSpace("visit number", 1000, format_six_digits, batch_size=100)
+                space.use_store(store)
+                runs.append([space.next() for _ in range(count)])
+                store.close()
+
+        self.assertEqual(1000, len(set(runs[0]) | set(runs[1])))
+        self.assertRaises(RuntimeError, space.take, 1)
+
+    def test_control_ids_differ_for_any_two_process_ids(self):
+        """Testing that process ids which only differ above four base 36 digits, as Linux allows, still 
+        give different control ids"""
+        first = ControlIdGenerator(worker_id=12345).next()
+        second = ControlIdGenerator(worker_id=12345 + 36 ** 4).next()
+        self.assertEqual(17, len(first))
+        self.assertNotEqual(first[6:11], second[6:11])
+
+    def test_replacement_worker_takes_the_dead_workers_share(self):
+        """Testing that a worker replacing one that died takes the dead worker's share of the identifier 
+        spaces, never the share of a worker that is still running"""
+        finished = multiprocessing.get_context("spawn").Process(target=os.getpid)
+        finished.start()
+        finished.join()
+
+        worker_shares = multiprocessing.Array("i", [os.getpid(), finished.pid, 0])
+        self.assertEqual(1, claim_worker_share(worker_shares))
+        self.assertEqual(2, claim_worker_share(worker_shares))
+        self.assertRaises(RuntimeError, claim_worker_share, worker_shares)
+
+    def test_worker_processes_with_ledger(self):
+        """Testing that fhir files are spread across two worker processes while the ledger, which is 
+        consulted from the pool's task thread, skips the files already processed. Runs without Firestore, 
+        with uploads turned off.
+        """
+        with tempfile.TemporaryDirectory() as folder, \
+                unittest.mock.patch.dict(os.environ, {"POLL_SYNTHEA_OFFLINE": "1"}):
+            folder = Path(folder)
+            files = []
+            for i in range(6):
+                bundle = synthea_bundle()
+                bundle["entry"][0]["resource"]["id"] = f"patient-{i}"
+                file = folder / f"bundle_{i}.json"
+                file.write_text(json.dumps(bundle))
+                files.append(file)
+
+            ledger = ProcessingLedger(folder / "ledger.sqlite")
+            for file in files[:2]:
+                ledger.record(file, "ADT_A01", None)
+
+            (folder / "HL7_v2").mkdir()
+            processor = HL7MessageProcessor(folder / "HL7_v2", ledger=ledger, engine="template", upload=False)
+            try:
+                results = processor.main(predetermined_message_type="ADT_A01", fhir_files=files, workers=2)
+                self.assertTrue(all(ledger.is_processed(file, "ADT_A01") for file in files))
+            finally:
+                ledger.close()
+
+            self.assertEqual(2, processor.skipped)
+            self.assertEqual([str(file) for file in files[2:]], [result.file for result in results])
+            self.assertEqual([None] * 4, [result.error for result in results])
+            self.assertEqual([f"patient-{i}" for i in range(2, 6)], [result.patient_id for result in results])
+
+            messages = [Path(result.hl7_path).read_text() for result in results]
+            patient_ids = {message.split("PID|")[1].split("|")[2] for message in messages}
+            self.assertEqual(4, len(patient_ids))
+
 if __name__ == '__main__':
     firestore = initialize_firestore()
     unittest.main()
\ No newline at end of file